@@ -25,16 +25,334 @@
 # a warning about too few methods being implemented isn't useful.
 # pylint: disable=R0903
 
+import argparse
+import concurrent.futures
 import ctypes
+import fcntl
+import hashlib
 import json
+import math
 import os
 import pwd
+import re
+import shlex
+import shutil
+import signal
+import socket
+import socketserver
+import struct
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import urllib.request as request
 
+# Destinations for progress output, set up by setup_progress
+PROGRESS_SINKS = {"console": None, "metrics": None}
+# Minimum number of seconds between console progress updates
+PROGRESS_INTERVAL = 1.0
+# Summary of the install written to the metrics stream when it finishes
+INSTALL_REPORT = {"stages": {}, "commands": [], "scripts": []}
+# Seconds a command may run before it is killed, by program name
+COMMAND_TIMEOUTS = {"rsync": 4 * 3600, "dd": 4 * 3600, "xz": 3600,
+                    "zypper": 3600}
+# Timeout for programs not listed in COMMAND_TIMEOUTS
+COMMAND_TIMEOUT = 600
+# Maximum number of commands running at once across the installer
+MAX_PARALLEL_COMMANDS = 4
+COMMAND_SLOTS = threading.BoundedSemaphore(MAX_PARALLEL_COMMANDS)
+# Seconds allowed for an image mirror to return its first byte
+MIRROR_PROBE_TIMEOUT = 5
+# A download moves to the next mirror when fewer than MIRROR_MIN_THROUGHPUT
+# bytes per second arrive over MIRROR_WINDOW seconds
+MIRROR_MIN_THROUGHPUT = 1024 * 1024
+MIRROR_WINDOW = 10
+# URLs checked at once and seconds each may take when validating templates
+# in a batch
+VALIDATE_WORKERS = 16
+VALIDATE_URL_TIMEOUT = 10
+
+LAZY_CHUNK = 1024 * 1024
+LAZY_READ_AHEAD = 32 * 1024 * 1024
+LAZY_TIMEOUT = 30
+LAZY_SOURCES = []
+# Whether remote images are xz compressed and whether their server
+# honours range requests, by URL
+REMOTE_PROBES = {}
+# Scratch folder and nbd device of this run, allocated on first use and
+# released by release_run so concurrent runs don't share them. nbd
+# devices are reserved by holding a lock file in NBD_LOCK_DIR.
+RUN_RESOURCES = {"dir": None, "device": None, "lock": None}
+# Teardown work left running in the background once the target is
+# unmounted, waited for before the installer exits
+TEARDOWN = []
+NBD_LOCK_DIR = "/run/lock/ister"
+NBD_DEVICES = 16
+# Ramdisk installs keep the source image in memory. An xz image is assumed
+# to grow XZ_EXPANSION times when decompressed and plans are cached per
+# MEMORY_BUCKET of memory budget.
+XZ_EXPANSION = 4
+MEMORY_BUCKET = 256 * 1024 * 1024
+# Block device queue settings applied for the install by device class
+IO_PROFILES = {
+    "rotational": {"scheduler": "mq-deadline", "nr_requests": "256",
+                   "read_ahead_kb": "4096"},
+    "ssd": {"scheduler": "mq-deadline", "nr_requests": "256",
+            "read_ahead_kb": "1024"},
+    "nvme": {"scheduler": "none", "nr_requests": "1023",
+             "read_ahead_kb": "1024"},
+    "virtual": {"read_ahead_kb": "8192"}
+}
+# Order queue settings are written in, changing the scheduler resets
+# nr_requests
+IO_SETTINGS = ["scheduler", "nr_requests", "read_ahead_kb"]
+# Original queue settings of tuned devices, restored by cleanup
+IO_TUNING = {}
+SYSFS_BLOCK = "/sys/block"
+# Options target filesystems are mounted with while installing
+INSTALL_MOUNT_OPTIONS = {
+    "ext2": "noatime",
+    "ext3": "noatime,commit=60,data=writeback,barrier=0",
+    "ext4": "noatime,commit=60,data=writeback,barrier=0",
+    "xfs": "noatime,logbufs=8,logbsize=256k",
+    "btrfs": "noatime,commit=60,nobarrier",
+    "vfat": "noatime"
+}
+# Mount options written to fstab when the template doesn't give any
+DEFAULT_MOUNT_OPTIONS = "rw,relatime"
+# parted flags set on PartitionLayout partitions by type
+PARTITION_FLAGS = {"EFI": "boot", "raid": "raid"}
+# mdadm levels for the RaidSetup raid types
+RAID_LEVELS = {"md-raid0": "0", "md-raid1": "1", "md-raid10": "10"}
+# Arrays whose initial resync is frozen until cleanup
+DEFERRED_RESYNC = []
+# Chunk size of striped md arrays that don't set one
+RAID_CHUNK = "512K"
+
+# Template sections holding scripts run after the install, in order
+SCRIPT_STAGES = ["PostNonChroot", "PostChroot"]
+# Folder of the target PostChroot scripts are copied to while they run
+CHROOT_SCRIPT_DIR = "/var/tmp/ister-scripts"
+
+# Share of a partition assumed to go to filesystem metadata
+FILESYSTEM_OVERHEAD = 0.05
+
+COPY_STRATEGIES = ["rsync", "parallel", "image", "ordered"]
+# Below this many files a single rsync is as fast as several
+PARALLEL_COPY_MIN_FILES = 20000
+# Above this average file size the copy is bound by the disks, not rsync
+PARALLEL_COPY_MAX_AVERAGE = 256 * 1024
+# Bytes of source files hinted for read-ahead ahead of the ordered copy
+COPY_READ_AHEAD = 64 * 1024 * 1024
+FS_IOC_FIEMAP = 0xC020660B
+# Chunk written and flushed at a time when the copy drops its page cache
+COPY_CHUNK = 8 * 1024 * 1024
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+LIBC = ctypes.CDLL(None, use_errno=True)
+# Install plans are cached here keyed by the template hash
+PLAN_CACHE_DIR = "/var/cache/ister"
+# Bumped whenever the plan format or its steps change
+PLAN_VERSION = 20
+
+DAEMON_MAX_JOBS = 2
+DAEMON_CACHE_DIR = "/var/cache/ister/sources"
+DAEMON_CACHE_BUDGET = "20G"
+# Plan steps a daemon job leaves to the daemon's source cache
+SHARED_SOURCE_STEPS = ["get_source_image", "setup_source"]
+
+
+def format_bytes(count):
+    """Return a human readable representation of a byte count
+    """
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if count < 1024:
+            return "{0:.1f}{1}".format(count, unit)
+        count /= 1024.0
+    return "{0:.1f}TiB".format(count)
+
+
+def format_eta(seconds):
+    """Return seconds formatted as H:MM:SS
+    """
+    seconds = int(seconds)
+    return "{0}:{1:02d}:{2:02d}".format(seconds // 3600,
+                                        seconds // 60 % 60, seconds % 60)
+
+
+def open_metrics(location):
+    """Open the machine readable metrics stream
+
+    The location is either a file:// URI naming a textfile that metrics
+    are appended to, or a unix:// URI naming a listening stream socket.
+
+    This function will raise an Exception on finding an error.
+    """
+    if location.find("file://") == 0:
+        try:
+            return open(location[len("file://"):], "a")
+        except Exception as exep:
+            raise Exception("Unable to open metrics file {0}: {1}"
+                            .format(location, exep))
+    if location.find("unix://") == 0:
+        try:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(location[len("unix://"):])
+            return sock.makefile("w")
+        except Exception as exep:
+            raise Exception("Unable to connect to metrics socket {0}: {1}"
+                            .format(location, exep))
+    raise Exception("Invalid MetricsLocation {}, must be a file:// or \
+    unix:// URI".format(location))
+
+
+def setup_progress(console=None, metrics_location=None):
+    """Select where progress reports are written
+
+    console is a file descriptor for the human readable progress line,
+    metrics_location a URI accepted by open_metrics.
+    """
+    if console is not None:
+        PROGRESS_SINKS["console"] = console
+    if metrics_location:
+        PROGRESS_SINKS["metrics"] = open_metrics(metrics_location)
+
+
+def write_metric(event, **fields):
+    """Write one JSON encoded event to the metrics stream
+
+    Metrics are best effort, a broken stream is dropped rather than
+    failing the install.
+    """
+    metrics = PROGRESS_SINKS["metrics"]
+    if not metrics:
+        return
+    fields["event"] = event
+    fields["time"] = time.time()
+    try:
+        metrics.write(json.dumps(fields, sort_keys=True) + "\n")
+        metrics.flush()
+    except Exception:
+        PROGRESS_SINKS["metrics"] = None
+
+
+def write_console(message):
+    """Write a message to the installer console if there is one
+    """
+    if PROGRESS_SINKS["console"] is None:
+        return
+    try:
+        os.write(PROGRESS_SINKS["console"], message.encode("utf-8"))
+    except Exception:
+        PROGRESS_SINKS["console"] = None
+
+
+def emit_report(status):
+    """Write the install report to the metrics stream and console
+    """
+    INSTALL_REPORT["status"] = status
+    if INSTALL_REPORT.get("start"):
+        INSTALL_REPORT["seconds"] = time.time() - INSTALL_REPORT["start"]
+    write_metric("report", **INSTALL_REPORT)
+    for name, stage in sorted(INSTALL_REPORT["stages"].items(),
+                              key=lambda v: v[1]["start"]):
+        write_console("{0}: {1} {2} files in {3} ({4}/s)\n"
+                      .format(name, format_bytes(stage["bytes"]),
+                              stage["files"], format_eta(stage["seconds"]),
+                              format_bytes(stage["rate"])))
+    if INSTALL_REPORT.get("copy_cache"):
+        write_console("page cache peak during the copy: {}\n".format(
+            format_bytes(INSTALL_REPORT["copy_cache"]["peak_cache"])))
+    if INSTALL_REPORT.get("durable"):
+        write_console("data durable after: {}\n".format(
+            format_eta(INSTALL_REPORT["durable"])))
+    if INSTALL_REPORT.get("seconds"):
+        write_console("install: {}\n".format(
+            format_eta(INSTALL_REPORT["seconds"])))
+
+
+class ProgressStage(object):
+    """Class encapsulating progress reporting for one install stage
+    """
+    def __init__(self, name, total_bytes=0, total_files=0):
+        """Stores the stage name and the expected amount of work
+        """
+        self.name = name
+        self.total_bytes = total_bytes
+        self.total_files = total_files
+        self.done_bytes = 0
+        self.done_files = 0
+        self.start = 0
+        self.last_report = 0
+
+    def __enter__(self):
+        """Start timing the stage
+        """
+        self.start = time.time()
+        write_metric("stage-start", stage=self.name,
+                     total_bytes=self.total_bytes,
+                     total_files=self.total_files)
+        return self
+
+    def update(self, done_bytes=None, done_files=None, total_bytes=None,
+               total_files=None):
+        """Record progress and report it if enough time has passed
+        """
+        if done_bytes is not None:
+            self.done_bytes = done_bytes
+        if done_files is not None:
+            self.done_files = done_files
+        if total_bytes:
+            self.total_bytes = total_bytes
+        if total_files:
+            self.total_files = total_files
+        now = time.time()
+        if now - self.last_report < PROGRESS_INTERVAL:
+            return
+        self.last_report = now
+        self.report(now)
+
+    def report(self, now):
+        """Write the current progress, throughput and ETA
+        """
+        elapsed = max(now - self.start, 0.001)
+        rate = self.done_bytes / elapsed
+        eta = None
+        if rate > 0 and self.total_bytes > self.done_bytes:
+            eta = (self.total_bytes - self.done_bytes) / rate
+        write_metric("progress", stage=self.name, bytes=self.done_bytes,
+                     total_bytes=self.total_bytes, files=self.done_files,
+                     total_files=self.total_files, rate=rate, eta=eta)
+        line = "\r\x1b[K{0}: {1}".format(self.name,
+                                         format_bytes(self.done_bytes))
+        if self.total_bytes:
+            line += "/{}".format(format_bytes(self.total_bytes))
+        if self.total_files:
+            line += " {0}/{1} files".format(self.done_files,
+                                            self.total_files)
+        line += " {}/s".format(format_bytes(rate))
+        if eta is not None:
+            line += " ETA {}".format(format_eta(eta))
+        write_console(line)
+
+    def __exit__(self, *args):
+        """Report the final state of the stage and add it to the report
+        """
+        now = time.time()
+        self.report(now)
+        write_console("\n")
+        seconds = now - self.start
+        INSTALL_REPORT["stages"][self.name] = {
+            "start": self.start, "seconds": seconds,
+            "bytes": self.done_bytes, "files": self.done_files,
+            "rate": self.done_bytes / max(seconds, 0.001)}
+        write_metric("stage-end", stage=self.name, seconds=seconds,
+                     bytes=self.done_bytes, files=self.done_files,
+                     ok=args[0] is None)
+        return False
+
 
 def select_disk(install_disk):
     """Find the target disk given the install disk
@@ -63,7 +381,7 @@ def find_target_disk():
     install_uuid = 'UUID="53E0-A0AB"'
 
     try:
-        blkid = subprocess.check_output("blkid").decode("utf-8").splitlines()
+        blkid = run_command(["blkid"])["stdout"].splitlines()
     except:
         raise Exception("Call to blkid failed")
     for line in blkid:
@@ -71,7 +389,7 @@ def find_target_disk():
             return select_disk(line)
 
     try:
-        mount = subprocess.check_output("mount").decode("utf-8").splitlines()
+        mount = run_command(["mount"])["stdout"].splitlines()
     except:
         raise Exception("Call to mount failed")
     for line in mount:
@@ -121,429 +439,3191 @@ def insert_fs_defaults(template):
     return
 
 
-def run_command(cmd, raise_exception=True):
-    """Execute given command in a subprocess
+def command_error(result):
+    """Return a description of why a command failed
+    """
+    command = " ".join(result["command"])
+    if result["timed_out"]:
+        return "{0} timed out after {1}s".format(command, result["timeout"])
+    stderr = result["stderr"].strip().splitlines()
+    return "{0} failed ({1}): {2}".format(command, result["returncode"],
+                                          stderr[-1] if stderr else "")
+
+
+def run_command(cmd, raise_exception=True, timeout=None, output=None):
+    """Execute given argument vector in a subprocess
+
+    The command and every process it started are killed if it runs
+    longer than timeout seconds, which defaults to the COMMAND_TIMEOUTS
+    entry for the program. Standard output
+    is passed in chunks to the output function if one is given, otherwise
+    it is captured. Returns a dictionary with the command, return code,
+    captured output and the seconds it took.
 
     This function will raise an Exception if the command fails.
     """
-    if subprocess.call(cmd.split(" ")) != 0 and raise_exception:
-        raise Exception("{0} failed".format(cmd))
+    if timeout is None:
+        timeout = COMMAND_TIMEOUTS.get(os.path.basename(cmd[0]),
+                                       COMMAND_TIMEOUT)
+    result = {"command": cmd, "returncode": None, "stdout": "",
+              "stderr": "", "timeout": timeout, "timed_out": False}
+    stdout = []
+    with COMMAND_SLOTS, tempfile.TemporaryFile() as errors:
+        start = time.time()
+        try:
+            # A session of its own lets children holding the output pipe
+            # be killed along with the command
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                    stderr=errors, start_new_session=True)
+        except OSError as exep:
+            proc = None
+            result["stderr"] = str(exep)
+        if proc:
+            killed = []
+
+            def kill():
+                """Kill the command's process group"""
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                    killed.append(True)
+                except ProcessLookupError:
+                    pass
+            timer = threading.Timer(timeout, kill)
+            timer.start()
+            try:
+                for chunk in iter(lambda: proc.stdout.read1(1024 * 1024),
+                                  b""):
+                    if output:
+                        output(chunk)
+                    else:
+                        stdout.append(chunk)
+            except BaseException:
+                kill()
+                raise
+            finally:
+                proc.stdout.close()
+                result["returncode"] = proc.wait()
+                timer.cancel()
+                timer.join()
+            # The timer may fire once the command is done, it only timed
+            # out if the kill ended it
+            result["timed_out"] = bool(killed) and \
+                result["returncode"] == -signal.SIGKILL
+            errors.seek(0)
+            result["stderr"] = errors.read().decode("utf-8", "replace")
+        result["seconds"] = time.time() - start
+    result["stdout"] = b"".join(stdout).decode("utf-8", "replace")
+    INSTALL_REPORT["commands"].append({"command": cmd,
+                                       "returncode": result["returncode"],
+                                       "seconds": result["seconds"]})
+    write_metric("command", command=cmd, returncode=result["returncode"],
+                 seconds=result["seconds"], timed_out=result["timed_out"])
+    if result["returncode"] != 0 and raise_exception:
+        raise Exception(command_error(result))
+    return result
+
+
+def run_commands(commands, raise_exception=True, timeout=None):
+    """Execute independent commands in parallel
+
+    No more than MAX_PARALLEL_COMMANDS commands run at once across the
+    whole installer. Returns the results in the order of commands.
+    timeout may be a list giving each command its own limit.
+
+    This function will raise an Exception if any command fails.
+    """
+    if not isinstance(timeout, list):
+        timeout = [timeout] * len(commands)
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(len(commands), 1)) as pool:
+        futures = [pool.submit(run_command, command, False, limit)
+                   for command, limit in zip(commands, timeout)]
+    results = [future.result() for future in futures]
+    failed = [result for result in results if result["returncode"] != 0]
+    if failed and raise_exception:
+        raise Exception(", ".join(command_error(result) for result in failed))
+    return results
+
+
+def resolve_commands(commands, **values):
+    """Return commands with their {name} placeholders replaced by values
+
+    Placeholders whose value is None are left in place.
+    """
+    values = dict(("{%s}" % name, value) for name, value in values.items()
+                  if value is not None)
+    resolved = []
+    for command in commands:
+        for placeholder, value in values.items():
+            command = [arg.replace(placeholder, value) for arg in command]
+        resolved.append(command)
+    return resolved
+
+
+def get_device_name(disk, partition):
+    """Return the device node name for a partition of disk
+
+    Disks whose name ends in a digit (nvme0n1, mmcblk0, nbd0) separate the
+    partition number with a 'p'. Without a partition, as for RAID arrays,
+    the disk itself is the device.
+    """
+    if partition is None:
+        return disk
+    if disk[-1].isdigit():
+        return "{0}p{1}".format(disk, partition)
+    return "{0}{1}".format(disk, partition)
 
 
-def create_partitions(template):
-    """Create partitions according to template configuration
+def partition_geometry(template):
+    """Return the template's partitions with their start and end sectors
+
+    The end of a rest partition is None, parted ends it with the disk.
     """
-    match = {"M": 1, "G": 1024, "T": 1024 * 1024}
-    parted = "parted -sa"
-    alignment = "optimal"
-    units = "unit MiB"
-    disks = set()
+    geometry = []
     cdisk = ""
-    for disk in template["PartitionLayout"]:
-        disks.add(disk["disk"])
-    for disk in disks:
-        command = "{0} {1} /dev/{2} {3} mklabel gpt".\
-                  format(parted, alignment, disk, units)
-        run_command(command)
-        command = "partprobe /dev/{0}".format(disk)
-        run_command(command)
     for part in sorted(template["PartitionLayout"], key=lambda v: v["disk"]
                        + str(v["partition"])):
         if part["disk"] != cdisk:
-            start = 1
-        if part["size"] == "rest":
-            end = -1
-        else:
-            mult = match[part["size"][-1]]
-            end = int(part["size"][:-1]) * mult + start
+            alignment = get_alignment(template, part["disk"])
+            sector = get_disk_geometry(part["disk"])["logical"]
+            start = alignment
+        end = None
+        if part["size"] != "rest":
+            end = start + parse_size(part["size"]) - 1
+        geometry.append({"disk": part["disk"], "partition": part["partition"],
+                         "type": part["type"], "start": start // sector,
+                         "end": None if end is None else end // sector})
+        if end is not None:
+            # The next partition starts on the next aligned boundary
+            start = (end // alignment + 1) * alignment
+        cdisk = part["disk"]
+    return geometry
+
+
+def partition_commands(template, disks=None):
+    """Return the commands needed to create the template's partitions
+
+    Only the partitions of disks are created if it is given.
+    """
+    parted = ["parted", "-sa", "optimal"]
+    units = ["unit", "s"]
+    geometry = [part for part in partition_geometry(template)
+                if disks is None or part["disk"] in disks]
+    commands = []
+    for disk in sorted(set(part["disk"] for part in geometry)):
+        commands.append(parted + ["/dev/{}".format(disk)] + units +
+                        ["mklabel", "gpt"])
+        commands.append(["partprobe", "/dev/{}".format(disk)])
+    for part in geometry:
         if part["type"] == "EFI":
             ptype = "fat32"
         elif part["type"] == "swap":
             ptype = "linux-swap"
         else:
             ptype = "ext2"
-        command = "{0} {1} -- /dev/{2} {3} mkpart primary {4} {5} {6}"\
-            .format(parted, alignment, part["disk"], units, ptype,
-                    start, end)
-        run_command(command)
-        command = "partprobe /dev/{}".format(part["disk"])
-        run_command(command)
-        if part["type"] == "EFI":
-            command = "parted -s /dev/{0} set {1} boot on"\
-                .format(part["disk"], part["partition"])
-            run_command(command)
-        start = end
-        cdisk = part["disk"]
-
-
-def create_filesystems(template):
-    """Create filesystems according to template configuration
+        commands.append(parted + ["--", "/dev/{}".format(part["disk"])] +
+                        units + ["mkpart", "primary", ptype,
+                                 "{}s".format(part["start"]),
+                                 "100%" if part["end"] is None else
+                                 "{}s".format(part["end"])])
+        commands.append(["partprobe", "/dev/{}".format(part["disk"])])
+        if part["type"] in PARTITION_FLAGS:
+            commands.append(["parted", "-s", "/dev/{}".format(part["disk"]),
+                             "set", str(part["partition"]),
+                             PARTITION_FLAGS[part["type"]], "on"])
+    return commands
+
+
+def parse_partition_table(output):
+    """Parse the output of parted -m unit s print
+
+    Example output:
+        BYT;
+        /dev/sda:1953525168s:scsi:512:4096:gpt:ATA Disk:;
+        1:2048s:1050623s:1048576s:fat32:primary:boot, esp;
+
+    Returns the disk label and the start, end and flags of each
+    partition, or None if there is no partition table.
     """
-    fs_util = {"ext2": "mkfs.ext2", "ext3": "mkfs.ext3", "ext4": "mkfs.ext4",
-               "btrfs": "mkfs.btrfs", "vfat": "mkfs.vfat", "swap": "mkswap"}
-    for fst in template["FilesystemTypes"]:
-        if fst.get("options"):
-            command = "{0} {1} /dev/{2}{3}".format(fs_util[fst["type"]],
-                                                   fst["options"], fst["disk"],
-                                                   fst["partition"])
-        else:
-            command = "{0} /dev/{1}{2}".format(fs_util[fst["type"]],
-                                               fst["disk"],
-                                               fst["partition"])
-        run_command(command)
-
+    lines = [line.rstrip(";").split(":") for line in output.splitlines()
+             if line.strip()]
+    if len(lines) < 2 or len(lines[1]) < 6:
+        return None
+    table = {"label": lines[1][5], "partitions": {}}
+    for fields in lines[2:]:
+        table["partitions"][int(fields[0])] = {
+            "start": int(fields[1].rstrip("s")),
+            "end": int(fields[2].rstrip("s")),
+            "flags": [flag.strip() for flag in fields[6].split(",")
+                      if flag.strip()] if len(fields) > 6 else []}
+    return table
+
+
+def read_partition_table(disk):
+    """Return the partition table on disk, None if there is none
+    """
+    result = run_command(["parted", "-sm", "/dev/{}".format(disk), "unit",
+                          "s", "print"], raise_exception=False)
+    if result["returncode"] != 0:
+        return None
+    return parse_partition_table(result["stdout"])
 
-def setup_mounts(template):
-    """Mount source and target folders
 
-    Returns a tuple containing source and target folders.
+def layout_matches(geometry, table):
+    """Return True if table holds exactly the partitions of geometry
 
-    This function will raise an Exception on finding an error.
+    Rest partitions only need to start in the right place.
     """
-    try:
-        source_dir = tempfile.mkdtemp()
-        target_dir = tempfile.mkdtemp()
-    except:
-        raise Exception("Failed to setup mounts for install")
+    if not table or table["label"] != "gpt" or \
+       sorted(table["partitions"]) != sorted(p["partition"] for p in geometry):
+        return False
+    for part in geometry:
+        current = table["partitions"][part["partition"]]
+        if current["start"] != part["start"] or \
+           part["end"] not in [None, current["end"]]:
+            return False
+        flag = PARTITION_FLAGS.get(part["type"])
+        if flag and flag not in current["flags"]:
+            return False
+    return True
+
+
+def get_reused_disks(template):
+    """Return the disks already partitioned as the template asks
+
+    Only templates setting ReuseLayout reuse disks.
+    """
+    if not template.get("ReuseLayout"):
+        return []
+    geometry = partition_geometry(template)
+    return [disk for disk in sorted(set(part["disk"] for part in geometry))
+            if layout_matches([part for part in geometry
+                               if part["disk"] == disk],
+                              read_partition_table(disk))]
 
-    prefix_len = len("file://")
-    source_image_compressed = template["ImageSourceLocation"][prefix_len:]
-    if not os.path.exists(source_image_compressed):
-        raise Exception("Source image ({}) not found"
-                        .format(source_image_compressed))
 
-    try:
-        with open("/tmp/source", "w") as ofile:
-            if subprocess.call("xz -dc {0}"
-                               .format(source_image_compressed)
-                               .split(" "), stdout=ofile) != 0:
-                raise Exception()
-    except:
-        raise Exception("Failed to extract source image")
-    run_command("modprobe nbd max_part=2")
-    run_command("qemu-nbd -c /dev/nbd0 /tmp/source")
-    run_command("partprobe /dev/nbd0")
-    run_command("mount -o ro /dev/nbd0p2 {}".format(source_dir))
-    run_command("mount -o ro /dev/nbd0p1 {}/boot".format(source_dir))
-    for part in sorted(template["PartitionMountPoints"], key=lambda v:
-                       v["mount"]):
-        if part["mount"] != "/":
-            run_command("mkdir {0}{1}".format(target_dir, part["mount"]))
-        run_command("mount /dev/{0}{1} {2}{3}".format(part["disk"],
-                                                      part["partition"],
-                                                      target_dir,
-                                                      part["mount"]))
+def create_partitions(template, commands=None):
+    """Create partitions according to template configuration
 
-    return (source_dir, target_dir)
+    commands, from partition_commands by default, are run except for
+    those of disks that ReuseLayout leaves alone because they are
+    already partitioned as the template asks. Returns the disks that
+    were left alone.
+    """
+    reused = get_reused_disks(template)
+    devices = set("/dev/{}".format(disk) for disk in reused)
+    for command in commands or partition_commands(template):
+        if not devices & set(command):
+            run_command(command)
+    INSTALL_REPORT["reuse"] = {"disks": reused, "filesystems": []}
+    if reused:
+        write_console("Keeping the partitions of {}\n"
+                      .format(", ".join(reused)))
+    return reused
 
 
-def copy_files(source_dir, target_dir, mini_rsync=False):
-    """Sync files, from source to target folders
+def merge_options(options, extra):
+    """Return mkfs options with the flag and value pair of extra added
 
-    Allow just syncing folders with mini_rsync
+    mkfs keeps only the last of a repeated -E or -d, so the value of
+    extra is appended to the one options already has.
     """
-    if mini_rsync:
-        command = ['rsync', '-aAHX', '--exclude', 'lost+found',
-                   '-f', "+ */", '-f', "- *", '{}/'.format(source_dir),
-                   target_dir]
+    if not extra:
+        return options
+    flag, value = extra
+    if flag not in options:
+        return options + extra
+    index = len(options) - 1 - options[::-1].index(flag)
+    merged = list(options)
+    if index + 1 < len(merged):
+        merged[index + 1] += "," + value
     else:
-        command = ['rsync', '-aAHX', '--exclude', 'lost+found', '{}/'
-                   .format(source_dir), target_dir]
-    if subprocess.call(command) != 0:
-        raise Exception("rsync failed with: {}".format(" ".join(command)))
+        merged.append(value)
+    return merged
 
 
-def match_uuids(updated_layout, used_partitions):
-    """Match uuids from blkid to devices in updated_layout
-
-    This function will raise an exception on finding an error.
+def filesystem_commands(template):
+    """Return the commands needed to create the template's filesystems
     """
-    uuids = []
+    fs_util = {"ext2": "mkfs.ext2", "ext3": "mkfs.ext3", "ext4": "mkfs.ext4",
+               "btrfs": "mkfs.btrfs", "vfat": "mkfs.vfat", "swap": "mkswap",
+               "xfs": "mkfs.xfs"}
+    commands = []
+    for fst in template["FilesystemTypes"]:
+        device = get_device_name(fst["disk"], fst.get("partition"))
+        options = shlex.split(fst.get("options", ""))
+        if not [opt for opt in options if re.search(
+                r"\b(stride|stripe[_-]width|su|sw|sunit|swidth)=", opt)]:
+            options = merge_options(options, stripe_options(
+                fst["type"], get_stripe(template, fst)))
+        commands.append([fs_util[fst["type"]]] + options +
+                        ["/dev/{}".format(device)])
+    return commands
+
+
+def get_disk_geometry(disk):
+    """Return the I/O geometry sysfs reports for disk in bytes
+
+    The dictionary holds the logical and physical block sizes and the
+    minimum and optimal I/O sizes, an optimal size of 0 means none is
+    reported.
+    """
+    geometry = {"logical": 512, "physical": 512, "minimum": 512,
+                "optimal": 0}
+    settings = {"logical": "logical_block_size",
+                "physical": "physical_block_size",
+                "minimum": "minimum_io_size", "optimal": "optimal_io_size"}
+    for key, setting in settings.items():
+        try:
+            geometry[key] = int(read_queue_setting(disk, setting))
+        except (OSError, ValueError):
+            pass
+    return geometry
 
-    try:
-        blkids = subprocess.check_output("blkid").decode("utf-8").splitlines()
-    except:
-        raise Exception("Call to blkid failed")
 
-    for line in blkids:
-        uuid = ""
-        # Example line:
-        # /dev/sda1: SEC_TYPE="msdos" UUID="53E0-A0AB" TYPE="vfat" \
-        #    PARTLABEL="EFI System"
-        # PARTUUID="4921334c-d69f-43c0-a85d-cb4976817b93"
-        pline = line.split(" ")
-        dev = pline[0][:-1]
-        if dev.find("/dev/nbd0") == 0:
-            continue
-        disk_part = os.path.basename(dev)
-        if not updated_layout.get(disk_part):
-            continue
-        if disk_part not in used_partitions:
-            continue
-        for i in pline:
-            if i.find('UUID="') == 0:
-                uuid = i.split('"')[1]
-        if uuid == "":
-            raise Exception("Partition uuid not found in {}".format(line))
-        updated_layout[disk_part]["uuid"] = uuid
-        uuids.append(updated_layout[disk_part])
+def get_alignment(template, disk):
+    """Return the boundary in bytes partitions on disk are aligned to
 
-    return uuids
+    Partitions are aligned to 1MiB, the physical block size and, when the
+    disk reports a sane one, its optimal I/O size such as a RAID stripe.
+    PartitionAlignment in the template overrides this.
+    """
+    if template.get("PartitionAlignment"):
+        return parse_size(template["PartitionAlignment"])
+    geometry = get_disk_geometry(disk)
+    alignment = lcm(1024 * 1024, geometry["physical"])
+    optimal = geometry["optimal"]
+    # Some USB bridges report nonsense like 32MiB - 512
+    if optimal and optimal % geometry["physical"] == 0 and \
+       optimal <= 64 * 1024 * 1024:
+        alignment = lcm(alignment, optimal)
+    return alignment
+
+
+def lcm(first, second):
+    """Return the least common multiple of two positive integers
+    """
+    return first * second // math.gcd(first, second)
 
 
-def get_uuids(template):
-    """Relate partition uuids from blkid to partition layout
+def get_stripe(template, fst):
+    """Return the stripe unit in bytes and data disk count for a filesystem
 
-    In order to relate partition uuids from blkid, first update partition
-    layout information to match what blkid returns.
+    The stripe_unit and stripe_width of the FilesystemTypes entry are used
+    if given. Otherwise md arrays use their chunk size and data disks and
+    other disks the minimum and optimal I/O sizes they report, as
+    hardware RAID does. Returns None when the device isn't striped.
     """
-    used_disk_part = []
-    updated_layout = {}
-
+    if fst.get("stripe_unit"):
+        return (parse_size(fst["stripe_unit"]), fst.get("stripe_width", 1))
+    for array in template.get("RaidSetup", []):
+        if array["rdisk"] != fst["disk"]:
+            continue
+        data_disks = {"md-raid0": len(array["rpartitions"]),
+                      "md-raid10": len(array["rpartitions"]) // 2}
+        if not data_disks.get(array["raid"]):
+            return None
+        try:
+            with open("{0}/{1}/md/chunk_size".format(SYSFS_BLOCK,
+                                                     array["rdisk"]),
+                      "r") as chunk:
+                chunk_size = int(chunk.read())
+        except (OSError, ValueError):
+            chunk_size = parse_size(array.get("chunk", RAID_CHUNK))
+        return (chunk_size, data_disks[array["raid"]])
+    geometry = get_disk_geometry(fst["disk"])
+    if geometry["minimum"] > geometry["physical"] and \
+       geometry["optimal"] % geometry["minimum"] == 0 and \
+       geometry["optimal"] // geometry["minimum"] > 1:
+        return (geometry["minimum"],
+                geometry["optimal"] // geometry["minimum"])
+    return None
+
+
+def stripe_options(fstype, stripe):
+    """Return the mkfs options matching a stripe from get_stripe
+    """
+    if not stripe:
+        return []
+    unit, width = stripe
+    if fstype in ["ext2", "ext3", "ext4"]:
+        # stride is counted in filesystem blocks, 4KiB by default
+        stride = max(unit // 4096, 1)
+        return ["-E", "stride={0},stripe_width={1}".format(stride,
+                                                           stride * width)]
+    if fstype == "xfs":
+        return ["-d", "su={0},sw={1}".format(unit, width)]
+    return []
+
+
+def raid_command(array):
+    """Return the command creating a RaidSetup array
+
+    With a resync of skip, mirrors are created with --assume-clean. Every
+    block the filesystem reads has been written through md first, so
+    only never written blocks differ between the mirrors.
+    """
+    command = ["mdadm", "--create", "/dev/{}".format(array["rdisk"]),
+               "--run", "--metadata=1.2",
+               "--level={}".format(RAID_LEVELS[array["raid"]]),
+               "--raid-devices={}".format(len(array["rpartitions"]))]
+    if array["raid"] != "md-raid1":
+        command.append("--chunk={}K".format(
+            parse_size(array.get("chunk", RAID_CHUNK)) // 1024))
+    if array.get("resync") == "skip" and array["raid"] != "md-raid0":
+        command.append("--assume-clean")
+    return command + ["/dev/{}".format(part) for part in array["rpartitions"]]
+
+
+def raid_groups(template):
+    """Group RaidSetup arrays so the arrays in a group share no disk
+
+    Arrays in the same group are created in parallel.
+    """
+    disks = {}
     for part in template["PartitionLayout"]:
-        disk_part = part["disk"] + str(part["partition"])
-        updated_layout[disk_part] = part.copy()
-        if updated_layout[disk_part]["type"] == "swap":
-            updated_layout[disk_part]["mount"] = "none"
+        disks[get_device_name(part["disk"], part["partition"])] = part["disk"]
+    groups = []
+    for array in template.get("RaidSetup", []):
+        array_disks = set(disks.get(part, part)
+                          for part in array["rpartitions"])
+        for group in groups:
+            if not group["disks"] & array_disks:
+                group["arrays"].append(array)
+                group["disks"] |= array_disks
+                break
+        else:
+            groups.append({"arrays": [array], "disks": array_disks})
+    return [group["arrays"] for group in groups]
 
-    for part in template["FilesystemTypes"]:
-        disk_part = part["disk"] + str(part["partition"])
-        updated_layout[disk_part]["type"] = part["type"]
 
-    for part in template["PartitionMountPoints"]:
-        disk_part = part["disk"] + str(part["partition"])
-        used_disk_part.append(disk_part)
-        updated_layout[disk_part]["mount"] = part["mount"]
-        if part.get("options"):
-            updated_layout[disk_part]["options"] = part["options"]
+def create_raid(template, commands=None):
+    """Create the md arrays listed in RaidSetup
 
-    return match_uuids(updated_layout, used_disk_part)
+    commands hold the command creating each array, in RaidSetup order,
+    and default to raid_command. Arrays on different disks are created
+    in parallel. The initial resync of mirrors is skipped or, by
+    default, frozen until cleanup so it doesn't compete with the install
+    for disk bandwidth.
+    """
+    arrays = template.get("RaidSetup", [])
+    commands = dict(zip([array["rdisk"] for array in arrays],
+                        commands or [raid_command(array)
+                                     for array in arrays]))
+    for group in raid_groups(template):
+        run_commands([commands[array["rdisk"]] for array in group])
+    for array in template.get("RaidSetup", []):
+        if array["raid"] == "md-raid0" or \
+           array.get("resync", "defer") != "defer":
+            continue
+        if write_sysfs("{0}/{1}/md/sync_action".format(SYSFS_BLOCK,
+                                                       array["rdisk"]),
+                       "frozen"):
+            DEFERRED_RESYNC.append(array["rdisk"])
 
 
-def update_loader(uuids, target_dir):
-    """Update root UUID in bootloader configuration
+def resume_raid_resync():
+    """Let the resyncs frozen by create_raid continue in the background
+    """
+    while DEFERRED_RESYNC:
+        write_sysfs("{0}/{1}/md/sync_action"
+                    .format(SYSFS_BLOCK, DEFERRED_RESYNC.pop()), "idle")
+
+
+def write_mdadm_conf(template, target_dir):
+    """Record the md arrays in the target's mdadm.conf so they assemble
 
     This function will raise an Exception on finding an error.
     """
-    for part in uuids:
-        if part["mount"] == "/":
-            uuid = part["uuid"]
-            break
+    if not template.get("RaidSetup"):
+        return
+    scan = run_command(["mdadm", "--detail", "--scan"])["stdout"]
     try:
-        with open("{}/boot/loader/entries/default.conf"
-                  .format(target_dir), "r+") as loader:
-            conf = loader.readlines()
-            # 3rd line contains:
-            # options root=UUID=0000-0000 kernel commandline options
-            options = conf[3].split(' ')
-            root_len = len("root=")
-            for i in range(len(options)):
-                if options[i][:root_len] == "root=":
-                    options[i] = "root=UUID={}".format(uuid)
-                    break
-            conf[3] = ' '.join(options)
-            loader.seek(0)
-            loader.truncate()
-            loader.writelines(conf)
+        with open("{}/etc/mdadm.conf".format(target_dir), "w") as conf:
+            conf.write(scan)
     except Exception as exep:
-        raise Exception("Unable to open or invalid bootloader configuration \
-        file: {}".format(exep))
+        raise Exception("Unable to write {0}/etc/mdadm.conf: {1}"
+                        .format(target_dir, exep))
 
 
-def update_fstab(uuids, target_dir):
-    """Add PARTUUID entries to /etc/fstab
-
-    This function will raise an Exception on finding an error.
+def get_filesystem_type(device):
+    """Return the type of the filesystem signature on device, None if none
     """
-    default_options = "rw,relatime 0 0"
-    try:
-        fstab = open("{}/etc/fstab".format(target_dir), "w")
-    except:
-        raise Exception("Failed to open {}/etc/fstab".format(target_dir))
+    result = run_command(["blkid", "-o", "value", "-s", "TYPE",
+                          "/dev/{}".format(device)], raise_exception=False)
+    return result["stdout"].strip() or None
 
-    try:
-        for part in uuids:
-            if part.get("options"):
-                options = part["options"]
-            else:
-                options = default_options
-            line = "UUID={0}	{1}	{2}	{3}\n".\
-                   format(part["uuid"], part["mount"], part["type"], options)
-            fstab.write(line)
-    except:
-        raise Exception("Failed to update {}/etc/fstab".format(target_dir))
-    finally:
-        fstab.close()
 
-    return
+def source_has_files(source_dir, mount):
+    """Return True if the copy writes anything under mount
+    """
+    path = os.path.join(source_dir, mount.lstrip("/"))
+    return os.path.isdir(path) and bool(os.listdir(path))
 
 
-def setup_machine_id(target_dir):
-    """Create a machine-id for the target system
+def create_filesystems(template, reused_disks=None, scratch=None,
+                       source_dir=None, commands=None):
+    """Create filesystems according to template configuration
+
+    commands default to filesystem_commands. Each filesystem is on its
+    own partition so they are created in parallel. Filesystems on
+    reused_disks that already have the type asked for are kept, unless
+    their FilesystemTypes entry sets wipe or the source in source_dir
+    has files under their mount point, which would be copied next to
+    files of the previous install. Without source_dir every mounted
+    filesystem is formatted. The scratch device holding the source image
+    is left for format_scratch.
     """
+    entries = dict(("/dev/{}".format(get_device_name(
+        fst["disk"], fst.get("partition"))), fst)
+                   for fst in template["FilesystemTypes"])
+    run = []
+    kept = []
+    copied = [get_device_name(part["disk"], part.get("partition"))
+              for part in template["PartitionMountPoints"]
+              if not source_dir or source_has_files(source_dir,
+                                                    part["mount"])]
+    for command in commands or filesystem_commands(template):
+        if command[-1] == scratch:
+            continue
+        fst = entries[command[-1]]
+        device = command[-1][len("/dev/"):]
+        if fst["disk"] in (reused_disks or []) and not fst.get("wipe") and \
+           device not in copied and \
+           get_filesystem_type(device) == fst["type"]:
+            kept.append(device)
+        else:
+            run.append(command)
+    run_commands(run)
+    if kept:
+        INSTALL_REPORT.setdefault("reuse", {})["filesystems"] = kept
+        write_console("Keeping the filesystems on {}\n"
+                      .format(", ".join(kept)))
 
-    command = "systemd-machine-id-setup --root={}".format(target_dir)
-    run_command(command)
 
+def format_scratch(template, scratch, commands=None):
+    """Create the filesystem of the swap partition that held the image
 
-class ChrootOpen(object):
-    """Class encapsulating chroot setup and teardown
+    Runs once the source is unmounted, swap partitions aren't mounted so
+    their new UUID doesn't need to reach fstab. commands default to the
+    filesystem_commands of scratch.
     """
-    def __init__(self, target_dir):
-        """Stores the target directory for the chroot
-        """
-        self.target_dir = target_dir
-        self.old_root = -1
+    for command in commands or [command for command
+                                in filesystem_commands(template)
+                                if command[-1] == scratch]:
+        run_command(command)
 
-    def __enter__(self):
-        """Using the target directory, setup the chroot
 
-        This function will raise an Exception on finding an error.
-        """
-        try:
-            self.old_root = os.open("/", os.O_RDONLY)
-            os.chroot(self.target_dir)
-        except:
-            raise Exception("Unable to setup chroot to create users")
+def get_uncompressed_size(image):
+    """Return the uncompressed size of an xz image or 0 if unknown
+    """
+    listing = run_command(["xz", "--robot", "--list", image],
+                          raise_exception=False)
+    if listing["returncode"] != 0:
+        return 0
+    for line in listing["stdout"].splitlines():
+        fields = line.split("\t")
+        if fields[0] == "totals" and len(fields) > 4:
+            return int(fields[4])
+    return 0
 
-        return self.target_dir
 
-    def __exit__(self, *args):
-        """Using the old root, teardown the chroot
+def decompress_image(image, dest):
+    """Decompress an xz image to dest reporting progress as it goes
 
-        This function will raise an Exception on finding an error.
-        """
-        try:
-            os.chdir(self.old_root)
-            os.chroot(".")
-            os.close(self.old_root)
-        except:
-            raise Exception("Unable to restore real root after chroot")
+    This function will raise an Exception on finding an error.
+    """
+    with ProgressStage("decompress", get_uncompressed_size(image)) as stage:
+        with open(dest, "wb") as ofile:
+            def write_chunk(chunk):
+                """Write decompressed data to dest and record progress"""
+                ofile.write(chunk)
+                stage.update(done_bytes=stage.done_bytes + len(chunk))
+            run_command(["xz", "-dc", image], output=write_chunk)
 
-        return True
 
+def setup_mounts(template):
+    """Mount source and target folders
 
-def create_account(user, target_dir):
-    """Add user to the system
+    Returns a tuple containing source and target folders.
 
-    Create a new account on the system with a home directory and one time
-    passwordless login. Also add a new group with same name as the user
+    This function will raise an Exception on finding an error.
     """
+    return (setup_source(template), setup_target(template))
 
-    if user.get("uid"):
-        command = "useradd -U -m -p '' -u {0} {1}"\
-            .format(user["uid"], user["username"])
-    else:
-        command = "useradd -U -m -p '' {}".format(user["username"])
 
-    with ChrootOpen(target_dir) as _:
-        run_command(command)
+def get_run_dir():
+    """Return the scratch folder of this run, creating it on first use
+    """
+    if not RUN_RESOURCES["dir"]:
+        RUN_RESOURCES["dir"] = tempfile.mkdtemp(prefix="ister-")
+    return RUN_RESOURCES["dir"]
 
 
-def add_user_key(user, target_dir):
-    """Append public key to user's ssh authorized_keys file
+def reserve_nbd_device():
+    """Return a free nbd device and the lock file reserving it
 
-    This function will raise an Exception on finding an error.
+    The device stays reserved until the lock file is closed, or the
+    process holding it exits. Connected devices are skipped.
+
+    This function will raise an Exception if every device is in use.
     """
-    key = request.urlopen(user["key"]).read().decode("utf-8")
-    # Must run pwd.getpwnam outside of chroot to load installer shared
-    # lib instead of target which prevents umount on cleanup
-    pwd.getpwnam("root")
-    with ChrootOpen(target_dir) as _:
+    os.makedirs(NBD_LOCK_DIR, exist_ok=True)
+    for index in range(NBD_DEVICES):
+        lock = open(os.path.join(NBD_LOCK_DIR, "nbd{}.lock".format(index)),
+                    "w")
         try:
-            os.makedirs("/home/{0}/.ssh".format(user["username"]), mode=700)
-            pwinfo = pwd.getpwnam(user["username"])
-            uid = pwinfo[2]
-            gid = pwinfo[3]
-            os.chown("/home/{0}/.ssh".format(user["username"]), uid, gid)
-            akey = open("/home/{0}/.ssh/authorized_keys"
-                        .format(user["username"]), "a")
-            akey.write(key)
-            akey.close()
-            os.chown("/home/{0}/.ssh/authorized_keys"
-                     .format(user["username"]), uid, gid)
-        except Exception as exep:
-            raise Exception("Unable to add {0}'s ssh key to authorized \
-            keys: {1}".format(user["username"], exep))
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            continue
+        if os.path.exists("/sys/block/nbd{}/pid".format(index)):
+            lock.close()
+            continue
+        return "/dev/nbd{}".format(index), lock
+    raise Exception("No free nbd device")
+
+
+def get_nbd_device():
+    """Return the nbd device of this run, reserving one on first use
+
+    This function will raise an Exception if every device is in use.
+    """
+    if not RUN_RESOURCES["device"]:
+        device, lock = reserve_nbd_device()
+        RUN_RESOURCES.update(device=device, lock=lock)
+    return RUN_RESOURCES["device"]
+
+
+def release_run(raise_exception=True):
+    """Disconnect the nbd device and remove the scratch folder of this run
+
+    Only what this run allocated is released.
+    """
+    device = RUN_RESOURCES["device"]
+    if device and os.path.exists("/sys/block/{}/pid".format(
+            os.path.basename(device))):
+        run_command(["qemu-nbd", "-d", device],
+                    raise_exception=raise_exception)
+    if RUN_RESOURCES["lock"]:
+        RUN_RESOURCES["lock"].close()
+    if RUN_RESOURCES["dir"]:
+        shutil.rmtree(RUN_RESOURCES["dir"], ignore_errors=True)
+    RUN_RESOURCES.update(dir=None, device=None, lock=None)
+
+
+def is_xz_image(image):
+    """Return True if image starts with the xz magic number
+    """
+    with open(image, "rb") as header:
+        return header.read(6) == b"\xfd7zXZ\x00"
 
 
-def setup_sudo(user, target_dir):
-    """Append user to sudoers file
+def setup_source(template, decompressed=None, device=None, memory=None):
+    """Mount the source image read only
+
+    The source is mounted before any disk is touched so the preflight
+    check can measure it. Disk images are decompressed to decompressed,
+    unless they were decompressed during the download, and attached to
+    the nbd device. Lazy sources keep their socket and cache next to
+    decompressed. Both default to the run's own. When the memory path
+    of the plan is a scratch device, the decompressed image or the lazy
+    source cache are kept there instead. A lazy source none of whose
+    mirrors serves ranges is downloaded instead, to where the memory
+    path puts downloads. The commands come from source_commands, as in
+    the install plan, but whether the image is compressed is read from
+    the image itself. Returns the source folder.
 
     This function will raise an Exception on finding an error.
     """
-    sudoer_template = "{} ALL=(ALL) ALL".format(user["username"])
     try:
-        conf = open("{0}/etc/sudoers.d/{1}"
-                    .format(target_dir, user["username"]), "w")
-        conf.write(sudoer_template)
-        conf.close()
+        source_dir = tempfile.mkdtemp()
+    except:
+        raise Exception("Failed to setup mounts for install")
+
+    decompressed = decompressed or os.path.join(get_run_dir(), "source")
+    scratch = (memory or {}).get("scratch")
+    if is_lazy_source(template):
+        device = device or get_nbd_device()
+        try:
+            start_lazy_source(template, decompressed + ".sock",
+                              scratch or decompressed + ".cache")
+        except Exception as exep:
+            # No mirror serves ranges after all, so fetch the whole image
+            write_metric("lazy-fallback", reason=str(exep))
+            get_source_image(template, memory)
+        else:
+            for command in lazy_mount_commands(decompressed + ".sock",
+                                               source_dir,
+                                               get_image_format(template),
+                                               device):
+                run_command(command)
+            return source_dir
+
+    prefix_len = len("file://")
+    source_image_compressed = template["ImageSourceLocation"][prefix_len:]
+    if not os.path.exists(source_image_compressed):
+        raise Exception("Source image ({}) not found"
+                        .format(source_image_compressed))
+
+    compressed = False
+    if get_image_format(template) == "disk":
+        device = device or get_nbd_device()
+        compressed = is_xz_image(source_image_compressed)
+    decompressed = scratch or decompressed
+    if compressed:
+        try:
+            decompress_image(source_image_compressed, decompressed)
+        except:
+            raise Exception("Failed to extract source image")
+    for command in source_commands(template, source_image_compressed,
+                                   compressed, decompressed, source_dir,
+                                   device):
+        run_command(command)
+
+    return source_dir
+
+
+def setup_target(template, commands=None):
+    """Mount the target partitions
+
+    commands default to target_mount_commands, their {target} is the new
+    target folder. Returns the target folder.
+
+    This function will raise an Exception on finding an error.
+    """
+    try:
+        target_dir = tempfile.mkdtemp()
+    except:
+        raise Exception("Failed to setup mounts for install")
+
+    for command in resolve_commands(
+            commands or target_mount_commands(template, "{target}"),
+            target=target_dir):
+        run_command(command)
+
+    return target_dir
+
+
+def get_image_format(template):
+    """Return the format of the source image: disk, squashfs or erofs
+
+    A disk image is an xz compressed, partitioned disk. squashfs and
+    erofs images hold the root filesystem, /boot included, and are
+    mounted as they are. The format is taken from ImageSourceFormat,
+    then from the image's magic number if it is already local, and
+    finally from the file extension.
+    """
+    if template.get("ImageSourceFormat"):
+        return template["ImageSourceFormat"]
+    location = template["ImageSourceLocation"]
+    if location.find("file://") == 0:
+        try:
+            with open(location[len("file://"):], "rb") as image:
+                header = image.read(1028)
+            if header[:4] == b"hsqs":
+                return "squashfs"
+            if header[1024:1028] == b"\xe2\xe1\xf5\xe0":
+                return "erofs"
+            return "disk"
+        except OSError:
+            pass
+    if re.search(r"\.(squashfs|sqfs)$", location):
+        return "squashfs"
+    if re.search(r"\.erofs$", location):
+        return "erofs"
+    return "disk"
+
+
+def image_mount_commands(source_image, source_dir, image_format):
+    """Return the commands needed to mount a filesystem image in place
+
+    The kernel decompresses blocks on demand as the copy reads them, so
+    there is no separate decompression stage.
+    """
+    return [["mount", "-t", image_format, "-o", "ro,loop", source_image,
+             source_dir]]
+
+
+def source_commands(template, image, compressed, decompressed, source_dir,
+                    device):
+    """Return the commands mounting image, the local source image
+
+    A compressed disk image is attached once it is decompressed to
+    decompressed.
+    """
+    image_format = get_image_format(template)
+    if image_format != "disk":
+        return image_mount_commands(image, source_dir, image_format)
+    return source_mount_commands(decompressed if compressed else image,
+                                 source_dir, device)
+
+
+def source_mount_commands(source_image, source_dir, device):
+    """Return the commands needed to mount the decompressed source image
+    """
+    return [["modprobe", "nbd", "max_part=2"],
+            ["qemu-nbd", "-c", device, source_image],
+            ["partprobe", device],
+            ["mount", "-o", "ro", "{}p2".format(device), source_dir],
+            ["mount", "-o", "ro", "{}p1".format(device),
+             "{}/boot".format(source_dir)]]
+
+
+def get_mount_options(template, part, production=False):
+    """Return the options to mount a PartitionMountPoints entry with
+
+    During the install filesystems are mounted with the relaxed
+    INSTALL_MOUNT_OPTIONS for their type, as a crash mid-install means a
+    reinstall anyway. The production options are the ones update_fstab
+    writes for the partition.
+    """
+    if production:
+        # fstab options may be followed by the dump and pass fields
+        return (part.get("options") or DEFAULT_MOUNT_OPTIONS).split()[0]
+    overrides = template.get("InstallMountOptions", {})
+    if overrides is False:
+        return DEFAULT_MOUNT_OPTIONS
+    device = get_device_name(part["disk"], part.get("partition"))
+    for fst in template["FilesystemTypes"]:
+        if get_device_name(fst["disk"], fst.get("partition")) == device:
+            return overrides.get(fst["type"],
+                                 INSTALL_MOUNT_OPTIONS.get(fst["type"],
+                                                           "noatime"))
+    return DEFAULT_MOUNT_OPTIONS
+
+
+def get_overlay_layers(target_dir):
+    """Return the folders the overlay root's lower and upper layers are
+    mounted on while target_dir is installed
+    """
+    return target_dir + ".lower", target_dir + ".upper"
+
+
+def overlay_mount_commands(template, target_dir, root, production=False):
+    """Return the commands mounting the overlay root at target_dir
+
+    The OverlayLower partition holding the image is the read only lower
+    layer. The upper layer and its work folder are the overlay and
+    overlay-workdir folders of the root filesystem, where overlayroot
+    looks for them at boot.
+    """
+    lower, upper = get_overlay_layers(target_dir)
+    return [["mkdir", "-p", lower, upper],
+            ["mount", "-o", "ro", "/dev/{}".format(get_device_name(
+                template["OverlayLower"]["disk"],
+                template["OverlayLower"]["partition"])), lower],
+            ["mount", "-o", get_mount_options(template, root, production),
+             "/dev/{}".format(get_device_name(root["disk"],
+                                              root.get("partition"))),
+             upper],
+            ["mkdir", "-p", "{}/overlay".format(upper),
+             "{}/overlay-workdir".format(upper)],
+            ["mount", "-t", "overlay", "-o",
+             "lowerdir={0},upperdir={1}/overlay,workdir={1}/overlay-workdir"
+             .format(lower, upper), "overlay", target_dir]]
+
+
+def umount_overlay_layers(target_dir, raise_exception=True):
+    """Unmount the overlay root's layers once target_dir is unmounted
+    """
+    for layer in reversed(get_overlay_layers(target_dir)):
+        if os.path.ismount(layer):
+            run_command(["umount", layer], raise_exception=raise_exception)
+
+
+def target_mount_commands(template, target_dir, production=False):
+    """Return the commands needed to mount the target partitions
+    """
+    commands = []
+    for part in sorted(template["PartitionMountPoints"], key=lambda v:
+                       v["mount"]):
+        if part["mount"] == "/" and template.get("OverlayLower"):
+            commands.extend(overlay_mount_commands(template, target_dir,
+                                                   part, production))
+            continue
+        if part["mount"] != "/" and not production:
+            commands.append(["mkdir", "{0}{1}".format(target_dir,
+                                                      part["mount"])])
+        commands.append(["mount", "-o",
+                         get_mount_options(template, part, production),
+                         "/dev/{}".format(get_device_name(
+                             part["disk"], part.get("partition"))),
+                         "{0}{1}".format(target_dir, part["mount"])])
+    return commands
+
+
+def get_target_mounts(target_dir):
+    """Return the mount points of the target, overlay layers included
+    """
+    roots = (target_dir,) + get_overlay_layers(target_dir)
+    mounts = []
+    with open("/proc/self/mounts", "r") as mtab:
+        for line in mtab:
+            path = line.split(" ")[1]
+            if [root for root in roots
+                    if path == root or path.startswith(root + "/")]:
+                mounts.append(path)
+    return mounts
+
+
+def syncfs(path):
+    """Flush the filesystem holding path to its device
+
+    This function will raise an Exception on finding an error.
+    """
+    fileno = os.open(path, os.O_RDONLY)
+    try:
+        if LIBC.syncfs(fileno) != 0:
+            raise OSError(ctypes.get_errno(), "syncfs failed")
+    finally:
+        os.close(fileno)
+
+
+def flush_target(target_dir):
+    """Flush every filesystem of the target at once
+
+    Each filesystem waits on its own devices only, so one slow disk
+    doesn't hold back the writeback of the others.
+
+    This function will raise an Exception on finding an error.
+    """
+    mounts = get_target_mounts(target_dir)
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(len(mounts), 1)) as pool:
+        list(pool.map(syncfs, mounts))
+
+
+def start_writeback(target_dir):
+    """Start flushing the copied files while the install goes on
+
+    Returns the thread flushing the target. Errors are left to the
+    final flush, which covers everything written again.
+    """
+    def flush():
+        """Flush the target, ignoring errors"""
+        try:
+            flush_target(target_dir)
+        except OSError:
+            pass
+    writeback = threading.Thread(target=flush, daemon=True)
+    writeback.start()
+    return writeback
+
+
+def remount_production(template, target_dir, writeback=None,
+                       commands=None):
+    """Flush the target and mount it again with its production options
+
+    The flush started by start_writeback after the copy is waited for,
+    then all filesystems are flushed at once for the configuration
+    written since, at which point the install is durable. Options such
+    as the ext4 data mode can't be changed by a remount, so the target
+    is unmounted and mounted again with the options update_fstab wrote,
+    which also checks they work. commands are the unmount followed by
+    the production target_mount_commands.
+    """
+    commands = commands or [["umount", "-R", target_dir]] + \
+        target_mount_commands(template, target_dir, True)
+    if writeback:
+        writeback.join()
+    flush_target(target_dir)
+    INSTALL_REPORT["durable"] = time.time() - INSTALL_REPORT.get(
+        "start", time.time())
+    write_metric("durable", seconds=INSTALL_REPORT["durable"])
+    run_command(commands[0])
+    # Overlay layers are mounted outside the target folder
+    umount_overlay_layers(target_dir)
+    for command in commands[1:]:
+        run_command(command)
+
+
+def get_mount_device(path):
+    """Return the block device name mounted at path, None if not mounted
+    """
+    return get_mount_entry(path)[0]
+
+
+def get_mount_entry(path):
+    """Return the block device name and filesystem type mounted at path
+
+    Returns (None, None) if no block device is mounted at path.
+    """
+    with open("/proc/self/mounts", "r") as mounts:
+        for line in mounts:
+            fields = line.split(" ")
+            if fields[1] == path and fields[0].find("/dev/") == 0:
+                return (os.path.basename(fields[0]), fields[2])
+    return (None, None)
+
+
+def get_parent_disk(device):
+    """Return the disk holding device, which is device itself for a disk
+    """
+    if os.path.exists("{0}/{1}".format(SYSFS_BLOCK, device)):
+        return device
+    sysfs = os.path.realpath("/sys/class/block/{}".format(device))
+    return os.path.basename(os.path.dirname(sysfs))
+
+
+def get_device_class(disk):
+    """Classify disk as nvme, ssd, rotational or virtual for IO_PROFILES
+    """
+    if re.match(r"(nbd|loop|ram|zram)\d", disk):
+        return "virtual"
+    if disk.find("nvme") == 0:
+        return "nvme"
+    try:
+        with open("{0}/{1}/queue/rotational".format(SYSFS_BLOCK, disk),
+                  "r") as rotational:
+            if rotational.read().strip() == "1":
+                return "rotational"
+    except OSError:
+        pass
+    return "ssd"
+
+
+def read_queue_setting(disk, setting):
+    """Return the current value of a block queue setting
+    """
+    with open("{0}/{1}/queue/{2}".format(SYSFS_BLOCK, disk, setting),
+              "r") as queue:
+        value = queue.read().strip()
+    # The scheduler file lists all schedulers with the active one in []
+    active = re.search(r"\[(.*)\]", value)
+    return active.group(1) if active else value
+
+
+def write_sysfs(path, value):
+    """Write value to a sysfs file, returning False if the kernel refuses it
+    """
+    try:
+        with open(path, "w") as sysfs:
+            sysfs.write(value)
+    except OSError:
+        return False
+    return True
+
+
+def write_queue_setting(disk, setting, value):
+    """Set a block queue setting, returning False if the kernel refuses it
+    """
+    return write_sysfs("{0}/{1}/queue/{2}".format(SYSFS_BLOCK, disk,
+                                                  setting), value)
+
+
+def tune_devices(template, source_dir):
+    """Apply the I/O profile for their class to the source and target disks
+
+    The original settings are saved in IO_TUNING so cleanup can restore
+    them, and what was applied is added to the install report. Settings
+    the kernel refuses are skipped.
+    """
+    overrides = template.get("IoTuning", {})
+    if overrides is False:
+        return
+    disks = set(part["disk"] for part in template["PartitionLayout"])
+    source = get_mount_device(source_dir)
+    if source:
+        disks.add(get_parent_disk(source))
+    report = INSTALL_REPORT.setdefault("io_tuning", {})
+    for disk in sorted(disks):
+        if disk in IO_TUNING:
+            continue
+        device_class = get_device_class(disk)
+        profile = dict(IO_PROFILES[device_class])
+        profile.update(overrides.get(device_class, {}))
+        original = {}
+        applied = {}
+        for setting in IO_SETTINGS:
+            if setting not in profile:
+                continue
+            try:
+                current = read_queue_setting(disk, setting)
+            except OSError:
+                continue
+            if write_queue_setting(disk, setting, str(profile[setting])):
+                original[setting] = current
+                applied[setting] = str(profile[setting])
+        IO_TUNING[disk] = original
+        report[disk] = {"class": device_class, "applied": applied}
+        write_metric("io-tuning", disk=disk, device_class=device_class,
+                     applied=applied)
+
+
+def restore_io_tuning():
+    """Put back the queue settings changed by tune_devices
+    """
+    for disk in list(IO_TUNING):
+        for setting in IO_SETTINGS:
+            if setting in IO_TUNING[disk]:
+                write_queue_setting(disk, setting, IO_TUNING[disk][setting])
+        del IO_TUNING[disk]
+
+
+def copy_command(source_dir, target_dir, mini_rsync=False):
+    """Return the rsync command syncing source to target folders
+    """
+    if mini_rsync:
+        return ['rsync', '-aAHX', '--exclude', 'lost+found',
+                '--info=progress2', '--no-inc-recursive',
+                '-f', "+ */", '-f', "- *", '{}/'.format(source_dir),
+                target_dir]
+    return ['rsync', '-aAHX', '--exclude', 'lost+found',
+            '--info=progress2', '--no-inc-recursive', '{}/'
+            .format(source_dir), target_dir]
+
+
+def copy_files(source_dir, target_dir, mini_rsync=False, stage_name="copy"):
+    """Sync files, from source to target folders
+
+    Allow just syncing folders with mini_rsync. Progress is reported as
+    the stage_name stage.
+    """
+    command = copy_command(source_dir, target_dir, mini_rsync)
+    with ProgressStage(stage_name) as stage:
+        try:
+            run_command(command, output=rsync_progress_reader(
+                lambda progress: stage.update(**progress)))
+        except Exception as exep:
+            raise Exception("rsync failed with: {}".format(exep))
+
+
+def rsync_progress_reader(update):
+    """Return an output function passing rsync progress fields to update
+    """
+    pending = [b""]
+
+    def read_progress(chunk):
+        """Pass complete progress lines from rsync to update"""
+        # progress2 output rewrites a single line using carriage returns
+        lines = re.split(b"[\r\n]", pending[0] + chunk)
+        pending[0] = lines.pop()
+        for line in lines:
+            progress = parse_rsync_progress(line.decode("utf-8", "replace"))
+            if progress:
+                update(progress)
+    return read_progress
+
+
+def scan_source(source_dir):
+    """Return the file count, bytes and hard linked files of the source
+
+    The bytes below each entry of the first two levels of the source
+    are returned in sizes, keyed by path relative to source_dir.
+    """
+    stats = {"files": 0, "bytes": 0, "hardlinks": 0, "sizes": {}}
+
+    def walk(path, depth):
+        """Return the bytes below path, counting files into stats"""
+        total = 0
+        for entry in os.scandir(path):
+            if depth == 0 and entry.name == "lost+found":
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                size = walk(entry.path, depth + 1)
+            else:
+                stat = entry.stat(follow_symlinks=False)
+                size = stat.st_size
+                stats["files"] += 1
+                if stat.st_nlink > 1:
+                    stats["hardlinks"] += 1
+            if depth < 2:
+                stats["sizes"][entry.path[len(source_dir) + 1:]] = size
+            total += size
+        return total
+    stats["bytes"] = walk(source_dir, 0)
+    return stats
+
+
+def split_copy(stats, workers):
+    """Return source paths split into at most workers lists of similar size
+
+    Top level folders holding more than their share of the source are
+    split into their own entries so a large /usr is shared out too.
+    """
+    limit = stats["bytes"] / (workers * 2)
+    parents = set(os.path.dirname(name) for name in stats["sizes"])
+    entries = []
+    for name, size in stats["sizes"].items():
+        parent = os.path.dirname(name)
+        if parent and stats["sizes"][parent] > limit:
+            entries.append((size, name))
+        elif not parent and (size <= limit or name not in parents):
+            entries.append((size, name))
+    buckets = [[0, []] for _ in range(workers)]
+    for size, name in sorted(entries, reverse=True):
+        bucket = min(buckets, key=lambda v: v[0])
+        bucket[0] += size
+        bucket[1].append(name)
+    return [sorted(names) for _, names in buckets if names]
+
+
+def parallel_copy_command(source_dir, target_dir, names):
+    """Return the rsync command copying names from source to target folders
+    """
+    return ['rsync', '-aAX', '--relative', '--info=progress2',
+            '--no-inc-recursive'] + \
+        ['{0}/./{1}'.format(source_dir, name) for name in names] + \
+        [target_dir]
+
+
+def copy_parallel(source_dir, target_dir, stats):
+    """Copy the source with several rsyncs running at once
+
+    Hard links between the parts would be lost, so this is only used
+    for images without them. A last folder only rsync fixes up the
+    metadata of the folders the parts were created in.
+
+    This function will raise an Exception on finding an error.
+    """
+    parts = split_copy(stats, MAX_PARALLEL_COMMANDS)
+    done = [[0, 0] for _ in parts]
+    with ProgressStage("copy", stats["bytes"], stats["files"]) as stage:
+        def part_reader(index):
+            """Return the output function for the rsync of one part"""
+            def update(progress):
+                """Report the progress of all the parts together"""
+                done[index] = [progress["done_bytes"],
+                               progress.get("done_files", 0)]
+                stage.update(done_bytes=sum(v[0] for v in done),
+                             done_files=sum(v[1] for v in done))
+            return rsync_progress_reader(update)
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(parts)) as pool:
+            futures = [pool.submit(run_command, parallel_copy_command(
+                source_dir, target_dir, names), False, None, part_reader(i))
+                       for i, names in enumerate(parts)]
+        failed = [future.result() for future in futures
+                  if future.result()["returncode"] != 0]
+        if failed:
+            raise Exception("rsync failed with: {}".format(
+                ", ".join(command_error(result) for result in failed)))
+    copy_files(source_dir, target_dir, mini_rsync=True,
+               stage_name="copy-folders")
+
+
+def get_physical_offset(path):
+    """Return the physical offset of the first extent of path
+
+    Returns None for files without extents or on filesystems without
+    FIEMAP support, such as squashfs.
+    """
+    # struct fiemap asking for a single struct fiemap_extent
+    fiemap = bytearray(struct.pack("=QQIIII", 0, 2 ** 64 - 1, 0, 0, 1, 0) +
+                       bytes(56))
+    try:
+        with open(path, "rb") as ifile:
+            fcntl.ioctl(ifile, FS_IOC_FIEMAP, fiemap)
+    except OSError:
+        return None
+    if not struct.unpack_from("=I", fiemap, 20)[0]:
+        return None
+    return struct.unpack_from("=Q", fiemap, 40)[0]
+
+
+def seek_distance(extents):
+    """Return the bytes skipped over reading (offset, size) extents in order
+    """
+    total = 0
+    position = None
+    for offset, size in extents:
+        if position is not None:
+            total += abs(offset - position)
+        position = offset + size
+    return total
+
+
+def schedule_copy(source_dir):
+    """Return the source files in the order the ordered copy reads them
+
+    Files are ordered by the physical offset of their first extent on
+    the source device, in inode order where FIEMAP isn't supported.
+    Empty, sparse and hard linked files are left to the rsync pass.
+    Returns the list of (path, stat) pairs and the bytes skipped seeking
+    between files in directory walk order and in the scheduled order.
+    """
+    files = []
+
+    def walk(path, depth):
+        """Add the regular files below path to files"""
+        for entry in os.scandir(path):
+            if depth == 0 and entry.name == "lost+found":
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                walk(entry.path, depth + 1)
+            elif entry.is_file(follow_symlinks=False):
+                stat = entry.stat(follow_symlinks=False)
+                if stat.st_size and stat.st_nlink == 1 and \
+                   stat.st_blocks * 512 >= stat.st_size:
+                    files.append((entry.path, stat,
+                                  get_physical_offset(entry.path)))
+    walk(source_dir, 0)
+    walk_seek = seek_distance([(offset, stat.st_size)
+                               for _, stat, offset in files
+                               if offset is not None])
+    files.sort(key=lambda v: (v[2] is None, v[2] or v[1].st_ino))
+    ordered_seek = seek_distance([(offset, stat.st_size)
+                                  for _, stat, offset in files
+                                  if offset is not None])
+    return [(path, stat) for path, stat, _ in files], walk_seek, ordered_seek
+
+
+def hint_read(path):
+    """Ask the kernel to start reading path into the page cache
+    """
+    try:
+        ifile = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(ifile, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(ifile)
+
+
+def copy_file_data(source, dest, stat):
+    """Copy the data of source to dest and give dest the source's mtime
+
+    Matching size and mtime let the rsync pass skip the file's data.
+    """
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    shutil.copyfile(source, dest)
+    os.utime(dest, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+
+def sync_file_range(fileno, offset, length, flags):
+    """Start or wait for the writeback of a range of an open file
+
+    This function will raise an Exception on finding an error.
+    """
+    if LIBC.sync_file_range(fileno, ctypes.c_int64(offset),
+                            ctypes.c_int64(length),
+                            ctypes.c_uint(flags)) != 0:
+        raise OSError(ctypes.get_errno(), "sync_file_range failed")
+
+
+def copy_file_uncached(source, dest, stat):
+    """Copy source to dest like copy_file_data, leaving neither cached
+
+    Each chunk written is queued for writeback at once and the source
+    pages it came from are dropped. The previous chunk is then waited
+    for and dropped, so flushes run one chunk behind the writes.
+    """
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    with open(source, "rb") as ifile, open(dest, "wb") as ofile:
+        offset = 0
+        previous = None
+        for data in iter(lambda: ifile.read(COPY_CHUNK), b""):
+            ofile.write(data)
+            ofile.flush()
+            os.posix_fadvise(ifile.fileno(), offset, len(data),
+                             os.POSIX_FADV_DONTNEED)
+            sync_file_range(ofile.fileno(), offset, len(data),
+                            SYNC_FILE_RANGE_WRITE)
+            if previous:
+                sync_file_range(ofile.fileno(), previous[0], previous[1],
+                                SYNC_FILE_RANGE_WAIT_BEFORE |
+                                SYNC_FILE_RANGE_WRITE |
+                                SYNC_FILE_RANGE_WAIT_AFTER)
+                os.posix_fadvise(ofile.fileno(), previous[0], previous[1],
+                                 os.POSIX_FADV_DONTNEED)
+            previous = (offset, len(data))
+            offset += len(data)
+        if previous:
+            sync_file_range(ofile.fileno(), previous[0], previous[1],
+                            SYNC_FILE_RANGE_WAIT_BEFORE |
+                            SYNC_FILE_RANGE_WRITE |
+                            SYNC_FILE_RANGE_WAIT_AFTER)
+            os.posix_fadvise(ofile.fileno(), previous[0], previous[1],
+                             os.POSIX_FADV_DONTNEED)
+    os.utime(dest, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+
+def copy_ordered(source_dir, target_dir, drop_cache=False):
+    """Copy file data in the physical order of the source, then rsync
+
+    Copy workers take files in the order schedule_copy returns while
+    read-ahead is requested for up to COPY_READ_AHEAD bytes of the files
+    after them, so a slow source is read mostly sequentially. With
+    drop_cache the data copied leaves no pages behind in the page cache.
+    An rsync pass then copies what was left out and sets ownership,
+    permissions, ACLs, xattrs and hard links.
+
+    This function will raise an Exception on finding an error.
+    """
+    copy_data = copy_file_uncached if drop_cache else copy_file_data
+    files, walk_seek, ordered_seek = schedule_copy(source_dir)
+    INSTALL_REPORT["ordered_copy"] = {"files": len(files),
+                                      "bytes": sum(stat.st_size for _, stat
+                                                   in files),
+                                      "walk_seek": walk_seek,
+                                      "ordered_seek": ordered_seek}
+    write_metric("ordered-copy", **INSTALL_REPORT["ordered_copy"])
+    slots = threading.BoundedSemaphore(MAX_PARALLEL_COMMANDS * 2)
+    done = [0, 0]
+    lock = threading.Lock()
+
+    def copy(path, stat):
+        """Copy one file and record it as done"""
+        try:
+            copy_data(path, target_dir + path[len(source_dir):], stat)
+        finally:
+            slots.release()
+        with lock:
+            done[0] += stat.st_size
+            done[1] += 1
+
+    with ProgressStage("copy", INSTALL_REPORT["ordered_copy"]["bytes"],
+                       len(files)) as stage, \
+            concurrent.futures.ThreadPoolExecutor(
+                max_workers=MAX_PARALLEL_COMMANDS) as pool:
+        futures = []
+        hinted = 0
+        hinted_bytes = 0
+        queued_bytes = 0
+        for path, stat in files:
+            while hinted < len(files) and \
+                    hinted_bytes - queued_bytes < COPY_READ_AHEAD:
+                hint_read(files[hinted][0])
+                hinted_bytes += files[hinted][1].st_size
+                hinted += 1
+            slots.acquire()
+            futures.append(pool.submit(copy, path, stat))
+            queued_bytes += stat.st_size
+            stage.update(done_bytes=done[0], done_files=done[1])
+        for future in futures:
+            future.result()
+        stage.update(done_bytes=done[0], done_files=done[1])
+    copy_files(source_dir, target_dir, stage_name="copy-rest")
+
+
+def get_backing_disk(path):
+    """Return the disk holding path, None if it isn't on a disk
+
+    Paths below /dev are block devices and their own backing.
+    """
+    try:
+        info = os.stat(path)
+    except OSError:
+        return None
+    number = info.st_rdev if path.startswith("/dev/") else info.st_dev
+    link = os.path.realpath("/sys/dev/block/{0}:{1}".format(
+        os.major(number), os.minor(number)))
+    if not os.path.exists(link):
+        return None
+    if os.path.exists(os.path.join(link, "partition")):
+        link = os.path.dirname(link)
+    return os.path.basename(link)
+
+
+def drops_copy_cache(template):
+    """Return True if the copy keeps copied data out of the page cache
+
+    DropCopyCache is meant for ramdisks, where the page cache competes
+    with the source image and the installer for memory.
+    """
+    return template.get("DropCopyCache", False)
+
+
+def sample_page_cache(report, stop, interval=PROGRESS_INTERVAL):
+    """Record the peak page cache use in report until stop is set
+    """
+    while True:
+        report["peak_cache"] = max(report["peak_cache"], get_page_cache())
+        if stop.wait(interval):
+            return
+
+
+def get_slow_source(template):
+    """Return why reading the source out of order is slow, None if it isn't
+
+    Lazily fetched remote images and images read from a removable or
+    rotational disk pay for every seek.
+    """
+    if is_lazy_source(template):
+        return "source read lazily from {}".format(
+            template["ImageSourceLocation"])
+    image = template["ImageSourceLocation"][len("file://"):]
+    try:
+        if is_xz_image(image):
+            image = os.path.join(get_run_dir(), "source")
+    except OSError:
+        return None
+    disk = get_backing_disk(image)
+    if not disk:
+        return None
+    try:
+        with open("{0}/{1}/removable".format(SYSFS_BLOCK, disk),
+                  "r") as removable:
+            if removable.read().strip() == "1":
+                return "source image on removable disk {}".format(disk)
+    except OSError:
+        pass
+    if get_device_class(disk) == "rotational":
+        return "source image on rotational disk {}".format(disk)
+    return None
+
+
+def get_image_mounts(template, source_dir):
+    """Return the mount points that can be copied block by block
+
+    The target mount points must all be filesystems of their own in the
+    source image. Those where source and target are the same ext
+    filesystem type and the target partition is big enough are returned
+    with their source and target devices, the others are left to rsync.
+    """
+    fstypes = {}
+    for fst in template["FilesystemTypes"]:
+        fstypes[get_device_name(fst["disk"], fst.get("partition"))] = \
+            fst["type"]
+    sizes = get_layout_sizes(template)
+    imaged = {}
+    for part in template["PartitionMountPoints"]:
+        mount = part["mount"]
+        device, fstype = get_mount_entry(os.path.normpath(source_dir +
+                                                          mount))
+        if not device:
+            return {}
+        target = get_device_name(part["disk"], part.get("partition"))
+        try:
+            with open("/sys/class/block/{}/size".format(device),
+                      "r") as sectors:
+                size = int(sectors.read()) * 512
+        except (OSError, ValueError):
+            continue
+        stat = os.statvfs(source_dir + mount)
+        if fstype in ["ext2", "ext3", "ext4"] and \
+           fstype == fstypes.get(target) and (sizes.get(target) or 0) >= size:
+            imaged[mount] = {"device": device, "target": target,
+                             "size": size, "used": (stat.f_blocks -
+                                                    stat.f_bfree) *
+                             stat.f_frsize}
+    return imaged
+
+
+def copy_image(template, source_dir, target_dir, imaged, drop_cache=False):
+    """Copy filesystems of the source image to their partitions with dd
+
+    Each imaged filesystem is checked, grown to fill its partition and
+    given a new UUID. The target is mounted again and the mount points
+    that couldn't be imaged are copied with rsync. With drop_cache dd
+    bypasses the page cache.
+
+    This function will raise an Exception on finding an error.
+    """
+    run_command(["umount", "-R", target_dir])
+    with ProgressStage("image", sum(v["size"] for v in imaged.values())) \
+            as stage:
+        for mount in sorted(imaged):
+            device = "/dev/{}".format(imaged[mount]["target"])
+            run_command(["dd", "if=/dev/{}".format(imaged[mount]["device"]),
+                         "of={}".format(device), "bs=4M", "conv=fsync"] +
+                        (["iflag=direct", "oflag=direct"] if drop_cache
+                         else []))
+            stage.update(done_bytes=stage.done_bytes + imaged[mount]["size"])
+            # e2fsck exits with 1 when it corrected the filesystem
+            check = run_command(["e2fsck", "-fy", device],
+                                raise_exception=False)
+            if check["returncode"] not in [0, 1]:
+                raise Exception(command_error(check))
+            run_command(["resize2fs", device])
+            run_command(["tune2fs", "-U", "random", device])
+    # The mount points already exist in the imaged filesystems
+    for command in target_mount_commands(template, target_dir):
+        if command[0] == "mount":
+            run_command(command)
+    for part in template["PartitionMountPoints"]:
+        if part["mount"] not in imaged:
+            copy_files(os.path.normpath(source_dir + part["mount"]),
+                       os.path.normpath(target_dir + part["mount"]))
+
+
+def select_copy_strategy(template, source_dir):
+    """Return the copy strategy for the install and why it was chosen
+
+    The image strategy replaces the filesystems made from FilesystemTypes,
+    dropping their mkfs options and stripe tuning, so it is only used
+    when CopyStrategy asks for it. The source is only scanned when the
+    choice or the parallel copy needs it.
+
+    Returns a dictionary with the strategy, the reason and the facts
+    about the image and the target disks the choice was based on.
+    """
+    imaged = get_image_mounts(template, source_dir)
+    classes = sorted(set(get_device_class(part["disk"])
+                         for part in template["PartitionLayout"]))
+    choice = {"files": None, "bytes": None, "hardlinks": None,
+              "targets": classes, "imaged": imaged, "stats": None}
+    if template.get("CopyStrategy"):
+        choice.update(strategy=template["CopyStrategy"],
+                      reason="set by CopyStrategy")
+        if choice["strategy"] == "image" and not imaged:
+            raise Exception("CopyStrategy image needs a disk image with an "
+                            "ext filesystem for a target mount point")
+        if choice["strategy"] == "parallel":
+            stats = scan_source(source_dir)
+            choice.update(files=stats["files"], bytes=stats["bytes"],
+                          hardlinks=stats["hardlinks"], stats=stats)
+        return choice
+    slow = get_slow_source(template)
+    if slow:
+        choice.update(strategy="ordered", reason=slow)
+        return choice
+    if drops_copy_cache(template):
+        choice.update(strategy="ordered", reason="only the ordered copy "
+                      "keeps the page cache free on a ramdisk")
+        return choice
+    stats = scan_source(source_dir)
+    average = stats["bytes"] // max(stats["files"], 1)
+    choice.update(files=stats["files"], bytes=stats["bytes"],
+                  hardlinks=stats["hardlinks"], stats=stats)
+    if stats["hardlinks"]:
+        choice.update(strategy="rsync", reason="{} hard linked files"
+                      .format(stats["hardlinks"]))
+    elif "rotational" in classes:
+        choice.update(strategy="rsync", reason="rotational target disk")
+    elif stats["files"] < PARALLEL_COPY_MIN_FILES:
+        choice.update(strategy="rsync", reason="only {} files"
+                      .format(stats["files"]))
+    elif average > PARALLEL_COPY_MAX_AVERAGE:
+        choice.update(strategy="rsync", reason="{} average file size"
+                      .format(format_bytes(average)))
+    else:
+        choice.update(strategy="parallel", reason="{0} files of {1} average "
+                      "size on {2} target disks".format(
+                          stats["files"], format_bytes(average),
+                          "/".join(classes)))
+    return choice
+
+
+def get_device_size(device):
+    """Return the size in bytes of a block device or partition, 0 if unknown
+    """
+    try:
+        with open("/sys/class/block/{}/size".format(device), "r") as sectors:
+            return int(sectors.read()) * 512
+    except (OSError, ValueError):
+        return 0
+
+
+def write_lower(template, source_dir):
+    """Write the source root filesystem to the OverlayLower partition
+
+    The filesystem mounted at source_dir, a partition of a disk image or
+    a squashfs or erofs image, is written block by block so the image
+    costs one sequential write.
+
+    This function will raise an Exception on finding an error.
+    """
+    device = get_mount_device(source_dir)
+    if not device:
+        raise Exception("The source root filesystem isn't on a device")
+    lower = get_device_name(template["OverlayLower"]["disk"],
+                            template["OverlayLower"]["partition"])
+    size = get_device_size(device)
+    with ProgressStage("lower", size) as stage:
+        run_command(["dd", "if=/dev/{}".format(device),
+                     "of=/dev/{}".format(lower), "bs=4M", "conv=fsync"] +
+                    (["iflag=direct", "oflag=direct"]
+                     if drops_copy_cache(template) else []))
+        stage.update(done_bytes=size)
+
+
+def copy_overlay(template, source_dir, target_dir):
+    """Copy the mount points other than the root to an overlay install
+
+    The root filesystem is the lower layer already, the other mount
+    points, such as /boot, hide what it holds below them.
+
+    This function will raise an Exception on finding an error.
+    """
+    for part in sorted(template["PartitionMountPoints"],
+                       key=lambda v: v["mount"]):
+        if part["mount"] != "/":
+            copy_files(os.path.normpath(source_dir + part["mount"]),
+                       os.path.normpath(target_dir + part["mount"]))
+
+
+def copy_source(template, source_dir, target_dir):
+    """Copy the source to the target with the best suited strategy
+
+    Overlay installs only copy the mount points outside the root.
+
+    This function will raise an Exception on finding an error.
+    """
+    if template.get("OverlayLower"):
+        INSTALL_REPORT["copy_strategy"] = {"strategy": "overlay",
+                                           "reason": "set by OverlayLower"}
+        copy_overlay(template, source_dir, target_dir)
+        return
+    choice = select_copy_strategy(template, source_dir)
+    INSTALL_REPORT["copy_strategy"] = {"strategy": choice["strategy"],
+                                       "reason": choice["reason"],
+                                       "files": choice["files"],
+                                       "bytes": choice["bytes"]}
+    write_metric("copy-strategy", **INSTALL_REPORT["copy_strategy"])
+    write_console("Copying with {0}: {1}\n".format(choice["strategy"],
+                                                   choice["reason"]))
+    drop_cache = drops_copy_cache(template)
+    report = {"dropped": drop_cache and choice["strategy"] in ["image",
+                                                               "ordered"],
+              "peak_cache": 0}
+    INSTALL_REPORT["copy_cache"] = report
+    stop = threading.Event()
+    threading.Thread(target=sample_page_cache, args=(report, stop),
+                     daemon=True).start()
+    try:
+        if choice["strategy"] == "image":
+            copy_image(template, source_dir, target_dir, choice["imaged"],
+                       drop_cache)
+        elif choice["strategy"] == "parallel":
+            copy_parallel(source_dir, target_dir, choice["stats"])
+        elif choice["strategy"] == "ordered":
+            copy_ordered(source_dir, target_dir, drop_cache)
+        else:
+            copy_files(source_dir, target_dir)
+    finally:
+        stop.set()
+        report["peak_cache"] = max(report["peak_cache"], get_page_cache())
+        write_metric("copy-cache", **report)
+
+
+def parse_rsync_progress(line):
+    """Parse a line of rsync --info=progress2 output
+
+    Example line:
+        1,234,567  45%   12.34MB/s    0:01:23 (xfr#12, to-chk=100/200)
+
+    Returns a dictionary of progress fields or None if the line doesn't
+    contain progress information.
+    """
+    match = re.match(r"\s*([\d,]+)\s+(\d+)%", line)
+    if not match:
+        return None
+    done_bytes = int(match.group(1).replace(",", ""))
+    percent = int(match.group(2))
+    progress = {"done_bytes": done_bytes}
+    if percent:
+        progress["total_bytes"] = done_bytes * 100 // percent
+    files = re.search(r"to-chk=(\d+)/(\d+)", line)
+    if files:
+        progress["total_files"] = int(files.group(2))
+        progress["done_files"] = int(files.group(2)) - int(files.group(1))
+    return progress
+
+
+def match_uuids(updated_layout, used_partitions):
+    """Match uuids from blkid to devices in updated_layout
+
+    This function will raise an exception on finding an error.
+    """
+    uuids = []
+
+    try:
+        blkids = run_command(["blkid"])["stdout"].splitlines()
+    except:
+        raise Exception("Call to blkid failed")
+
+    for line in blkids:
+        uuid = ""
+        # Example line:
+        # /dev/sda1: SEC_TYPE="msdos" UUID="53E0-A0AB" TYPE="vfat" \
+        #    PARTLABEL="EFI System"
+        # PARTUUID="4921334c-d69f-43c0-a85d-cb4976817b93"
+        pline = line.split(" ")
+        dev = pline[0][:-1]
+        # Skip the partitions of the source image
+        if RUN_RESOURCES["device"] and \
+           re.match(r"{}p?\d*$".format(RUN_RESOURCES["device"]), dev):
+            continue
+        disk_part = os.path.basename(dev)
+        if not updated_layout.get(disk_part):
+            continue
+        if disk_part not in used_partitions:
+            continue
+        for i in pline:
+            if i.find('UUID="') == 0:
+                uuid = i.split('"')[1]
+        if uuid == "":
+            raise Exception("Partition uuid not found in {}".format(line))
+        updated_layout[disk_part]["uuid"] = uuid
+        uuids.append(updated_layout[disk_part])
+
+    return uuids
+
+
+def get_uuids(template):
+    """Relate partition uuids from blkid to partition layout
+
+    In order to relate partition uuids from blkid, first update partition
+    layout information to match what blkid returns.
+    """
+    used_disk_part = []
+    updated_layout = {}
+
+    for part in template["PartitionLayout"]:
+        disk_part = get_device_name(part["disk"], part["partition"])
+        updated_layout[disk_part] = part.copy()
+        if updated_layout[disk_part]["type"] == "swap":
+            updated_layout[disk_part]["mount"] = "none"
+
+    for array in template.get("RaidSetup", []):
+        updated_layout[array["rdisk"]] = {"disk": array["rdisk"]}
+
+    for part in template["FilesystemTypes"]:
+        disk_part = get_device_name(part["disk"], part.get("partition"))
+        updated_layout[disk_part]["type"] = part["type"]
+
+    for part in template["PartitionMountPoints"]:
+        disk_part = get_device_name(part["disk"], part.get("partition"))
+        used_disk_part.append(disk_part)
+        updated_layout[disk_part]["mount"] = part["mount"]
+        if part.get("options"):
+            updated_layout[disk_part]["options"] = part["options"]
+
+    return match_uuids(updated_layout, used_disk_part)
+
+
+def get_lower_partuuid(template):
+    """Return the PARTUUID of the OverlayLower partition, None without one
+
+    squashfs has no filesystem UUID so the lower layer is found by its
+    partition.
+
+    This function will raise an Exception on finding an error.
+    """
+    if not template.get("OverlayLower"):
+        return None
+    return run_command(["blkid", "-o", "value", "-s", "PARTUUID",
+                        "/dev/{}".format(get_device_name(
+                            template["OverlayLower"]["disk"],
+                            template["OverlayLower"]["partition"]))])[
+                                "stdout"].strip()
+
+
+def update_loader(uuids, target_dir, lower=None):
+    """Update root UUID in bootloader configuration
+
+    With the PARTUUID of an overlay lower layer, the root is the read
+    only lower partition and overlayroot mounts the root filesystem as
+    the upper layer over it.
+
+    This function will raise an Exception on finding an error.
+    """
+    for part in uuids:
+        if part["mount"] == "/":
+            uuid = part["uuid"]
+            break
+    try:
+        with open("{}/boot/loader/entries/default.conf"
+                  .format(target_dir), "r+") as loader:
+            conf = loader.readlines()
+            # 3rd line contains:
+            # options root=UUID=0000-0000 kernel commandline options
+            options = conf[3].split()
+            root = "root=PARTUUID={}".format(lower) if lower else \
+                "root=UUID={}".format(uuid)
+            options = [root if option.find("root=") == 0 else option
+                       for option in options]
+            if lower:
+                options = [option for option in options
+                           if option not in ["ro", "rw"] and
+                           option.find("overlayroot=") != 0] + \
+                    ["ro", "overlayroot=device:dev=UUID={},recurse=0"
+                     .format(uuid)]
+            conf[3] = ' '.join(options) + "\n"
+            loader.seek(0)
+            loader.truncate()
+            loader.writelines(conf)
+    except Exception as exep:
+        raise Exception("Unable to open or invalid bootloader configuration \
+        file: {}".format(exep))
+
+
+def update_fstab(uuids, target_dir, overlay=False):
+    """Add PARTUUID entries to /etc/fstab
+
+    The root of an overlay install is mounted by overlayroot from the
+    kernel command line so it has no entry.
+
+    This function will raise an Exception on finding an error.
+    """
+    default_options = DEFAULT_MOUNT_OPTIONS + " 0 0"
+    try:
+        fstab = open("{}/etc/fstab".format(target_dir), "w")
+    except:
+        raise Exception("Failed to open {}/etc/fstab".format(target_dir))
+
+    try:
+        for part in uuids:
+            if overlay and part["mount"] == "/":
+                continue
+            if part.get("options"):
+                options = part["options"]
+            else:
+                options = default_options
+            line = "UUID={0}	{1}	{2}	{3}\n".\
+                   format(part["uuid"], part["mount"], part["type"], options)
+            fstab.write(line)
+    except:
+        raise Exception("Failed to update {}/etc/fstab".format(target_dir))
+    finally:
+        fstab.close()
+
+    return
+
+
+def machine_id_command(target_dir):
+    """Return the command creating a machine-id for the target system
+    """
+    return ["systemd-machine-id-setup", "--root={}".format(target_dir)]
+
+
+def setup_machine_id(target_dir, command=None):
+    """Create a machine-id for the target system
+
+    command defaults to machine_id_command.
+    """
+
+    run_command(command or machine_id_command(target_dir))
+
+
+def run_worker_commands(commands, timeout=None):
+    """Execute independent commands from the target worker, at most
+    MAX_PARALLEL_COMMANDS at once
+
+    The worker is forked while other installer threads may hold locks,
+    so it only uses plain subprocesses, without run_command's shared
+    slots, timer threads or metrics. Output goes to temporary files so
+    no command blocks on a full pipe. Returns the results in the order
+    of commands, as run_command returns them.
+    """
+    if not isinstance(timeout, list):
+        timeout = [timeout] * len(commands)
+    results = []
+    for index in range(0, len(commands), MAX_PARALLEL_COMMANDS):
+        started = []
+        for cmd, limit in zip(commands[index:index + MAX_PARALLEL_COMMANDS],
+                              timeout[index:index + MAX_PARALLEL_COMMANDS]):
+            if limit is None:
+                limit = COMMAND_TIMEOUTS.get(os.path.basename(cmd[0]),
+                                             COMMAND_TIMEOUT)
+            result = {"command": cmd, "returncode": None, "stdout": "",
+                      "stderr": "", "timeout": limit, "timed_out": False,
+                      "start": time.time()}
+            outputs = (tempfile.TemporaryFile(), tempfile.TemporaryFile())
+            try:
+                proc = subprocess.Popen(cmd, stdout=outputs[0],
+                                        stderr=outputs[1])
+            except OSError as exep:
+                proc = None
+                result["stderr"] = str(exep)
+            started.append((result, proc, outputs))
+        for result, proc, outputs in started:
+            start = result.pop("start")
+            if proc:
+                try:
+                    result["returncode"] = proc.wait(
+                        max(start + result["timeout"] - time.time(), 0))
+                except subprocess.TimeoutExpired:
+                    result["timed_out"] = True
+                    proc.kill()
+                    result["returncode"] = proc.wait()
+                for name, ofile in zip(["stdout", "stderr"], outputs):
+                    ofile.seek(0)
+                    result[name] = ofile.read().decode("utf-8", "replace")
+            for ofile in outputs:
+                ofile.close()
+            result["seconds"] = time.time() - start
+            results.append(result)
+    return results
+
+
+def run_target_operation(operation):
+    """Perform one operation for the target worker, inside the target root
+
+    Returns a dictionary describing the result of the operation.
+    """
+    name = operation["op"]
+    if name == "run":
+        result = run_worker_commands([operation["command"]],
+                                     operation.get("timeout"))[0]
+        if result["returncode"] != 0:
+            raise Exception(command_error(result))
+        return result
+    if name == "run_all":
+        # Failures are left for the installer to report per command
+        return {"results": run_worker_commands(operation["commands"],
+                                               operation.get("timeout"))}
+    if name == "makedirs":
+        os.makedirs(operation["path"], mode=operation.get("mode", 0o777),
+                    exist_ok=True)
+    elif name == "write":
+        with open(operation["path"], "a" if operation.get("append")
+                  else "w") as ofile:
+            ofile.write(operation["data"])
+        if operation.get("mode"):
+            os.chmod(operation["path"], operation["mode"])
+    elif name == "chown":
+        pwinfo = pwd.getpwnam(operation["user"])
+        os.chown(operation["path"], pwinfo[2], pwinfo[3])
+    else:
+        raise Exception("Unknown target operation {}".format(name))
+    return {}
+
+
+def target_worker_main(target_dir, requests, replies):
+    """Serve batches of operations from inside the target root
+
+    Runs in the forked worker process. The first reply reports whether
+    the chroot succeeded, after that each batch read from requests gets
+    one reply listing the result of each operation. A batch stops at the
+    first failing operation.
+    """
+    # Progress belongs to the installer, the worker only reports results
+    PROGRESS_SINKS["console"] = None
+    PROGRESS_SINKS["metrics"] = None
+    try:
+        os.chroot(target_dir)
+        os.chdir("/")
+        # The temporary folder found outside is looked up again inside
+        tempfile.tempdir = None
+        replies.write(json.dumps({"ok": True}) + "\n")
+    except Exception as exep:
+        replies.write(json.dumps({"error": "Unable to setup chroot: {}"
+                                  .format(exep)}) + "\n")
+        replies.flush()
+        return
+    replies.flush()
+    for line in requests:
+        results = []
+        reply = {"results": results}
+        for operation in json.loads(line):
+            try:
+                results.append(run_target_operation(operation))
+            except Exception as exep:
+                reply["error"] = "{0}: {1}".format(
+                    operation.get("error", operation["op"]), exep)
+                break
+        replies.write(json.dumps(reply) + "\n")
+        replies.flush()
+
+
+class TargetWorker(object):
+    """Class encapsulating a helper process chrooted into the target
+
+    The worker is forked and changes its root once, the installer itself
+    never leaves the real root so the target's shared libraries are never
+    loaded into it. Operations are sent in batches over a pipe. Other
+    threads of the installer may hold locks when it forks, so the worker
+    runs commands with run_worker_commands only.
+    """
+    def __init__(self, target_dir):
+        """Stores the target directory for the worker
+        """
+        self.target_dir = target_dir
+        self.pid = -1
+        self.requests = None
+        self.replies = None
+
+    def __enter__(self):
+        """Start the worker and wait for it to enter the target
+
+        This function will raise an Exception on finding an error.
+        """
+        requests_in, requests_out = os.pipe()
+        replies_in, replies_out = os.pipe()
+        self.pid = os.fork()
+        if self.pid == 0:
+            os.close(requests_out)
+            os.close(replies_in)
+            try:
+                target_worker_main(self.target_dir,
+                                   os.fdopen(requests_in, "r"),
+                                   os.fdopen(replies_out, "w"))
+            finally:
+                # The forked worker must never return into the installer
+                os._exit(0)  # pylint: disable=W0212
+        os.close(requests_in)
+        os.close(replies_out)
+        self.requests = os.fdopen(requests_out, "w")
+        self.replies = os.fdopen(replies_in, "r")
+        ready = json.loads(self.replies.readline() or "{}")
+        if not ready.get("ok"):
+            self.__exit__(None, None, None)
+            raise Exception(ready.get("error", "Target worker failed to "
+                                      "start"))
+        return self
+
+    def run(self, operations):
+        """Perform a batch of operations inside the target
+
+        Returns the list of results, one per operation.
+
+        This function will raise an Exception on finding an error.
+        """
+        self.requests.write(json.dumps(operations) + "\n")
+        self.requests.flush()
+        reply = json.loads(self.replies.readline() or
+                           '{"error": "Target worker exited"}')
+        for result in reply.get("results", []):
+            for command in result.get("results", [result]):
+                if "command" not in command:
+                    continue
+                INSTALL_REPORT["commands"].append(
+                    {"command": command["command"],
+                     "returncode": command["returncode"],
+                     "seconds": command["seconds"]})
+                write_metric("command", command=command["command"],
+                             returncode=command["returncode"],
+                             seconds=command["seconds"], chroot=True)
+        if reply.get("error"):
+            raise Exception(reply["error"])
+        return reply["results"]
+
+    def __exit__(self, *args):
+        """Stop the worker and wait for it to exit
+        """
+        if self.requests:
+            self.requests.close()
+        if self.replies:
+            self.replies.close()
+        if self.pid > 0:
+            os.waitpid(self.pid, 0)
+        return False
+
+
+def account_command(user):
+    """Return the command adding user, run inside the target chroot
+    """
+    if user.get("uid"):
+        return ["useradd", "-U", "-m", "-p", "", "-u", str(user["uid"]),
+                user["username"]]
+    return ["useradd", "-U", "-m", "-p", "", user["username"]]
+
+
+def account_operations(user, command=None):
+    """Return target operations adding user to the system
+
+    Create a new account on the system with a home directory and one time
+    passwordless login. Also add a new group with same name as the user.
+    command defaults to account_command.
+    """
+    return [{"op": "run", "command": command or account_command(user),
+             "error": "Unable to add user {}".format(user["username"])}]
+
+
+def user_key_operations(user):
+    """Return target operations appending the user's public key to their
+    ssh authorized_keys file
+
+    This function will raise an Exception on finding an error.
+    """
+    key = request.urlopen(user["key"]).read().decode("utf-8")
+    ssh_dir = "/home/{}/.ssh".format(user["username"])
+    error = "Unable to add {}'s ssh key to authorized keys"\
+        .format(user["username"])
+    return [{"op": "makedirs", "path": ssh_dir, "mode": 0o700,
+             "error": error},
+            {"op": "chown", "path": ssh_dir, "user": user["username"],
+             "error": error},
+            {"op": "write", "path": ssh_dir + "/authorized_keys",
+             "data": key, "append": True, "error": error},
+            {"op": "chown", "path": ssh_dir + "/authorized_keys",
+             "user": user["username"], "error": error}]
+
+
+def sudo_operations(user):
+    """Return target operations adding the user to the sudoers
+    """
+    return [{"op": "write",
+             "path": "/etc/sudoers.d/{}".format(user["username"]),
+             "data": "{} ALL=(ALL) ALL".format(user["username"]),
+             "error": "Unable to add sudoer conf file for {}"
+                      .format(user["username"])}]
+
+
+def add_users(template, target_dir, commands=None):
+    """Create user accounts with no password one time logins
+
+    Will setup sudo and ssh key access if specified in template. All the
+    users are added by a single batch sent to a target worker. commands
+    hold the command adding each user and default to account_command.
+    """
+    users = template.get("Users")
+    if not users:
+        return
+
+    operations = []
+    for user, command in zip(users, commands or [None] * len(users)):
+        operations += account_operations(user, command)
+        if user.get("key"):
+            operations += user_key_operations(user)
+        if user.get("sudo"):
+            operations += sudo_operations(user)
+    with TargetWorker(target_dir) as worker:
+        worker.run(operations)
+
+
+def post_install_packages(template, target_dir, commands=None):
+    """Install packages after system installation completed
+
+    commands default to package_commands.
+    """
+    for command in commands or package_commands(template, target_dir):
+        run_command(command)
+
+
+def get_package_cache(run_dir=None):
+    """Return the folder InstallPackages are downloaded to, in the run's
+    scratch folder by default
+    """
+    return "{}/packages".format(run_dir or get_run_dir())
+
+
+def package_download_commands(template, source_dir, run_dir):
+    """Return the commands downloading InstallPackages against the source
+
+    The source is mounted read only, so zypper runs in a writable
+    overlay of it in run_dir, where it can keep its lock and state
+    files. The first two commands create the overlay, the last one
+    unmounts it.
+    """
+    root, upper, work = ["{0}/packages-{1}".format(run_dir, layer)
+                         for layer in ["root", "upper", "work"]]
+    return [["mkdir", "-p", root, upper, work],
+            ["mount", "-t", "overlay", "-o",
+             "lowerdir={0},upperdir={1},workdir={2}".format(
+                 source_dir, upper, work), "overlay", root]] + \
+        package_commands(template, root, "InstallPackages",
+                         get_package_cache(run_dir), True) + \
+        [["umount", root]]
+
+
+def start_package_download(template, source_dir, commands=None):
+    """Start downloading InstallPackages while the disks are prepared
+
+    The repositories and the package database of the source are those
+    the target gets, so zypper solves the dependencies against the
+    source and only downloads to the package cache. Returns the thread
+    downloading the packages. Failed downloads are logged and those
+    packages are fetched again when they are installed. commands
+    default to package_download_commands.
+    """
+    commands = commands or package_download_commands(template, source_dir,
+                                                     get_run_dir())
+    report = INSTALL_REPORT.setdefault("packages", {})
+
+    def download():
+        """Download the packages, leaving errors to install_packages"""
+        start = time.time()
+        results = [run_command(command, raise_exception=False)
+                   for command in commands[:2]]
+        if not [result for result in results if result["returncode"]]:
+            results += [run_command(command, raise_exception=False)
+                        for command in commands[2:-1]]
+            results.append(run_command(commands[-1], raise_exception=False))
+        report["download"] = time.time() - start
+        report["failed"] = [" ".join(result["command"]) for result in results
+                            if result["returncode"] != 0]
+        for result in results:
+            if result["returncode"] != 0:
+                write_console("Package download failed, installing will "
+                              "fetch them again: {}\n"
+                              .format(command_error(result)))
+        write_metric("package-download", seconds=report["download"],
+                     failed=report["failed"])
+    thread = threading.Thread(target=download, daemon=True)
+    thread.start()
+    return thread
+
+
+def install_packages(template, target_dir, download=None, commands=None):
+    """Install InstallPackages into the copied target from the package cache
+
+    The download started by start_package_download is waited for first,
+    the time spent waiting is in the install report. commands default to
+    package_commands.
+
+    This function will raise an Exception on finding an error.
+    """
+    report = INSTALL_REPORT.setdefault("packages", {})
+    start = time.time()
+    if download:
+        download.join()
+    report["wait"] = time.time() - start
+    for command in commands or package_commands(
+            template, target_dir, "InstallPackages", get_package_cache()):
+        run_command(command)
+    write_metric("packages", **report)
+
+
+def package_commands(template, target_dir, section="PostInstallPackages",
+                     cache_dir=None, download_only=False):
+    """Return the commands installing the packages of section into target_dir
+
+    Given a cache_dir, zypper keeps its metadata and packages there. With
+    download_only the packages are only downloaded.
+    """
+    commands = []
+    for package in template.get(section, []):
+        if package["packagemanager"] == "zypper":
+            command = ["zypper", "--root", target_dir]
+            if cache_dir:
+                command.extend(["--cache-dir", cache_dir])
+            command.extend(["-n", "in"])
+            if download_only:
+                command.append("--download-only")
+            if package["type"] == "group":
+                command.extend(["-t", "pattern"])
+            commands.append(command + [package["name"]])
+    return commands
+
+
+def script_entries(template, stage):
+    """Return the scripts of a PostNonChroot or PostChroot stage
+
+    Plain script paths are turned into entries of their own and every
+    entry records its position in the stage.
+    """
+    entries = []
+    for index, entry in enumerate(template.get(stage, [])):
+        entry = {"script": entry} if isinstance(entry, str) else dict(entry)
+        entry["index"] = index
+        entries.append(entry)
+    return entries
+
+
+def script_groups(scripts):
+    """Return scripts split into groups that are run one after another
+
+    Scripts naming the same group run concurrently, at the position of
+    the first script of the group. Scripts without a group run alone.
+    """
+    groups = []
+    named = {}
+    for script in scripts:
+        if "group" not in script:
+            groups.append([script])
+        elif script["group"] in named:
+            named[script["group"]].append(script)
+        else:
+            named[script["group"]] = [script]
+            groups.append(named[script["group"]])
+    return groups
+
+
+def script_command(stage, script, target_dir):
+    """Return the command running script for stage
+
+    PostNonChroot scripts run on the installer with the target folder as
+    their argument, PostChroot scripts run from a copy inside the target.
+    """
+    if stage == "PostChroot":
+        return ["{0}/{1}-{2}".format(CHROOT_SCRIPT_DIR, script["index"],
+                                     os.path.basename(script["script"]))]
+    return [script["script"], target_dir]
+
+
+def record_scripts(stage, scripts, results):
+    """Add the timing and output of each script to the install report
+
+    This function will raise an Exception if any script failed.
+    """
+    for script, result in zip(scripts, results):
+        INSTALL_REPORT["scripts"].append(
+            {"stage": stage, "script": script["script"],
+             "group": script.get("group"), "returncode": result["returncode"],
+             "seconds": result["seconds"], "timed_out": result["timed_out"],
+             "stdout": result["stdout"], "stderr": result["stderr"]})
+        write_metric("script", stage=stage, script=script["script"],
+                     returncode=result["returncode"],
+                     seconds=result["seconds"])
+    failed = [result for result in results if result["returncode"] != 0]
+    if failed:
+        raise Exception("{0} script {1}".format(
+            stage, ", ".join(command_error(result) for result in failed)))
+
+
+def run_post_non_chroot(template, target_dir, commands=None):
+    """Run the PostNonChroot scripts against the installed target
+
+    commands hold the command running each script, in stage order, and
+    default to script_command.
+
+    This function will raise an Exception if any script failed.
+    """
+    scripts = script_entries(template, "PostNonChroot")
+    commands = commands or [script_command("PostNonChroot", script,
+                                           target_dir) for script in scripts]
+    for group in script_groups(scripts):
+        results = run_commands([commands[script["index"]]
+                                for script in group], raise_exception=False,
+                               timeout=[script.get("timeout")
+                                        for script in group])
+        record_scripts("PostNonChroot", group, results)
+
+
+def chroot_mount_commands(target_dir):
+    """Return the commands bind mounting /proc, /dev and /sys in the target
+    """
+    commands = []
+    for path in ["/proc", "/dev", "/sys"]:
+        commands.append(["mkdir", "-p", target_dir + path])
+        commands.append(["mount", "--rbind", path, target_dir + path])
+        # Unmounting the target's copy must not reach the installer's
+        commands.append(["mount", "--make-rslave", target_dir + path])
+    return commands
+
+
+def run_post_chroot(template, target_dir, commands=None):
+    """Run the PostChroot scripts inside the installed target
+
+    The scripts are copied into the target, made executable, and each
+    group is sent to a single target worker as one batch with /proc,
+    /dev and /sys of the installer mounted in the target. commands hold
+    the command running each script, in stage order, and default to
+    script_command.
+
+    This function will raise an Exception if any script failed.
+    """
+    scripts = script_entries(template, "PostChroot")
+    if not scripts:
+        return
+
+    commands = commands or [script_command("PostChroot", script, target_dir)
+                            for script in scripts]
+    script_dir = target_dir + CHROOT_SCRIPT_DIR
+    os.makedirs(script_dir, exist_ok=True)
+    mounted = []
+    try:
+        for script in scripts:
+            path = target_dir + commands[script["index"]][0]
+            shutil.copy(script["script"], path)
+            os.chmod(path, 0o755)
+        for command in chroot_mount_commands(target_dir):
+            run_command(command)
+            if command[1] == "--rbind":
+                mounted.append(command[-1])
+        with TargetWorker(target_dir) as worker:
+            for group in script_groups(scripts):
+                results = worker.run([{
+                    "op": "run_all",
+                    "commands": [commands[script["index"]]
+                                 for script in group],
+                    "timeout": [script.get("timeout") for script in group]
+                }])[0]["results"]
+                record_scripts("PostChroot", group, results)
+    finally:
+        for path in reversed(mounted):
+            run_command(["umount", "-R", path], raise_exception=False)
+        shutil.rmtree(script_dir, ignore_errors=True)
+
+
+def cleanup(source_dir, target_dir, raise_exception=True,
+            shared_source=False, background=False, commands=None):
+    """Unmount and remove temporary files
+
+    A shared_source belongs to the install daemon and is left mounted,
+    the nbd device, lock and scratch folder of the run are released
+    either way.
+    With background, only the unmounts are waited for and the removals
+    and the nbd disconnect are left to wait_teardown. commands default
+    to cleanup_commands.
+
+    This function may raise an Exception on finding an error.
+    """
+    restore_io_tuning()
+    commands = commands or cleanup_commands(source_dir, target_dir)
+    umounts, removals = commands[:2], commands[2:]
+    if shared_source:
+        umounts, removals = umounts[:1], removals[:1]
+    run_commands(umounts, raise_exception=raise_exception)
+    umount_overlay_layers(target_dir, raise_exception)
+    resume_raid_resync()
+
+    def remove(raise_exception):
+        """Remove the run's folders and release its source"""
+        run_commands(removals)
+        for layer in get_overlay_layers(target_dir):
+            # A layer that failed to unmount is left in place
+            try:
+                os.rmdir(layer)
+            except OSError:
+                pass
+        # Filesystem images are loop mounted and detached by the umount,
+        # only an nbd device the run reserved needs disconnecting
+        if not shared_source:
+            stop_lazy_sources()
+        release_run(raise_exception)
+    if not background:
+        remove(raise_exception)
+        return
+    teardown = threading.Thread(target=remove, args=(False,))
+    teardown.start()
+    TEARDOWN.append(teardown)
+
+
+def wait_teardown(seconds=0):
+    """Wait for the background teardown, taking at least seconds
+    """
+    deadline = time.time() + seconds
+    while TEARDOWN:
+        TEARDOWN.pop().join()
+    time.sleep(max(deadline - time.time(), 0))
+
+
+def cleanup_commands(source_dir, target_dir):
+    """Return the unmounts and removals of the teardown in the order they
+    are run
+
+    The nbd device is disconnected by release_run, only if the run
+    reserved one.
+    """
+    return [["umount", "-R", target_dir],
+            ["umount", "-R", source_dir],
+            ["rm", "-fr", target_dir],
+            ["rm", "-fr", source_dir]]
+
+
+def parse_size(size):
+    """Return the number of bytes in a PartitionLayout size such as 512M
+    """
+    match = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    return int(size[:-1]) * match[size[-1]]
+
+
+def get_disk_size(disk):
+    """Return the size in bytes of disk as reported by sysfs, 0 if unknown
+    """
+    try:
+        with open("{0}/{1}/size".format(SYSFS_BLOCK, disk), "r") as sectors:
+            return int(sectors.read()) * 512
+    except:
+        return 0
+
+
+def get_download_size(template):
+    """Return the bytes the remote source image takes to download, 0 if
+    unknown
+    """
+    try:
+        head = request.urlopen(request.Request(
+            template["ImageSourceLocation"], method="HEAD"), timeout=5)
+        return int(head.headers.get("Content-Length", 0))
+    except:
+        return 0
+
+
+def get_image_size(template):
+    """Estimate the uncompressed size of the source image without fetching it
+
+    The xz index giving the uncompressed size is at the end of the file,
+    so remote xz images are assumed to grow XZ_EXPANSION times.
+    """
+    location = template["ImageSourceLocation"]
+    if location.find("file://") == 0:
+        if get_image_format(template) != "disk":
+            return os.path.getsize(location[len("file://"):])
+        return get_uncompressed_size(location[len("file://"):])
+    size = get_download_size(template)
+    if size and get_image_format(template) == "disk" and \
+       (location.endswith(".xz") or is_remote_xz(location)):
+        return size * XZ_EXPANSION
+    return size
+
+
+def get_free_space(template):
+    """Return the bytes each disk of the layout has left after its fixed
+    size partitions, negative when they don't fit
+    """
+    free = {}
+    for part in template["PartitionLayout"]:
+        disk = part["disk"]
+        if disk not in free:
+            free[disk] = get_disk_size(disk) - get_alignment(template, disk)
+        if part["size"] != "rest":
+            free[disk] -= parse_size(part["size"])
+    return free
+
+
+def layout_errors(template):
+    """Return why the partitions of the layout don't fit their disks
+
+    Disks of unknown size are skipped.
+    """
+    free = get_free_space(template)
+    errors = []
+    for disk in sorted(free):
+        rest = [get_device_name(part["disk"], part["partition"])
+                for part in template["PartitionLayout"]
+                if part["disk"] == disk and part["size"] == "rest"]
+        if not get_disk_size(disk):
+            continue
+        if rest and free[disk] <= 0:
+            errors.append("{0} doesn't fit on {1}".format(rest[0], disk))
+        elif free[disk] < 0:
+            errors.append("the partitions of {0} need {1} more than it "
+                          "holds".format(disk, format_bytes(-free[disk])))
+    return errors
+
+
+def check_layout(template):
+    """Check the layout fits the disks before the source is fetched
+
+    This function will raise an Exception on finding an error.
+    """
+    errors = layout_errors(template)
+    if errors:
+        raise Exception("Layout check failed: {}".format(", ".join(errors)))
+
+
+def get_layout_sizes(template):
+    """Return the size in bytes of every partition and md array in the layout
+
+    A rest partition gets what the other partitions leave of its disk,
+    which is negative when they don't fit. Sizes depending on a disk of
+    unknown size are None.
+    """
+    free = get_free_space(template)
+    sizes = {}
+    for part in template["PartitionLayout"]:
+        name = get_device_name(part["disk"], part["partition"])
+        if get_disk_size(part["disk"]) == 0:
+            sizes[name] = None
+        elif part["size"] == "rest":
+            sizes[name] = free[part["disk"]]
+        else:
+            sizes[name] = parse_size(part["size"])
+    for array in template.get("RaidSetup", []):
+        members = [sizes.get(part) for part in array["rpartitions"]]
+        if None in members:
+            sizes[array["rdisk"]] = None
+        elif array["raid"] == "md-raid0":
+            sizes[array["rdisk"]] = sum(members)
+        elif array["raid"] == "md-raid1":
+            sizes[array["rdisk"]] = min(members)
+        else:
+            sizes[array["rdisk"]] = min(members) * (len(members) // 2)
+    return sizes
+
+
+def get_source_usage(source_dir, mounts, image_format):
+    """Return the bytes the source needs below each of mounts
+
+    Disk images are measured from the used block counts of their
+    filesystems when each mount point is a filesystem of its own in the
+    image. Otherwise files count towards the deepest mount point holding
+    them, rounded up to whole blocks and hard links counted once.
+    """
+    usage = dict.fromkeys(mounts, 0)
+    if image_format == "disk" and \
+       [m for m in mounts if os.path.ismount(source_dir + m)] == mounts:
+        for mount in mounts:
+            stat = os.statvfs(source_dir + mount)
+            usage[mount] = (stat.f_blocks - stat.f_bfree) * stat.f_frsize
+        return usage
+
+    seen = set()
+
+    def walk(path, mount):
+        """Add the size of everything below path to usage"""
+        for entry in os.scandir(path):
+            stat = entry.stat(follow_symlinks=False)
+            if stat.st_nlink > 1 and not entry.is_dir(follow_symlinks=False):
+                if (stat.st_dev, stat.st_ino) in seen:
+                    continue
+                seen.add((stat.st_dev, stat.st_ino))
+            usage[mount] += (stat.st_size + 4095) // 4096 * 4096
+            if entry.is_dir(follow_symlinks=False):
+                name = entry.path[len(source_dir):]
+                walk(entry.path, name if name in usage else mount)
+    walk(source_dir, "/")
+    return usage
+
+
+def preflight_check(template, source_dir):
+    """Check the layout fits the disks and the source fits the layout
+
+    Runs before anything is written to the disks, every problem found
+    is reported at once.
+
+    This function will raise an Exception on finding an error.
+    """
+    sizes = get_layout_sizes(template)
+    errors = layout_errors(template)
+
+    mounts = {}
+    for part in template["PartitionMountPoints"]:
+        mounts[part["mount"]] = sizes.get(get_device_name(
+            part["disk"], part.get("partition")))
+    usage = get_source_usage(source_dir, sorted(mounts),
+                             get_image_format(template))
+    INSTALL_REPORT["preflight"] = {}
+    if template.get("OverlayLower"):
+        # The root filesystem goes whole to the lower partition, the
+        # root mount point only takes per machine changes
+        lower = get_device_name(template["OverlayLower"]["disk"],
+                                template["OverlayLower"]["partition"])
+        usage["/"] = get_device_size(get_mount_device(source_dir) or "")
+        mounts["/"] = sizes.get(lower)
+    for mount, size in sorted(mounts.items()):
+        INSTALL_REPORT["preflight"][mount] = {"needed": usage[mount],
+                                              "available": size}
+        if size is None or size <= 0:
+            continue
+        if template.get("OverlayLower") and mount == "/":
+            if usage[mount] > size:
+                errors.append("the root filesystem needs {0} but {1} holds "
+                              "{2}".format(format_bytes(usage[mount]), lower,
+                                           format_bytes(size)))
+            continue
+        available = int(size * (1 - FILESYSTEM_OVERHEAD))
+        if usage[mount] > available:
+            errors.append("{0} needs {1} but its partition holds {2}".format(
+                mount, format_bytes(usage[mount]), format_bytes(available)))
+    write_metric("preflight", mounts=INSTALL_REPORT["preflight"])
+    if errors:
+        raise Exception("Preflight check failed: {}".format(", ".join(errors)))
+
+
+def get_meminfo():
+    """Return the fields of /proc/meminfo in bytes, empty if unknown
+    """
+    info = {}
+    try:
+        with open("/proc/meminfo", "r") as meminfo:
+            for line in meminfo:
+                fields = line.split()
+                info[fields[0].rstrip(":")] = int(fields[1]) * 1024
+    except (OSError, IndexError, ValueError):
+        pass
+    return info
+
+
+def get_available_memory():
+    """Return the bytes of memory available without swapping, 0 if unknown
+    """
+    return get_meminfo().get("MemAvailable", 0)
+
+
+def get_page_cache():
+    """Return the bytes of page cache holding file data
+
+    tmpfs files are counted in Cached as well but can't be dropped, so
+    they are left out.
+    """
+    info = get_meminfo()
+    return info.get("Cached", 0) - info.get("Shmem", 0)
+
+
+def get_memory_budget(template):
+    """Return the bytes of memory the source image may use
+
+    MemoryBudget takes precedence over the memory available now.
+    """
+    if template.get("MemoryBudget"):
+        return parse_size(template["MemoryBudget"])
+    return get_available_memory()
+
+
+def is_ram_backed(path):
+    """Return True if path is on a filesystem held in memory
+    """
+    mount, fstype = "", None
+    with open("/proc/self/mounts", "r") as mounts:
+        for line in mounts:
+            fields = line.split()
+            if (path.rstrip("/") + "/").startswith(
+                    fields[1].rstrip("/") + "/") and \
+               len(fields[1]) >= len(mount):
+                mount, fstype = fields[1], fields[2]
+    return fstype in ["tmpfs", "ramfs", "rootfs"]
+
+
+def get_scratch_partition(template, size):
+    """Return the first swap partition holding size bytes, None if none
+    """
+    sizes = get_layout_sizes(template)
+    for part in template["PartitionLayout"]:
+        name = get_device_name(part["disk"], part["partition"])
+        if part["type"] == "swap" and (sizes[name] or 0) >= size:
+            return "/dev/{}".format(name)
+    return None
+
+
+def select_memory_path(template):
+    """Choose where the source image is kept during the install
+
+    When /tmp is held in memory, as on PXE booted ramdisks, the image
+    has to fit in the memory budget. The paths are tried in order: the
+    usual download to /tmp, streaming the download through xz so only
+    the decompressed image is kept, and reading the image lazily. If
+    none fits, the image is kept on a swap partition of the target,
+    which is only formatted once the install is done.
+
+    This function will raise an Exception if the image fits nowhere.
+    """
+    memory = {"path": "tmp", "budget": None, "needed": 0}
+    if not is_ram_backed(tempfile.gettempdir()):
+        return memory
+    if template["ImageSourceType"] == "remote":
+        size = get_download_size(template)
+    else:
+        size = get_image_size(template)
+    image_format = get_image_format(template)
+    if is_lazy_source(template):
+        paths, spill = [("lazy", size)], size
+    elif template["ImageSourceType"] == "remote" and image_format == "disk":
+        spill = size * XZ_EXPANSION
+        paths = [("tmp", size + spill), ("stream", spill)]
+    else:
+        # Local images are in memory already, only a copy costs more
+        spill = size if template["ImageSourceType"] == "remote" or \
+            image_format == "disk" else 0
+        paths = [("tmp", spill)]
+    memory["budget"] = get_memory_budget(template)
+    for path, needed in paths:
+        if needed <= memory["budget"]:
+            memory.update(path=path, needed=needed)
+            return memory
+    scratch = get_scratch_partition(template, spill)
+    if not scratch:
+        raise Exception("The source image needs {0} of memory but the "
+                        "budget is {1} and no swap partition can hold it"
+                        .format(format_bytes(min(p[1] for p in paths)),
+                                format_bytes(memory["budget"])))
+    memory.update(path="scratch", scratch=scratch)
+    return memory
+
+
+def sample_memory(start, stop, interval=PROGRESS_INTERVAL):
+    """Record the peak memory used since start bytes were available until
+    stop is set
+    """
+    while True:
+        report = INSTALL_REPORT["memory"]
+        report["peak"] = max(report.get("peak", 0),
+                             start - get_available_memory())
+        if stop.wait(interval):
+            return
+
+
+def check_memory(memory):
+    """Report the memory path chosen and start tracking peak memory use
+
+    Returns the thread sampling memory use and the event stopping it.
+    """
+    INSTALL_REPORT["memory"] = dict(memory, peak=0)
+    write_metric("memory", **memory)
+    if memory["path"] != "tmp":
+        write_console("Keeping the source image in {}\n".format(
+            memory.get("scratch", memory["path"])))
+    stop = threading.Event()
+    sampler = threading.Thread(target=sample_memory,
+                               args=(get_available_memory(), stop),
+                               daemon=True)
+    sampler.start()
+    return sampler, stop
+
+
+def plan_step(step, commands=None, size=0, **details):
+    """Return one step of an install plan
+    """
+    return dict(details, step=step, commands=commands or [], bytes=size)
+
+
+def build_plan(template):
+    """Compile a validated template into an ordered install plan
+
+    The plan lists every operation of the install along with the
+    commands it runs and an estimate of the bytes it writes. Building
+    the plan never writes to any disk. Mount points that are only known
+    at install time are written as {source} and {target}, the run's
+    scratch folder and nbd device as {run} and {device}.
+
+    Steps run the commands listed for them, except for what is only
+    known once the install runs: the partitions and filesystems
+    ReuseLayout keeps are skipped, the source commands follow the image
+    actually fetched and the copy strategy, unless set by the template,
+    is picked from the source.
+    """
+    source, target, run = "{source}", "{target}", "{run}"
+    image_size = get_image_size(template)
+    sizes = get_layout_sizes(template)
+    layout_size = sum(max(sizes[get_device_name(part["disk"],
+                                                part["partition"])] or 0, 0)
+                      for part in template["PartitionLayout"])
+
+    memory = select_memory_path(template)
+    scratch = memory.get("scratch")
+    image_format = get_image_format(template)
+    location = template["ImageSourceLocation"]
+    lazy = is_lazy_source(template)
+    compressed = False
+    steps = [plan_step("check_memory"), plan_step("check_layout")]
+    if template["ImageSourceType"] == "remote" and not lazy:
+        steps.append(plan_step("get_source_image", size=image_size))
+        image, streamed = get_download_dest(template, memory, run)
+        compressed = image_format == "disk" and not streamed and \
+            (location.endswith(".xz") or is_remote_xz(location))
+    elif not lazy:
+        image = location[len("file://"):]
+        compressed = image_format == "disk" and \
+            (not os.path.exists(image) or is_xz_image(image))
+    if lazy:
+        mounts = lazy_mount_commands("{}/source.sock".format(run), source,
+                                     image_format, "{device}")
+    else:
+        mounts = source_commands(template, image, compressed,
+                                 scratch or "{}/source".format(run), source,
+                                 "{device}")
+    steps.append(plan_step("setup_source", mounts, image_size,
+                           decompress=compressed))
+    if template.get("InstallPackages"):
+        steps.append(plan_step("fetch_packages", package_download_commands(
+            template, source, run)))
+    steps.append(plan_step("preflight"))
+    steps.append(plan_step("create_partitions",
+                           partition_commands(template), layout_size))
+    if template.get("RaidSetup"):
+        steps.append(plan_step("create_raid",
+                               [raid_command(array) for array in
+                                template["RaidSetup"]]))
+    steps.append(plan_step("create_filesystems",
+                           [command for command in
+                            filesystem_commands(template)
+                            if command[-1] != scratch]))
+    if template.get("OverlayLower"):
+        steps.append(plan_step("write_lower", size=image_size))
+    steps.append(plan_step("setup_target",
+                           target_mount_commands(template, target)))
+    steps.append(plan_step("tune_devices"))
+    if template.get("OverlayLower"):
+        strategy = "overlay"
+    else:
+        strategy = template.get("CopyStrategy")
+    steps.append(plan_step("copy_files", size=image_size,
+                           strategy=strategy))
+    if template.get("InstallPackages"):
+        steps.append(plan_step("install_packages", package_commands(
+            template, target, "InstallPackages", get_package_cache(run))))
+    steps.append(plan_step("start_writeback"))
+    steps.append(plan_step("get_uuids", [["blkid"]]))
+    steps.append(plan_step("update_loader"))
+    steps.append(plan_step("update_fstab"))
+    if template.get("RaidSetup"):
+        steps.append(plan_step("write_mdadm_conf",
+                               [["mdadm", "--detail", "--scan"]]))
+    steps.append(plan_step("setup_machine_id", [machine_id_command(target)]))
+    steps.append(plan_step("add_users",
+                           [account_command(user)
+                            for user in template.get("Users", [])]))
+    steps.append(plan_step("post_install_packages",
+                           package_commands(template, target)))
+    for stage in SCRIPT_STAGES:
+        if template.get(stage):
+            steps.append(plan_step(
+                "post_chroot" if stage == "PostChroot" else "post_non_chroot",
+                [script_command(stage, script, target)
+                 for script in script_entries(template, stage)]))
+    steps.append(plan_step("remount_production",
+                           [["umount", "-R", target]] +
+                           target_mount_commands(template, target, True)))
+    steps.append(plan_step("cleanup",
+                           cleanup_commands(source, target)))
+    if scratch:
+        # The image is kept on the scratch partition, which has to exist
+        # before the image is fetched and is formatted once it is unused.
+        # The layout is checked against the disks first.
+        names = [step["step"] for step in steps]
+        steps.insert(names.index("check_layout") + 1,
+                     steps.pop(names.index("create_partitions")))
+        steps.append(plan_step("format_scratch",
+                               [command for command in
+                                filesystem_commands(template)
+                                if command[-1] == scratch]))
+    return {"version": PLAN_VERSION, "template": template, "steps": steps,
+            "memory": memory}
+
+
+def get_template_hash(template, *extra):
+    """Return a stable hash of the template, the planner version and extra
+    """
+    encoded = json.dumps([PLAN_VERSION, template] + list(extra),
+                         sort_keys=True)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def get_plan(template, cache_dir=PLAN_CACHE_DIR, fetch_key=request.urlopen):
+    """Return the install plan for template, using the plan cache if possible
+
+    The template is validated and its defaults, such as the target disk,
+    are resolved on every call. The plan is cached in cache_dir keyed by
+    the hash of the resolved template and the sizes of its disks, so a
+    disk found under another name or replaced is planned again. Ramdisk
+    installs also key it by the memory budget, which decides where the
+    plan keeps the source image. Without cache_dir the plan is built
+    without reading or writing the cache.
+
+    This function will raise an Exception on finding an error.
+    """
+    validate_template(template, fetch_key)
+    if not cache_dir:
+        return build_plan(template)
+    budget = None
+    if is_ram_backed(tempfile.gettempdir()):
+        budget = get_memory_budget(template) // MEMORY_BUCKET
+    disks = dict((part["disk"], get_disk_size(part["disk"]))
+                 for part in template["PartitionLayout"])
+    cache_file = os.path.join(cache_dir, "{}.json".format(
+        get_template_hash(template, budget, disks)))
+    try:
+        with open(cache_file, "r") as cached:
+            plan = json.load(cached)
+        if plan.get("version") == PLAN_VERSION:
+            return plan
+    except:
+        pass
+
+    plan = build_plan(template)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Runs sharing the cache must never read a partial plan
+        with tempfile.NamedTemporaryFile("w", dir=cache_dir,
+                                         delete=False) as cached:
+            json.dump(plan, cached)
+        os.replace(cached.name, cache_file)
     except:
-        raise Exception("Unable to add sudoer conf file for {}"
-                        .format(user["username"]))
+        # A read only cache only costs planning time on the next boot
+        pass
+    return plan
+
+
+# Functions executing each install plan step given the template, the
+# execution context and the step's commands with their placeholders
+# filled in
+PLAN_STEPS = {
+    "check_memory": lambda t, c, cmds: c.update(
+        memory_sampler=check_memory(c["memory"])),
+    "check_layout": lambda t, c, cmds: check_layout(t),
+    "get_source_image": lambda t, c, cmds: get_source_image(t, c["memory"]),
+    "create_partitions": lambda t, c, cmds: c.update(
+        reused=create_partitions(t, cmds)),
+    "create_raid": lambda t, c, cmds: create_raid(t, cmds),
+    "create_filesystems": lambda t, c, cmds: create_filesystems(
+        t, c.get("reused"), c["memory"].get("scratch"), c["source"], cmds),
+    "setup_source": lambda t, c, cmds: c.update(source=setup_source(
+        t, memory=c["memory"])),
+    "fetch_packages": lambda t, c, cmds: c.update(
+        packages=start_package_download(t, c["source"], cmds)),
+    "preflight": lambda t, c, cmds: preflight_check(t, c["source"]),
+    "setup_target": lambda t, c, cmds: c.update(target=setup_target(t, cmds)),
+    "tune_devices": lambda t, c, cmds: tune_devices(t, c["source"]),
+    "copy_files": lambda t, c, cmds: copy_source(t, c["source"], c["target"]),
+    "install_packages": lambda t, c, cmds: install_packages(
+        t, c["target"], c.get("packages"), cmds),
+    "start_writeback":
+        lambda t, c, cmds: c.update(writeback=start_writeback(c["target"])),
+    "get_uuids": lambda t, c, cmds: c.update(uuids=get_uuids(t)),
+    "write_lower": lambda t, c, cmds: write_lower(t, c["source"]),
+    "update_loader": lambda t, c, cmds: update_loader(
+        c["uuids"], c["target"], get_lower_partuuid(t)),
+    "update_fstab": lambda t, c, cmds: update_fstab(
+        c["uuids"], c["target"], bool(t.get("OverlayLower"))),
+    "write_mdadm_conf": lambda t, c, cmds: write_mdadm_conf(t, c["target"]),
+    "setup_machine_id": lambda t, c, cmds: setup_machine_id(c["target"],
+                                                            cmds[0]),
+    "add_users": lambda t, c, cmds: add_users(t, c["target"], cmds),
+    "post_install_packages":
+        lambda t, c, cmds: post_install_packages(t, c["target"], cmds),
+    "post_non_chroot": lambda t, c, cmds: run_post_non_chroot(
+        t, c["target"], cmds),
+    "post_chroot": lambda t, c, cmds: run_post_chroot(t, c["target"], cmds),
+    "remount_production": lambda t, c, cmds: remount_production(
+        t, c["target"], c.get("writeback"), cmds),
+    "cleanup": lambda t, c, cmds: cleanup(
+        c["source"], c["target"],
+        shared_source=c.get("shared_source", False), background=True,
+        commands=cmds),
+    "format_scratch": lambda t, c, cmds: format_scratch(
+        t, c["memory"]["scratch"], cmds)
+}
+
+
+def resolve_step(step, context):
+    """Return the commands of a plan step with the placeholders filled in
+
+    The source and target folders are taken from the context. The run's
+    scratch folder and nbd device, unless the context has them, are only
+    allocated once a step uses them.
+    """
+    used = set(re.findall(r"\{(\w+)\}", " ".join(
+        arg for command in step["commands"] for arg in command)))
+    values = {"source": context["source"], "target": context["target"]}
+    if "run" in used:
+        values["run"] = context.get("run") or get_run_dir()
+    if "device" in used:
+        values["device"] = context.get("device") or get_nbd_device()
+    return resolve_commands(step["commands"], **values)
 
 
-def add_users(template, target_dir):
-    """Create user accounts with no password one time logins
+def run_plan_step(step, template, context):
+    """Execute a single step of an install plan
 
-    Will setup sudo and ssh key access if specified in template.
+    This function will raise an Exception on finding an error.
     """
-    users = template.get("Users")
-    if not users:
-        return
+    if step["step"] not in PLAN_STEPS:
+        raise Exception("Unknown install plan step {}".format(step["step"]))
+    PLAN_STEPS[step["step"]](template, context, resolve_step(step, context))
 
-    for user in users:
-        create_account(user, target_dir)
-        if user.get("key"):
-            add_user_key(user, target_dir)
-        if user.get("sudo"):
-            setup_sudo(user, target_dir)
 
+def noop_plan_step(step, _, context):
+    """Resolve a plan step as run_plan_step does without executing anything
 
-def post_install_packages(template, target_dir):
-    """Install packages after system installation completed
+    The resolved commands are recorded in the context, which lets the
+    orchestration overhead be measured on its own.
     """
-    packages = template.get("PostInstallPackages")
-    if not packages:
-        return
-
-    for package in packages:
-        if package["packagemanager"] == "zypper":
-            if package["type"] == "group":
-                command = "zypper --root {0} -n in -t pattern {1}".format(target_dir, package["name"])
-            else:
-                command = "zypper --root {0} -n in {1}".format(target_dir, package["name"])
-        run_command(command)
+    if step["step"] not in PLAN_STEPS:
+        raise Exception("Unknown install plan step {}".format(step["step"]))
+    context["source"] = context["source"] or "/tmp/ister-noop-source"
+    context["target"] = context["target"] or "/tmp/ister-noop-target"
+    context.setdefault("run", "/tmp/ister-noop-run")
+    context.setdefault("device", "/dev/nbd0")
+    context.setdefault("commands", []).extend(resolve_step(step, context))
 
 
-def cleanup(source_dir, target_dir, raise_exception=True):
-    """Unmount and remove temporary files
+def execute_plan(plan, executor=run_plan_step, context=None):
+    """Run every step of an install plan in order
 
-    This function may raise an Exception on finding an error.
+    Returns the execution context, which records the source and target
+    folders used for the install. Devices tuned for the install are put
+    back as they were even if a step fails.
     """
-    run_command("umount -R {}".format(target_dir),
-                raise_exception=raise_exception)
-    run_command("umount -R {}".format(source_dir),
-                raise_exception=raise_exception)
-    run_command("rm -fr {}".format(target_dir))
-    run_command("rm -fr {}".format(source_dir))
-    run_command("qemu-nbd -d /dev/nbd0", raise_exception=raise_exception)
+    template = plan["template"]
+    context = context or {"source": None, "target": None}
+    context.setdefault("memory", plan.get("memory", {"path": "tmp"}))
+    INSTALL_REPORT.setdefault("start", time.time())
+    try:
+        for step in plan["steps"]:
+            executor(step, template, context)
+    finally:
+        restore_io_tuning()
+        if context.get("memory_sampler"):
+            sampler, stop = context.pop("memory_sampler")
+            stop.set()
+            sampler.join()
+    return context
 
 
-def do_install(template):
-    """Create partitions, filesystems, and copy files for install
+def benchmark_plan(plan, rounds=100):
+    """Return the average seconds spent orchestrating plan with no work done
     """
-    create_partitions(template)
-    create_filesystems(template)
-    (source_dir, target_dir) = setup_mounts(template)
-    copy_files(source_dir, target_dir)
-    uuids = get_uuids(template)
-    update_loader(uuids, target_dir)
-    update_fstab(uuids, target_dir)
-    setup_machine_id(target_dir)
-    add_users(template, target_dir)
-    post_install_packages(template, target_dir)
-    cleanup(source_dir, target_dir)
+    start = time.time()
+    for _ in range(rounds):
+        execute_plan(plan, noop_plan_step)
+    return (time.time() - start) / rounds
 
 
 def get_template_location(path):
@@ -576,7 +3656,7 @@ def validate_layout(template):
     disk_to_parts = {}
     parts_to_size = {}
     has_efi = False
-    accepted_ptypes = ["EFI", "linux", "swap"]
+    accepted_ptypes = ["EFI", "linux", "swap", "raid"]
     accepted_sizes = ["M", "G", "T"]
 
     for layout in template["PartitionLayout"]:
@@ -603,12 +3683,11 @@ def validate_layout(template):
         if ptype == "EFI":
             has_efi = True
 
-        disk_part = disk + str(part)
-        if disk_to_parts.get(disk):
-            if part in disk_to_parts[disk]:
-                raise Exception("Duplicate disk {0} and partition {1} entry \
-                in PartitionLayout".format(disk, part))
-            disk_to_parts[disk].append(part)
+        disk_part = get_device_name(disk, part)
+        if part in disk_to_parts.setdefault(disk, []):
+            raise Exception("Duplicate disk {0} and partition {1} entry \
+            in PartitionLayout".format(disk, part))
+        disk_to_parts[disk].append(part)
         parts_to_size[disk_part] = size
 
     if not has_efi:
@@ -617,7 +3696,8 @@ def validate_layout(template):
     for key in disk_to_parts:
         parts = sorted(disk_to_parts[key])
         for part in parts:
-            if parts_to_size[key + part] == "rest" and part != parts[-1]:
+            if parts_to_size[get_device_name(key, part)] == "rest" and \
+               part != parts[-1]:
                 raise Exception("Partition other than last uses rest of \
                 disk {0} partition {1}".format(key, part))
 
@@ -634,25 +3714,34 @@ def validate_fstypes(template, parts_to_size):
     partition_fstypes = set()
     accepted_fstypes = ["ext2", "ext3", "ext4", "vfat", "btrfs", "xfs", "swap"]
 
-    for fstype in template["FilesystemTypes"]:
-        disk = fstype.get("disk")
-        part = fstype.get("partition")
-        fstype = fstype.get("type")
-        if not disk or not part or not type:
+    for entry in template["FilesystemTypes"]:
+        disk = entry.get("disk")
+        part = entry.get("partition")
+        fstype = entry.get("type")
+        if not disk or not fstype or (not part and disk not in parts_to_size):
             raise Exception("Invalid FilesystemTypes section: {}"
-                            .format(fstype))
+                            .format(entry))
 
         if fstype not in accepted_fstypes:
             raise Exception("Invalid filesystem type {0}, supported types \
             are: {1}".format(fstype, accepted_fstypes))
 
-        disk_part = disk + str(part)
+        if not isinstance(entry.get("wipe", False), bool):
+            raise Exception("Invalid wipe in FilesystemTypes section: {}"
+                            .format(entry))
+
+        if not is_size(entry.get("stripe_unit", "1K")) or \
+           not isinstance(entry.get("stripe_width", 1), int):
+            raise Exception("Invalid stripe_unit or stripe_width in \
+            FilesystemTypes section: {}".format(entry))
+
+        disk_part = get_device_name(disk, part)
         if disk_part in partition_fstypes:
             raise Exception("Duplicate disk {0} and partition {1} entry in \
             FilesystemTypes".format(disk, part))
         if disk_part not in parts_to_size:
             raise Exception("disk {0} partition {1} used in FilesystemTypes \
-            not found in PartitionLayout".format(disk, part))
+            not found in PartitionLayout or RaidSetup".format(disk, part))
         partition_fstypes.add(disk_part)
 
     return partition_fstypes
@@ -668,11 +3757,12 @@ def validate_partition_mounts(template, partition_fstypes):
         disk = pmount.get("disk")
         part = pmount.get("partition")
         mount = pmount.get("mount")
-        if not disk or not part or not mount:
+        if not disk or not mount or (not part and
+                                     disk not in partition_fstypes):
             raise Exception("Invalid PartitionMountPoints section: {}"
                             .format(pmount))
 
-        disk_part = disk + str(part)
+        disk_part = get_device_name(disk, part)
         if disk_part in partition_mounts:
             raise Exception("Duplicate disk {0} and partition {1} entry in \
             PartitionMountPoints".format(disk, part))
@@ -683,6 +3773,84 @@ def validate_partition_mounts(template, partition_fstypes):
         partition_mounts.add(disk_part)
 
 
+def validate_overlay(template):
+    """Validate the OverlayLower partition is sane
+
+    This function will raise an Exception on finding an error.
+    """
+    lower = template["OverlayLower"]
+    if not isinstance(lower, dict) or not lower.get("disk") or \
+       not lower.get("partition"):
+        raise Exception("Invalid OverlayLower: {}".format(lower))
+    name = get_device_name(lower["disk"], lower["partition"])
+    if name not in [get_device_name(part["disk"], part["partition"])
+                    for part in template["PartitionLayout"]
+                    if part["type"] == "linux"]:
+        raise Exception("OverlayLower {} is not a linux partition in "
+                        "PartitionLayout".format(name))
+    for section in ["FilesystemTypes", "PartitionMountPoints"]:
+        if name in [get_device_name(part["disk"], part.get("partition"))
+                    for part in template[section]]:
+            raise Exception("OverlayLower {0} can't be in {1}"
+                            .format(name, section))
+    if "/" not in [part["mount"] for part in
+                   template["PartitionMountPoints"]]:
+        raise Exception("OverlayLower needs a / mount point for the upper "
+                        "layer")
+
+
+def is_size(size):
+    """Return True if size is a size string such as 64K or 512M
+    """
+    return isinstance(size, str) and re.match(r"\d+[KMGT]$", size)
+
+
+def validate_raid(template, parts_to_size):
+    """Validate RAID arrays are sane
+
+    Adds the arrays to parts_to_size so filesystems and mount points can
+    use them.
+
+    This function will raise an Exception on finding an error.
+    """
+    if template.get("RaidSupport") != "md":
+        raise Exception("Invalid RaidSupport {}, supported types are: md"
+                        .format(template.get("RaidSupport")))
+    if not template.get("RaidSetup"):
+        raise Exception("Invalid template, missing RaidSetup")
+    members = set()
+    for array in template["RaidSetup"]:
+        raid = array.get("raid")
+        rdisk = array.get("rdisk")
+        rparts = array.get("rpartitions")
+        if not raid or not rdisk or not rparts:
+            raise Exception("Invalid RaidSetup section: {}".format(array))
+        if raid not in RAID_LEVELS:
+            raise Exception("Invalid raid type {0}, supported types are: \
+            {1}".format(raid, sorted(RAID_LEVELS)))
+        if not re.match(r"md\d+$", rdisk) or rdisk in parts_to_size:
+            raise Exception("Invalid or duplicate rdisk {}".format(rdisk))
+        if len(rparts) < 2:
+            raise Exception("RAID array {} needs at least two partitions"
+                            .format(rdisk))
+        for part in rparts:
+            if part not in parts_to_size or part in members:
+                raise Exception("RAID partition {0} of {1} is not in \
+                PartitionLayout or is used twice".format(part, rdisk))
+            members.add(part)
+        if not is_size(array.get("chunk", RAID_CHUNK)):
+            raise Exception("Invalid chunk size for {}".format(rdisk))
+        if array.get("resync", "defer") not in ["defer", "skip", "now"]:
+            raise Exception("Invalid resync option {}, supported options \
+            are: defer, skip, now".format(array["resync"]))
+        parts_to_size[rdisk] = "raid"
+    for fstype in template["FilesystemTypes"]:
+        if get_device_name(fstype.get("disk", ""), fstype.get(
+                "partition")) in members:
+            raise Exception("RAID partition {} can't have a filesystem"
+                            .format(fstype))
+
+
 def validate_disk_template(template):
     """Attempt to verify all disk layout related information is sane
 
@@ -696,21 +3864,28 @@ def validate_disk_template(template):
         raise Exception("Invalid template, missing PartitionMountPoints")
 
     parts_to_size = validate_layout(template)
+    if template.get("RaidSupport") or template.get("RaidSetup"):
+        validate_raid(template, parts_to_size)
     partition_fstypes = validate_fstypes(template, parts_to_size)
     validate_partition_mounts(template, partition_fstypes)
+    if template.get("OverlayLower"):
+        validate_overlay(template)
 
 
-def validate_user_template(users):
+def validate_user_template(users, fetch_key=request.urlopen):
     """Attempt to verify all user related information is sane
 
     Also cache the users public keys, so we fail early if the key isn't
-    found.
+    found. fetch_key is given each key URL.
 
     This function will raise an Exception on finding an error.
     """
     max_uid = ctypes.c_uint32(-1).value
     uids = {}
     unames = {}
+    if not isinstance(users, list) or \
+       [user for user in users if not isinstance(user, dict)]:
+        raise Exception("Users must be a list of user entries")
     for user in users:
         name = user.get("username")
         uid = user.get("uid")
@@ -732,7 +3907,7 @@ def validate_user_template(users):
             uids[uid] = uid
 
         if user.get("key"):
-            request.urlopen(user["key"])
+            fetch_key(user["key"])
 
         if sudo:
             if sudo != "password":
@@ -742,6 +3917,8 @@ def validate_user_template(users):
 def validate_post_install_packages(post_packages):
     """Attempt to verify all package related information is sane
 
+    Used for both InstallPackages and PostInstallPackages.
+
     This function will raise an Exception on finding an error.
     """
     accepted_package_managers = ["zypper"]
@@ -770,16 +3947,121 @@ def validate_post_install_packages(post_packages):
             are: {1}".format(package_type, accepted_package_types))
 
 
-def validate_template(template):
-    """Attempt to verify template is sane
+def validate_scripts(stage, scripts, check_files=True):
+    """Attempt to verify the scripts of a PostNonChroot or PostChroot stage
+
+    The script files are only looked for with check_files, as they are
+    local to the installer.
+
+    This function will raise an Exception on finding an error.
+    """
+    if not isinstance(scripts, list):
+        raise Exception("{} must be a list of scripts".format(stage))
+    for script in script_entries({stage: scripts}, stage):
+        if not isinstance(script.get("script"), str):
+            raise Exception("Missing script for {0} entry: {1}"
+                            .format(stage, script))
+        if check_files and not os.path.isfile(script["script"]):
+            raise Exception("{0} script {1} not found"
+                            .format(stage, script["script"]))
+        timeout = script.get("timeout", COMMAND_TIMEOUT)
+        if not isinstance(timeout, (int, float)) or timeout <= 0:
+            raise Exception("Invalid timeout {0} for {1}"
+                            .format(timeout, script["script"]))
+        if not isinstance(script.get("group", ""), (str, int)):
+            raise Exception("Invalid group for {0} script {1}"
+                            .format(stage, script["script"]))
+
+
+def validate_copy_strategy(template):
+    """Attempt to verify the CopyStrategy override is sane
+
+    This function will raise an Exception on finding an error.
+    """
+    if template["CopyStrategy"] not in COPY_STRATEGIES:
+        raise Exception("Invalid CopyStrategy {0}, supported strategies \
+        are: {1}".format(template["CopyStrategy"], COPY_STRATEGIES))
+    if template["CopyStrategy"] == "image" and \
+       get_image_format(template) != "disk":
+        raise Exception("CopyStrategy image needs a disk image source")
+
+
+def validate_mirrors(template):
+    """Attempt to verify image mirror settings are sane
+
+    This function will raise an Exception on finding an error.
+    """
+    mirrors = template["ImageSourceMirrors"]
+    if not isinstance(mirrors, list) or \
+       [url for url in mirrors if not isinstance(url, str)]:
+        raise Exception("ImageSourceMirrors must be a list of URIs")
+    if template["ImageSourceType"] != "remote":
+        raise Exception("ImageSourceMirrors requires a remote ImageSourceType")
+    throughput = template.get("MirrorMinThroughput", MIRROR_MIN_THROUGHPUT)
+    if not isinstance(throughput, int) or throughput < 0:
+        raise Exception("Invalid MirrorMinThroughput {}".format(throughput))
+
+
+def validate_io_tuning(tuning):
+    """Attempt to verify I/O tuning overrides are sane
+
+    This function will raise an Exception on finding an error.
+    """
+    if not isinstance(tuning, dict):
+        raise Exception("IoTuning must be false or map device classes to \
+        queue settings")
+    for device_class, settings in tuning.items():
+        if device_class not in IO_PROFILES:
+            raise Exception("Invalid IoTuning device class {0}, supported \
+            classes are: {1}".format(device_class, sorted(IO_PROFILES)))
+        for setting in settings:
+            if setting not in IO_SETTINGS:
+                raise Exception("Invalid IoTuning setting {0}, supported \
+                settings are: {1}".format(setting, IO_SETTINGS))
+
+
+def validate_command_timeouts(timeouts):
+    """Attempt to verify command timeout overrides are sane
+
+    This function will raise an Exception on finding an error.
+    """
+    if not isinstance(timeouts, dict):
+        raise Exception("CommandTimeouts must map program names to seconds")
+    for program, timeout in timeouts.items():
+        if not isinstance(timeout, (int, float)) or timeout <= 0:
+            raise Exception("Invalid timeout {0} for {1}"
+                            .format(timeout, program))
+
+
+def validate_source_template(template):
+    """Attempt to verify the image source settings are sane
 
     This function will raise an Exception on finding an error.
     """
-    disk_info = False
     if not template.get("ImageSourceType"):
         raise Exception("Missing ImageSourceType field")
     if not template.get("ImageSourceLocation"):
         raise Exception("Missing ImageSourceLocation field")
+
+    if template.get("ImageSourceFormat") and \
+       template["ImageSourceFormat"] not in ["disk", "squashfs", "erofs"]:
+        raise Exception("Invalid ImageSourceFormat {}, supported formats \
+        are: disk, squashfs, erofs".format(template["ImageSourceFormat"]))
+
+    if template.get("ImageSourceMirrors"):
+        validate_mirrors(template)
+
+    if template.get("CopyStrategy"):
+        validate_copy_strategy(template)
+
+
+def validate_layout_template(template, insert_defaults=True):
+    """Attempt to verify the disk layout, inserting the default one if the
+    template has none and insert_defaults is set
+
+    This function will raise an Exception on finding an error.
+    """
+    disk_info = False
     if template.get("ParitionLayout"):
         disk_info = True
     if template.get("FilesystemTypes"):
@@ -789,24 +4071,704 @@ def validate_template(template):
 
     if disk_info:
         validate_disk_template(template)
-    else:
+    elif insert_defaults:
         insert_fs_defaults(template)
 
+
+def validate_flag(template, key):
+    """Attempt to verify the key option of template is true or false
+
+    This function will raise an Exception on finding an error.
+    """
+    if not isinstance(template.get(key, False), bool):
+        raise Exception("{} must be true or false".format(key))
+
+
+def validate_size_option(template, key):
+    """Attempt to verify the key option of template is a size such as 64K
+
+    This function will raise an Exception on finding an error.
+    """
+    if not is_size(template.get(key, "1M")):
+        raise Exception("Invalid {0} {1}".format(key, template[key]))
+
+
+def validate_install_mount_options(overrides):
+    """Attempt to verify install mount option overrides are sane
+
+    This function will raise an Exception on finding an error.
+    """
+    if not isinstance(overrides, dict) or \
+       [v for v in overrides.values() if not isinstance(v, str)]:
+        raise Exception("InstallMountOptions must be false or map \
+        filesystem types to mount options")
+
+
+def validate_metrics_location(location):
+    """Attempt to verify the MetricsLocation URI is supported
+
+    This function will raise an Exception on finding an error.
+    """
+    if location.find("file://") != 0 and location.find("unix://") != 0:
+        raise Exception("Invalid MetricsLocation {}, must be a file:// \
+        or unix:// URI".format(location))
+
+
+def template_checks(template, fetch_key=request.urlopen,
+                    insert_defaults=True):
+    """Return the checks of template in the order they are run
+
+    Each check raises an Exception on the first error it finds in its
+    own part of the template, independently of the others.
+    """
+    checks = [lambda: validate_source_template(template),
+              lambda: validate_layout_template(template, insert_defaults)]
     if template.get("Users"):
-        validate_user_template(template["Users"])
+        checks.append(lambda: validate_user_template(template["Users"],
+                                                     fetch_key))
+    for section in ["InstallPackages", "PostInstallPackages"]:
+        if template.get(section):
+            checks.append(lambda section=section:
+                          validate_post_install_packages(template[section]))
+    for stage in SCRIPT_STAGES:
+        if template.get(stage):
+            checks.append(lambda stage=stage: validate_scripts(
+                stage, template[stage], insert_defaults))
+    for key in ["ReuseLayout", "LazySource", "DropCopyCache"]:
+        checks.append(lambda key=key: validate_flag(template, key))
+    for key in ["MemoryBudget", "PartitionAlignment"]:
+        checks.append(lambda key=key: validate_size_option(template, key))
+    if template.get("InstallMountOptions"):
+        checks.append(lambda: validate_install_mount_options(
+            template["InstallMountOptions"]))
+    if template.get("IoTuning"):
+        checks.append(lambda: validate_io_tuning(template["IoTuning"]))
+    if template.get("CommandTimeouts"):
+        checks.append(lambda: validate_command_timeouts(
+            template["CommandTimeouts"]))
+    if template.get("MetricsLocation"):
+        checks.append(lambda: validate_metrics_location(
+            template["MetricsLocation"]))
+    return checks
+
+
+def validate_template(template, fetch_key=request.urlopen):
+    """Attempt to verify template is sane
 
-    if template.get("PostInstallPackages"):
-        validate_post_install_packages(template["PostInstallPackages"])
-    return
+    fetch_key is given the URL of each user's key.
+
+    This function will raise an Exception on finding an error.
+    """
+    for check in template_checks(template, fetch_key):
+        check()
+
+
+def template_urls(template):
+    """Return the URLs a template refers to
+
+    These are the users' key URLs, and the image with its mirrors for a
+    remote source.
+    """
+    users = template.get("Users")
+    urls = [user["key"] for user in (users if isinstance(users, list)
+                                     else [])
+            if isinstance(user, dict) and isinstance(user.get("key"), str)]
+    if template.get("ImageSourceType") == "remote":
+        mirrors = template.get("ImageSourceMirrors")
+        for url in [template.get("ImageSourceLocation")] + \
+                (mirrors if isinstance(mirrors, list) else []):
+            if isinstance(url, str):
+                urls.append(url)
+    return urls
+
+
+def check_url(url, timeout=VALIDATE_URL_TIMEOUT):
+    """Return why url can't be fetched, None if it can
+
+    Only the first byte is requested.
+    """
+    try:
+        with request.urlopen(request.Request(url,
+                                             headers={"Range": "bytes=0-0"}),
+                             timeout=timeout) as response:
+            response.read(1)
+    except Exception as exep:
+        return "Unable to fetch {0}: {1}".format(url, exep)
+    return None
+
+
+def check_urls(urls):
+    """Check each distinct URL once, all at once
+
+    Returns a map of the URLs to why they can't be fetched, None for
+    those that can.
+    """
+    urls = sorted(set(urls))
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(min(len(urls), VALIDATE_WORKERS), 1)) as pool:
+        return dict(zip(urls, pool.map(check_url, urls)))
+
+
+def template_errors(template, url_errors):
+    """Return every error found in template without side effects
+
+    Disks aren't probed for the default layout and URLs are looked up in
+    url_errors, as returned by check_urls, instead of being fetched.
+    """
+    if not isinstance(template, dict):
+        return ["Template must be a JSON object"]
+
+    def cached_url(url):
+        """Raise the cached error of url"""
+        if url_errors.get(url):
+            raise Exception(url_errors[url])
+
+    errors = []
+    for check in template_checks(template, cached_url, False):
+        try:
+            check()
+        except Exception as exep:
+            errors.append(str(exep))
+    for url in template_urls(template):
+        if url_errors.get(url) and url_errors[url] not in errors:
+            errors.append(url_errors[url])
+    return errors
+
+
+def find_templates(paths):
+    """Return the template files in paths, folders searched for *.json
+    """
+    files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+        for root, dirs, names in os.walk(path):
+            dirs.sort()
+            files.extend(os.path.join(root, name) for name in sorted(names)
+                         if name.endswith(".json"))
+    return files
+
+
+def validate_templates(paths):
+    """Validate many template files in one pass
 
+    Every URL the templates refer to is checked once, concurrently,
+    before the templates are checked. Returns a map of each template
+    file to the list of errors found in it.
+    """
+    templates = {}
+    errors = {}
+    for path in find_templates(paths):
+        try:
+            with open(path, "r") as tfile:
+                templates[path] = json.load(tfile)
+        except (OSError, ValueError) as exep:
+            errors[path] = ["Unable to load template: {}".format(exep)]
+    url_errors = check_urls([url for template in templates.values()
+                             if isinstance(template, dict)
+                             for url in template_urls(template)])
+    for path, template in templates.items():
+        errors[path] = template_errors(template, url_errors)
+    return errors
+
+
+def show_validation(paths):
+    """Print the errors found in each template, returns True if all are
+    valid
+    """
+    errors = validate_templates(paths)
+    for path in sorted(errors):
+        if not errors[path]:
+            print("{}: valid".format(path))
+        for error in errors[path]:
+            print("{0}: {1}".format(path, " ".join(error.split())))
+    return not [path for path in errors if errors[path]]
+
+
+def probe_mirror(url, timeout=MIRROR_PROBE_TIMEOUT):
+    """Return the seconds url takes to return its first byte
+
+    Returns None if the mirror doesn't answer within timeout.
+    """
+    start = time.time()
+    try:
+        with request.urlopen(request.Request(url,
+                                             headers={"Range": "bytes=0-0"}),
+                             timeout=timeout) as response:
+            response.read(1)
+    except Exception:
+        return None
+    return time.time() - start
+
+
+def rank_mirrors(mirrors):
+    """Return the mirrors fastest first
+
+    Mirrors that didn't answer the probe in time are kept at the end in
+    their original order, as a slow server is better than none. A single
+    mirror isn't probed.
+    """
+    if len(mirrors) < 2:
+        return list(mirrors)
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(mirrors)) as pool:
+        latencies = list(pool.map(probe_mirror, mirrors))
+    write_metric("mirror-probe", latencies=dict(zip(mirrors, latencies)))
+    ranked = sorted((latency is None, latency or 0, index, url)
+                    for index, (url, latency)
+                    in enumerate(zip(mirrors, latencies)))
+    return [url for _, _, _, url in ranked]
+
+
+def fetch_from_mirror(url, ofile, stage, min_throughput, window):
+    """Append the rest of the image at url to ofile
+
+    The download resumes from the current end of ofile using a range
+    request. If min_throughput is set, the download is abandoned once
+    fewer than min_throughput bytes per second arrive over window seconds.
+    Returns False if it was abandoned, True once the image is complete.
+
+    This function will raise an Exception on finding an error.
+    """
+    offset = ofile.tell()
+    headers = {"Range": "bytes={}-".format(offset)} if offset else {}
+    with request.urlopen(request.Request(url, headers=headers),
+                         timeout=window) as response:
+        if offset and response.status != 206:
+            # The mirror ignored the range so start over
+            ofile.seek(0)
+            ofile.truncate()
+            offset = 0
+        if response.headers.get("Content-Length"):
+            stage.update(total_bytes=offset +
+                         int(response.headers["Content-Length"]))
+        window_start = time.time()
+        window_bytes = 0
+        for chunk in iter(lambda: response.read(64 * 1024), b""):
+            ofile.write(chunk)
+            window_bytes += len(chunk)
+            stage.update(done_bytes=ofile.tell())
+            elapsed = time.time() - window_start
+            if elapsed < window:
+                continue
+            if min_throughput and window_bytes / elapsed < min_throughput:
+                return False
+            window_start = time.time()
+            window_bytes = 0
+    return True
+
+
+class XzWriter(object):
+    """Class decompressing the xz stream written to it into a file
+
+    Lets a download be decompressed as it arrives so the compressed image
+    is never stored. The stream can't be rewound, so the download can't
+    restart on a mirror that ignores range requests.
+    """
+    def __init__(self, dest):
+        """Start xz writing to dest
+        """
+        self.dest = open(dest, "wb")
+        self.process = subprocess.Popen(["xz", "-dc"], stdin=subprocess.PIPE,
+                                        stdout=self.dest)
+        self.written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Wait for xz to finish
+
+        This function will raise an Exception if xz fails after a complete
+        download.
+        """
+        self.process.stdin.close()
+        returncode = self.process.wait()
+        self.dest.close()
+        if exc_type is None and returncode != 0:
+            raise Exception("Failed to extract source image")
+
+    def write(self, data):
+        """Feed data to xz
+        """
+        self.process.stdin.write(data)
+        self.written += len(data)
+
+    def tell(self):
+        """Return the number of compressed bytes written
+        """
+        return self.written
+
+    def seek(self, _):
+        """Refuse to rewind the stream
+
+        This function will always raise an Exception.
+        """
+        raise Exception("a streamed download can't restart")
 
-def get_source_image(template):
+
+def download_image(mirrors, dest, min_throughput=MIRROR_MIN_THROUGHPUT,
+                   window=MIRROR_WINDOW, decompress=False):
+    """Download the image from the first of mirrors that can deliver it
+
+    A mirror that fails or drops below min_throughput is abandoned and
+    the download continues from the same offset on the next mirror. The
+    last mirror is used regardless of its throughput, and if it fails
+    the download resumes on the mirrors abandoned for being slow, this
+    time without a throughput limit. With decompress the xz image is
+    decompressed to dest as it arrives.
+
+    This function will raise an Exception if every mirror fails.
+    """
+    errors = []
+    attempts = [(url, None if index == len(mirrors) - 1 else min_throughput)
+                for index, url in enumerate(mirrors)]
+    with ProgressStage("download") as stage, \
+            (XzWriter(dest) if decompress else open(dest, "wb")) as ofile:
+        for switches, (url, limit) in enumerate(attempts):
+            try:
+                complete = fetch_from_mirror(url, ofile, stage, limit,
+                                             window)
+            except Exception as exep:
+                errors.append("{0}: {1}".format(url, exep))
+                write_metric("mirror-switch", mirror=url,
+                             offset=ofile.tell(), reason=str(exep))
+                continue
+            if not complete:
+                # A slow mirror is better than none
+                attempts.append((url, None))
+                write_metric("mirror-switch", mirror=url,
+                             offset=ofile.tell(),
+                             reason="throughput below {}/s".format(
+                                 format_bytes(limit)))
+                continue
+            INSTALL_REPORT["mirror"] = {"url": url, "switches": switches}
+            return
+    raise Exception("Unable to download image from any mirror: {}"
+                    .format(", ".join(errors)))
+
+
+def get_download_dest(template, memory, run_dir):
+    """Return where the image is downloaded to in run_dir and whether it
+    is decompressed as it arrives
+
+    The memory path chosen by select_memory_path decides whether an xz
+    disk image is decompressed as it arrives and whether it is stored on
+    a scratch device. A lazy source downloaded after all takes the
+    memory budgeted for its cache. Images kept as they are named after
+    what their magic number shows.
+    """
+    location = template["ImageSourceLocation"]
+    xz = location.endswith(".xz") or is_remote_xz(location)
+    decompress = memory["path"] in ["stream", "scratch"] and xz and \
+        get_image_format(template) == "disk"
+    if memory["path"] == "scratch":
+        return memory["scratch"], decompress
+    if decompress:
+        return os.path.join(run_dir, "source"), decompress
+    return os.path.join(run_dir, "image.xz" if xz else "image"), decompress
+
+
+def get_source_image(template, memory=None):
     """Download install source image
 
-    If download is successful, update ImageSourceLocation to be the local file.
+    The image is fetched from the fastest responding of
+    ImageSourceLocation and ImageSourceMirrors to the place
+    get_download_dest picks. If download is successful, update
+    ImageSourceLocation to be the local file.
+    """
+    dest, decompress = get_download_dest(template, memory or {"path": "tmp"},
+                                         get_run_dir())
+    mirrors = [template["ImageSourceLocation"]] + \
+        template.get("ImageSourceMirrors", [])
+    download_image(rank_mirrors(mirrors), dest,
+                   template.get("MirrorMinThroughput",
+                                MIRROR_MIN_THROUGHPUT), decompress=decompress)
+    template["ImageSourceLocation"] = "file://{}".format(dest)
+    template["ImageSourceType"] = "local"
+
+
+def probe_remote_image(url):
+    """Return whether the image at url is xz compressed and served by range
+
+    The first bytes of the image are fetched once with a range request.
+    An image that can't be probed is assumed to be compressed, so it is
+    downloaded as before.
+    """
+    if url not in REMOTE_PROBES:
+        try:
+            with request.urlopen(request.Request(
+                    url, headers={"Range": "bytes=0-5"}),
+                                 timeout=MIRROR_PROBE_TIMEOUT) as response:
+                REMOTE_PROBES[url] = {
+                    "xz": response.read(6) == b"\xfd7zXZ\x00",
+                    "ranges": response.status == 206}
+        except Exception:
+            REMOTE_PROBES[url] = {"xz": True, "ranges": False}
+    return REMOTE_PROBES[url]
+
+
+def is_remote_xz(url):
+    """Return True unless the image at url is known not to be xz compressed
+    """
+    return probe_remote_image(url)["xz"]
+
+
+def is_lazy_source(template):
+    """Return True if the remote source is read on demand, not downloaded
+
+    Uncompressed disk images and squashfs or erofs images, which can be
+    read at any offset, are served lazily unless LazySource is false or
+    their server ignores range requests. xz images, told apart by their
+    magic number, have to be downloaded and decompressed in full.
+    """
+    if template["ImageSourceType"] != "remote" or \
+       not template.get("LazySource", True) or \
+       template["ImageSourceLocation"].endswith(".xz"):
+        return False
+    probe = probe_remote_image(template["ImageSourceLocation"])
+    return probe["ranges"] and not probe["xz"]
+
+
+class HttpBlockSource(object):
+    """Class reading a remote image on demand with HTTP range requests
+
+    Fetched chunks are kept in a sparse local cache file so nothing is
+    downloaded twice. Each miss fetches whole LAZY_CHUNK chunks, doubling
+    up to LAZY_READ_AHEAD bytes while the misses are sequential. A
+    mirror that fails is moved to the back of the list. The cache may be
+    a scratch block device, which is left in place when closed.
+    """
+    def __init__(self, urls, cache_file):
+        """Find the image size and create the cache file
+
+        This function will raise an Exception on finding an error.
+        """
+        self.urls = list(urls)
+        self.size = self.get_size()
+        self.chunks = (self.size + LAZY_CHUNK - 1) // LAZY_CHUNK
+        self.cache_file = cache_file
+        self.cache = open(cache_file, "w+b")
+        if not cache_file.startswith("/dev/"):
+            self.cache.truncate(self.size)
+        self.cached = set()
+        self.read_ahead = LAZY_CHUNK
+        self.next_chunk = None
+        self.fetched = 0
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def get_size(self):
+        """Return the image size from a one byte range request
+
+        This function will raise an Exception if no mirror serves ranges.
+        """
+        errors = []
+        for url in self.urls:
+            try:
+                with request.urlopen(request.Request(
+                        url, headers={"Range": "bytes=0-0"}),
+                                     timeout=LAZY_TIMEOUT) as response:
+                    response.read()
+                    if response.status != 206:
+                        raise Exception("range requests not supported")
+                    return int(response.headers["Content-Range"]
+                               .split("/")[1])
+            except Exception as exep:
+                errors.append("{0}: {1}".format(url, exep))
+        raise Exception("Unable to read image lazily: {}"
+                        .format(", ".join(errors)))
+
+    def fetch(self, first, count):
+        """Download count chunks from chunk first into the cache
+
+        This function will raise an Exception if every mirror fails.
+        """
+        start = first * LAZY_CHUNK
+        end = min((first + count) * LAZY_CHUNK, self.size) - 1
+        errors = []
+        for url in list(self.urls):
+            try:
+                with request.urlopen(request.Request(
+                        url, headers={"Range": "bytes={0}-{1}"
+                                               .format(start, end)}),
+                                     timeout=LAZY_TIMEOUT) as response:
+                    data = response.read()
+                if response.status != 206 or len(data) != end - start + 1:
+                    raise Exception("bad range reply")
+            except Exception as exep:
+                errors.append("{0}: {1}".format(url, exep))
+                self.urls.remove(url)
+                self.urls.append(url)
+                continue
+            self.cache.seek(start)
+            self.cache.write(data)
+            self.cached.update(range(first, first + count))
+            self.fetched += len(data)
+            self.requests += 1
+            return
+        raise Exception("Unable to read image from any mirror: {}"
+                        .format(", ".join(errors)))
+
+    def read(self, offset, length):
+        """Return length bytes of the image from offset
+
+        This function will raise an Exception on finding an error.
+        """
+        with self.lock:
+            last = min((offset + length - 1) // LAZY_CHUNK, self.chunks - 1)
+            for chunk in range(offset // LAZY_CHUNK, last + 1):
+                if chunk in self.cached:
+                    continue
+                if chunk == self.next_chunk:
+                    self.read_ahead = min(self.read_ahead * 2,
+                                          LAZY_READ_AHEAD)
+                else:
+                    self.read_ahead = LAZY_CHUNK
+                wanted = min(max(self.read_ahead // LAZY_CHUNK,
+                                 last - chunk + 1), self.chunks - chunk)
+                count = 1
+                while count < wanted and chunk + count not in self.cached:
+                    count += 1
+                self.fetch(chunk, count)
+                self.next_chunk = chunk + count
+            self.cache.seek(offset)
+            return self.cache.read(length)
+
+    def close(self):
+        """Remove the cache file
+        """
+        self.cache.close()
+        if not self.cache_file.startswith("/dev/"):
+            os.remove(self.cache_file)
+
+
+def recv_exact(connection, length):
+    """Return exactly length bytes read from connection
+
+    This function will raise an Exception if the connection is closed.
+    """
+    data = b""
+    while len(data) < length:
+        chunk = connection.recv(length - len(data))
+        if not chunk:
+            raise Exception("NBD client disconnected")
+        data += chunk
+    return data
+
+
+def serve_nbd(source, connection):
+    """Serve source read only to one NBD client on connection
+
+    Implements the fixed newstyle handshake with the EXPORT_NAME, INFO
+    and GO options and the READ, WRITE, DISC and FLUSH requests with
+    simple replies. Writes are refused.
+    """
+    # Transmission flags: HAS_FLAGS, READ_ONLY, SEND_FLUSH
+    flags = 1 | 2 | 4
+    connection.sendall(b"NBDMAGIC" + b"IHAVEOPT" + struct.pack(">H", 3))
+    no_zeroes = struct.unpack(">I", recv_exact(connection, 4))[0] & 2
+
+    def option_reply(option, reply, data=b""):
+        """Send the reply to a handshake option"""
+        connection.sendall(struct.pack(">QIII", 0x3e889045565a9, option,
+                                       reply, len(data)) + data)
+    while True:
+        _, option, length = struct.unpack(">8sII",
+                                          recv_exact(connection, 16))
+        recv_exact(connection, length)
+        if option == 1:
+            connection.sendall(struct.pack(">QH", source.size, flags) +
+                               (b"" if no_zeroes else b"\0" * 124))
+            break
+        if option in [6, 7]:
+            option_reply(option, 3, struct.pack(">HQH", 0, source.size,
+                                                flags))
+            option_reply(option, 1)
+            if option == 7:
+                break
+        elif option == 2:
+            option_reply(option, 1)
+            return
+        else:
+            option_reply(option, 2 ** 31 + 1)
+    while True:
+        _, _, kind, handle, offset, length = struct.unpack(
+            ">IHHQQI", recv_exact(connection, 28))
+        if kind == 2:
+            return
+        error, data = 0, b""
+        if kind == 0:
+            try:
+                data = source.read(offset, length)
+            except Exception:
+                error = 5
+        elif kind == 1:
+            recv_exact(connection, length)
+            error = 1
+        connection.sendall(struct.pack(">IIQ", 0x67446698, error, handle) +
+                           (b"" if error else data))
+
+
+def start_lazy_source(template, socket_path, cache_file):
+    """Serve the remote source as an NBD export on a Unix socket
+
+    The mirrors are ranked as for a download and the export is served
+    from background threads until stop_lazy_sources is called.
+    Returns the HttpBlockSource behind the export.
+
+    This function will raise an Exception on finding an error.
+    """
+    mirrors = [template["ImageSourceLocation"]] + \
+        template.get("ImageSourceMirrors", [])
+    source = HttpBlockSource(rank_mirrors(mirrors), cache_file)
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    listener.listen(4)
+
+    def accept():
+        """Serve each client connecting to the socket"""
+        while True:
+            try:
+                connection = listener.accept()[0]
+            except OSError:
+                return
+            threading.Thread(target=lambda: serve_nbd(source, connection),
+                             daemon=True).start()
+    threading.Thread(target=accept, daemon=True).start()
+    LAZY_SOURCES.append({"source": source, "listener": listener,
+                         "socket": socket_path})
+    return source
+
+
+def stop_lazy_sources():
+    """Stop serving lazy sources and record what they fetched
     """
-    request.urlretrieve(template["ImageSourceLocation"], "/tmp/image.xz")
-    template["ImageSourceLocation"] = "file:///tmp/image.xz"
+    while LAZY_SOURCES:
+        lazy = LAZY_SOURCES.pop()
+        lazy["listener"].close()
+        os.remove(lazy["socket"])
+        lazy["source"].close()
+        INSTALL_REPORT["lazy_source"] = {
+            "url": lazy["source"].urls[0], "size": lazy["source"].size,
+            "fetched": lazy["source"].fetched,
+            "requests": lazy["source"].requests}
+        write_metric("lazy-source", **INSTALL_REPORT["lazy_source"])
+
+
+def lazy_mount_commands(socket_path, source_dir, image_format, device):
+    """Return the commands mounting a lazy source served on socket_path
+    """
+    attach = ["qemu-nbd", "-c", device, "-r", "-f", "raw",
+              "nbd+unix:///?socket={}".format(socket_path)]
+    if image_format == "disk":
+        return [["modprobe", "nbd", "max_part=2"], attach] + \
+            source_mount_commands(None, source_dir, device)[2:]
+    return [["modprobe", "nbd", "max_part=2"], attach,
+            ["mount", "-t", image_format, "-o", "ro", device, source_dir]]
 
 
 def install_os():
@@ -820,29 +4782,407 @@ def install_os():
     """
     template_location = get_template_location("/etc/ister.conf")
     template = get_template(template_location)
-    validate_template(template)
-    if template["ImageSourceType"] == "remote":
-        get_source_image(template)
+    plan = get_plan(template)
+    setup_progress(metrics_location=plan["template"].get("MetricsLocation"))
+    COMMAND_TIMEOUTS.update(plan["template"].get("CommandTimeouts", {}))
+    execute_plan(plan)
+
+
+class SourceCache(object):
+    """Class keeping decoded source images mounted between daemon jobs
+
+    Sources are keyed by image location and format. Sources no job is
+    using are unmounted and removed, least recently used first, while
+    the files kept for them take more than budget bytes.
+    """
+    def __init__(self, cache_dir=DAEMON_CACHE_DIR,
+                 budget=DAEMON_CACHE_BUDGET):
+        """Stores the cache folder and the disk budget
+        """
+        self.cache_dir = cache_dir
+        self.budget = parse_size(budget)
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, template):
+        """Return a mounted source folder for template's image
+
+        The source stays mounted until release is called for it.
+
+        This function will raise an Exception on finding an error.
+        """
+        key = "{0}:{1}".format(get_image_format(template),
+                               template["ImageSourceLocation"])
+        with self.lock:
+            entry = self.entries.get(key)
+            if not entry:
+                entry = {"key": key, "source": None, "files": [],
+                         "device": None, "size": 0, "users": 0,
+                         "lock": threading.Lock()}
+                self.entries[key] = entry
+            entry["users"] += 1
+            entry["last_used"] = time.time()
+        try:
+            with entry["lock"]:
+                if not entry["source"]:
+                    try:
+                        self.prepare(entry, dict(template))
+                    except Exception:
+                        self.discard(entry)
+                        raise
+        except Exception:
+            with self.lock:
+                entry["users"] -= 1
+                if not entry["source"]:
+                    del self.entries[key]
+            raise
+        self.evict()
+        return entry["source"]
+
+    def prepare(self, entry, template):
+        """Download, decode and mount the source of a new cache entry
+
+        This function will raise an Exception on finding an error.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        name = hashlib.sha256(entry["key"].encode("utf-8")).hexdigest()
+        path = os.path.join(self.cache_dir, name)
+        if template["ImageSourceType"] == "remote":
+            mirrors = [template["ImageSourceLocation"]] + \
+                template.get("ImageSourceMirrors", [])
+            entry["files"].append(path + ".image")
+            download_image(rank_mirrors(mirrors), path + ".image",
+                           template.get("MirrorMinThroughput",
+                                        MIRROR_MIN_THROUGHPUT))
+            template["ImageSourceLocation"] = "file://{}.image".format(path)
+            template["ImageSourceType"] = "local"
+        if get_image_format(template) == "disk":
+            entry["device"], entry["nbd_lock"] = reserve_nbd_device()
+            entry["files"].append(path + ".raw")
+        entry["source"] = setup_source(template, path + ".raw",
+                                       entry["device"])
+        entry["size"] = sum(os.stat(f).st_blocks * 512
+                            for f in entry["files"] if os.path.exists(f))
+
+    def discard(self, entry):
+        """Unmount the source of an entry and remove its files, releasing
+        its nbd device
+
+        Also used for an entry prepare failed for, which is left empty.
+        """
+        if entry["source"]:
+            run_command(["umount", "-R", entry["source"]],
+                        raise_exception=False)
+        if entry["device"]:
+            run_command(["qemu-nbd", "-d", entry["device"]],
+                        raise_exception=False)
+        if entry.get("nbd_lock"):
+            entry["nbd_lock"].close()
+        folders = [entry["source"]] if entry["source"] else []
+        run_command(["rm", "-fr"] + folders + entry["files"],
+                    raise_exception=False)
+        entry.update(source=None, files=[], device=None, nbd_lock=None,
+                     size=0)
+
+    def release(self, source_dir):
+        """Mark a source returned by acquire as no longer used by a job
+        """
+        with self.lock:
+            for entry in self.entries.values():
+                if entry["source"] == source_dir:
+                    entry["users"] -= 1
+                    entry["last_used"] = time.time()
+        self.evict()
+
+    def evict(self, budget=None):
+        """Remove unused sources until the cache fits in budget bytes
+        """
+        budget = self.budget if budget is None else budget
+        with self.lock:
+            entries = sorted(self.entries.values(),
+                             key=lambda v: v["last_used"])
+            total = sum(entry["size"] for entry in entries)
+            evicted = []
+            for entry in entries:
+                if total <= budget:
+                    break
+                if entry["users"] or not entry["source"]:
+                    continue
+                total -= entry["size"]
+                del self.entries[entry["key"]]
+                evicted.append(entry)
+        for entry in evicted:
+            write_metric("source-evicted", source=entry["key"],
+                         bytes=entry["size"])
+            self.discard(entry)
+
+    def status(self):
+        """Return the cached sources with their size and users
+        """
+        with self.lock:
+            return [{"source": entry["key"], "bytes": entry["size"],
+                     "users": entry["users"],
+                     "last_used": entry["last_used"]}
+                    for entry in self.entries.values()]
+
+
+def run_job(job_file):
+    """Run one install job of the daemon in this process
+
+    The job file holds the template and the source folder the daemon
+    mounted for it. Steps preparing the source are skipped and cleanup
+    leaves the source mounted.
+
+    This function will raise an Exception on finding an error.
+    """
+    with open(job_file, "r") as jfile:
+        job = json.load(jfile)
+    setup_progress(metrics_location="file://{}".format(job["metrics"]))
+    plan = get_plan(job["template"])
+    COMMAND_TIMEOUTS.update(plan["template"].get("CommandTimeouts", {}))
+    plan["steps"] = [step for step in plan["steps"]
+                     if step["step"] not in SHARED_SOURCE_STEPS]
+    try:
+        execute_plan(plan, context={"source": job["source"], "target": None,
+                                    "shared_source": True})
+    except Exception:
+        emit_report("failed")
+        raise
+    emit_report("complete")
+    wait_teardown()
+
+
+def retarget_template(template, disk):
+    """Return a copy of template installing to disk
+
+    Only templates laying out a single disk can be moved to another.
+
+    This function will raise an Exception on finding an error.
+    """
+    template = json.loads(json.dumps(template))
+    disks = set(part["disk"] for part in template.get("PartitionLayout", []))
+    if len(disks) != 1:
+        raise Exception("Only templates using a single disk can be given a "
+                        "target")
+    for section in ["PartitionLayout", "FilesystemTypes",
+                    "PartitionMountPoints"]:
+        for part in template[section]:
+            if part["disk"] in disks:
+                part["disk"] = disk
+    return template
+
+
+class InstallDaemon(object):
+    """Class running install jobs submitted over a Unix socket
+
+    Each job runs in its own ister process so jobs share no state, no
+    more than max_jobs of them at once. Sources are mounted by the
+    daemon and kept warm in a SourceCache between jobs.
+    """
+    def __init__(self, max_jobs=DAEMON_MAX_JOBS, cache=None):
+        """Stores the job limit and the source cache
+        """
+        self.cache = cache or SourceCache()
+        self.slots = threading.BoundedSemaphore(max_jobs)
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def submit(self, template, target=None):
+        """Queue an install of template, optionally moved to target disk
+
+        Returns the id of the new job.
+
+        This function will raise an Exception on finding an error.
+        """
+        if target:
+            template = retarget_template(template, target)
+        validate_template(json.loads(json.dumps(template)))
+        with self.lock:
+            job_id = str(len(self.jobs) + 1)
+            self.jobs[job_id] = {"job": job_id, "state": "queued",
+                                 "target": target, "submitted": time.time(),
+                                 "dir": tempfile.mkdtemp(prefix="ister-job-")}
+        threading.Thread(target=self.run, args=(job_id, template),
+                         daemon=True).start()
+        return job_id
+
+    def run(self, job_id, template):
+        """Run a queued job once a job slot is free
+        """
+        job = self.jobs[job_id]
+        with self.slots:
+            job.update(state="preparing source", started=time.time())
+            source = None
+            try:
+                source = self.cache.acquire(template)
+                job["state"] = "running"
+                job_file = os.path.join(job["dir"], "job.json")
+                with open(job_file, "w") as jfile:
+                    json.dump({"template": template, "source": source,
+                               "metrics": os.path.join(job["dir"],
+                                                       "metrics")}, jfile)
+                with open(os.path.join(job["dir"], "log"), "w") as log:
+                    returncode = subprocess.Popen(
+                        [sys.executable, os.path.abspath(__file__), "--job",
+                         job_file], stdout=log, stderr=log).wait()
+                job.update(state="complete" if returncode == 0 else "failed",
+                           returncode=returncode)
+            except Exception as exep:
+                job.update(state="failed", error=str(exep))
+            finally:
+                if source:
+                    self.cache.release(source)
+                job["finished"] = time.time()
+                job["seconds"] = job["finished"] - job["started"]
+
+    def status(self, job_id=None):
+        """Return the status of one job or of every job
+
+        The status of a job includes the last event of its metrics stream.
+        """
+        with self.lock:
+            jobs = [self.jobs[job_id]] if job_id else list(self.jobs.values())
+        statuses = []
+        for job in jobs:
+            status = dict(job)
+            try:
+                with open(os.path.join(job["dir"], "metrics"), "r") as events:
+                    status["last_event"] = json.loads(events.readlines()[-1])
+            except (OSError, IndexError, ValueError):
+                pass
+            statuses.append(status)
+        return statuses
+
+    def handle(self, message):
+        """Return the reply to a request read from the daemon socket
+        """
+        try:
+            if message.get("op") == "install":
+                return {"job": self.submit(message["template"],
+                                           message.get("target"))}
+            if message.get("op") == "status":
+                if message.get("job") and message["job"] not in self.jobs:
+                    raise Exception("Unknown job {}".format(message["job"]))
+                return {"jobs": self.status(message.get("job")),
+                        "sources": self.cache.status()}
+            raise Exception("Unknown request {}".format(message.get("op")))
+        except Exception as exep:
+            return {"error": str(exep)}
+
+
+class DaemonRequestHandler(socketserver.StreamRequestHandler):
+    """Class answering JSON line requests on the daemon socket
+    """
+    def handle(self):
+        """Reply to each request line with one JSON line
+        """
+        for line in self.rfile:
+            try:
+                reply = self.server.installer.handle(json.loads(line.decode(
+                    "utf-8")))
+            except ValueError as exep:
+                reply = {"error": "Invalid request: {}".format(exep)}
+            self.wfile.write((json.dumps(reply) + "\n").encode("utf-8"))
+
+
+def serve(socket_path, max_jobs=DAEMON_MAX_JOBS,
+          cache_budget=DAEMON_CACHE_BUDGET):
+    """Accept install jobs on a Unix socket until interrupted or terminated
+
+    Sources still cached are unmounted and removed on the way out.
+    """
+    def stop(*_):
+        """Leave the server loop on SIGTERM as on an interrupt"""
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop)
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = socketserver.ThreadingUnixStreamServer(socket_path,
+                                                    DaemonRequestHandler)
+    server.daemon_threads = True
+    server.installer = InstallDaemon(max_jobs,
+                                     SourceCache(budget=cache_budget))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+        server.installer.cache.evict(0)
 
-    do_install(template)
+
+def show_plan(noop=False):
+    """Print the install plan for the configured template
+
+    With noop, also print the orchestration overhead of running the plan.
+    """
+    template_location = get_template_location("/etc/ister.conf")
+    # Nothing is written and user keys aren't fetched, the default target
+    # disk is still looked up to show its partitioning
+    plan = get_plan(get_template(template_location), None, lambda url: None)
+    print(json.dumps(plan, indent=4, sort_keys=True))
+    if noop:
+        print("Orchestration overhead: {:.6f}s".format(benchmark_plan(plan)))
+
+
+def handle_options():
+    """Parse command line options
+    """
+    parser = argparse.ArgumentParser(description="Linux installation "
+                                     "template system")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="print the install plan without touching any "
+                        "disk")
+    parser.add_argument("--noop", action="store_true",
+                        help="with --dry-run, also time a no-op execution "
+                        "of the plan")
+    parser.add_argument("--validate", nargs="+", metavar="TEMPLATE",
+                        help="check template files, or folders of them, "
+                        "without touching the system and exit")
+    parser.add_argument("--daemon", metavar="SOCKET",
+                        help="run install jobs submitted on a Unix socket")
+    parser.add_argument("--max-jobs", type=int, default=DAEMON_MAX_JOBS,
+                        help="with --daemon, the number of jobs run at once")
+    parser.add_argument("--cache-budget", default=DAEMON_CACHE_BUDGET,
+                        help="with --daemon, the disk space kept for warm "
+                        "sources, such as 20G")
+    parser.add_argument("--job", help=argparse.SUPPRESS)
+    return parser.parse_args()
 
 
 def main():
     """Start the installer
     """
+    args = handle_options()
+    if args.dry_run:
+        show_plan(args.noop)
+        sys.exit(0)
+    if args.validate:
+        sys.exit(0 if show_validation(args.validate) else 1)
+    if args.daemon:
+        serve(args.daemon, args.max_jobs, args.cache_budget)
+        sys.exit(0)
+    if args.job:
+        run_job(args.job)
+        sys.exit(0)
+
     console = os.open("/dev/tty1", os.O_RDWR)
     os.write(console, b"\x1b[2J\x1b[H")
     os.write(console, b"Starting installation\n")
+    setup_progress(console=console)
     try:
         install_os()
     except Exception as exep:
+        emit_report("failed")
         os.write(console, "Installation failed: {}\n".format(exep)
                  .encode("ascii"))
-        time.sleep(5)
+        wait_teardown(5)
         sys.exit(-1)
 
+    emit_report("complete")
     os.write(console, b"Installation complete")
-    time.sleep(5)
+    wait_teardown(5)
     sys.exit(0)
 
 if __name__ == '__main__':
@@ -22,8 +22,15 @@
 # warning isn't helpful.
 # pylint: disable=W0703
 
+import http.server
 import ister
 import json
+import lzma
+import os
+import socket
+import struct
+import tempfile
+import threading
 import time
 
 
@@ -111,6 +118,26 @@ def full_user_install_template():
     "uid": 1001, "sudo": "password"}]}'
 
 
+def good_raid_template():
+    """Return string representation of good_raid_template"""
+    return u'{"ImageSourceType": "local", "ImageSourceLocation": \
+    "file:///good.raw.xz", "PartitionLayout": \
+    [{"disk": "sda", "partition": 1, "size": "512M", "type": "EFI"}, \
+    {"disk": "sda", "partition": 2, "size": "rest", "type": "raid"}, \
+    {"disk": "sdb", "partition": 1, "size": "rest", "type": "raid"}, \
+    {"disk": "sdc", "partition": 1, "size": "rest", "type": "raid"}, \
+    {"disk": "sdd", "partition": 1, "size": "rest", "type": "raid"}], \
+    "RaidSupport": "md", "RaidSetup": \
+    [{"raid": "md-raid1", "rdisk": "md0", "rpartitions": ["sda2", "sdb1"]}, \
+    {"raid": "md-raid0", "rdisk": "md1", "rpartitions": ["sdc1", "sdd1"]}], \
+    "FilesystemTypes": \
+    [{"disk": "sda", "partition": 1, "type": "vfat"}, \
+    {"disk": "md0", "type": "ext4"}, {"disk": "md1", "type": "ext4"}], \
+    "PartitionMountPoints": \
+    [{"disk": "sda", "partition": 1, "mount": "/boot"}, \
+    {"disk": "md0", "mount": "/"}, {"disk": "md1", "mount": "/srv"}]}'
+
+
 def read_good_local_conf():
     """Run read_good_local_conf test"""
     template_file = ister.get_template_location("/root/good-ister.conf")
@@ -143,7 +170,8 @@ def get_valid_remote_image():
         ister.get_source_image(template)
     except:
         raise Exception("Unable to download template file")
-    if template["ImageSourceLocation"] != "file:///tmp/image.xz":
+    if template["ImageSourceLocation"] != \
+       "file://{}/image.xz".format(ister.get_run_dir()):
         raise Exception("Failed to update ImageSourceLocation")
 
 
@@ -153,7 +181,7 @@ def validate_good_template():
                       good_user_template, good_user_key_template,
                       good_user_uid_template, good_user_sudop_template,
                       good_disk_template, full_user_install_template,
-                      good_post_install_template]
+                      good_post_install_template, good_raid_template]
 
     for template_string in good_templates:
         template = json.loads(template_string())
@@ -342,6 +370,1221 @@ def validate_remote_image_setup():
         raise Exception("Unable to cleanup after install: {}".format(exep))
 
 
+def validate_rsync_progress_parse():
+    """Run validate_rsync_progress_parse test"""
+    line = "  1,234,567  50%   12.34MB/s    0:01:23 (xfr#12, to-chk=100/200)"
+    progress = ister.parse_rsync_progress(line)
+    if progress != {"done_bytes": 1234567, "total_bytes": 2469134,
+                    "done_files": 100, "total_files": 200}:
+        raise Exception("Incorrect rsync progress: {}".format(progress))
+    if ister.parse_rsync_progress("sending incremental file list") is not None:
+        raise Exception("Non progress line parsed as progress")
+
+
+def validate_progress_metrics():
+    """Run validate_progress_metrics test"""
+    metrics_file = "/tmp/ister-metrics"
+    ister.setup_progress(metrics_location="file://{}".format(metrics_file))
+    with ister.ProgressStage("test", total_bytes=100) as stage:
+        stage.update(done_bytes=100)
+    ister.PROGRESS_SINKS["metrics"].close()
+    ister.PROGRESS_SINKS["metrics"] = None
+    with open(metrics_file, "r") as mfile:
+        events = [json.loads(line) for line in mfile]
+    if [e["event"] for e in events][0] != "stage-start" or \
+       events[-1]["event"] != "stage-end" or events[-1]["bytes"] != 100:
+        raise Exception("Unexpected metrics stream: {}".format(events))
+    if ister.INSTALL_REPORT["stages"]["test"]["bytes"] != 100:
+        raise Exception("Stage missing from install report")
+
+
+def validate_install_plan():
+    """Run validate_install_plan test"""
+    template = json.loads(good_disk_template())
+    cache_dir = tempfile.mkdtemp()
+    plan = ister.get_plan(template, cache_dir)
+    steps = [step["step"] for step in plan["steps"]]
+    order = [steps.index(step) for step in ["setup_source", "preflight",
+                                            "create_partitions",
+                                            "create_filesystems",
+                                            "setup_target", "copy_files",
+                                            "update_loader", "cleanup"]]
+    if order != sorted(order) or steps[-1] != "cleanup":
+        raise Exception("Unexpected plan steps: {}".format(steps))
+    if plan["steps"][steps.index("create_partitions")]["commands"][0] != \
+       ["parted", "-sa", "optimal", "/dev/sdb", "unit", "s", "mklabel",
+            "gpt"]:
+        raise Exception("Unexpected partition commands: {}"
+                        .format(plan["steps"]))
+    cached = ister.get_plan(json.loads(good_disk_template()), cache_dir)
+    if cached != json.loads(json.dumps(plan)):
+        raise Exception("Cached plan doesn't match the original plan")
+    cached = len(os.listdir(cache_dir))
+    ister.get_plan(json.loads(good_disk_template()), None)
+    if len(os.listdir(cache_dir)) != cached:
+        raise Exception("Uncached plan written to the cache")
+    sysfs = tempfile.mkdtemp()
+    os.makedirs("{}/sdb".format(sysfs))
+    with open("{}/sdb/size".format(sysfs), "w") as sfile:
+        sfile.write(str(64 * 1024 * 1024))
+    ister.SYSFS_BLOCK = sysfs
+    try:
+        ister.get_plan(json.loads(good_disk_template()), cache_dir)
+    finally:
+        ister.SYSFS_BLOCK = "/sys/block"
+        ister.run_command(["rm", "-fr", sysfs])
+    if len(os.listdir(cache_dir)) != cached + 1:
+        raise Exception("Plan for another disk taken from the cache")
+    ister.run_command(["rm", "-fr", cache_dir])
+    context = ister.execute_plan(plan, ister.noop_plan_step)
+    if ["mkfs.ext4", "/dev/sdb3"] not in context["commands"]:
+        raise Exception("No-op execution skipped commands: {}"
+                        .format(context["commands"]))
+    if [cmd for cmd in context["commands"] if "{target}" in " ".join(cmd)]:
+        raise Exception("No-op execution left unresolved placeholders")
+    executed = []
+    run_command = ister.run_command
+    ister.run_command = lambda command, *_: executed.append(command)
+    context = {"source": "/source", "target": None}
+    try:
+        for step in [{"step": "setup_target",
+                      "commands": [["mount", "{source}", "{target}"]]},
+                     {"step": "create_partitions",
+                      "commands": [["parted", "/dev/sdb"]]}]:
+            ister.run_plan_step(step, template, context)
+    finally:
+        ister.run_command = run_command
+    os.rmdir(context["target"])
+    if executed != [["mount", "/source", context["target"]],
+                    ["parted", "/dev/sdb"]]:
+        raise Exception("Plan commands not run: {}".format(executed))
+
+
+def validate_command_executor():
+    """Run validate_command_executor test"""
+    result = ister.run_command(["echo", "a b"])
+    if result["stdout"] != "a b\n" or result["returncode"] != 0:
+        raise Exception("Output not captured: {}".format(result))
+    result = ister.run_command(["sleep", "5"], raise_exception=False,
+                               timeout=0.5)
+    if not result["timed_out"] or result["seconds"] > 4:
+        raise Exception("Command not killed on timeout: {}".format(result))
+    result = ister.run_command(["sh", "-c", "sleep 5; true"],
+                               raise_exception=False, timeout=0.5)
+    if not result["timed_out"] or result["seconds"] > 4:
+        raise Exception("Command children not killed on timeout: {}"
+                        .format(result))
+
+    def fail(_):
+        """Fail on the first output"""
+        raise ValueError("output rejected")
+    start = time.time()
+    try:
+        ister.run_command(["sh", "-c", "echo out; sleep 5"], output=fail)
+    except ValueError:
+        pass
+    if time.time() - start > 4:
+        raise Exception("Command not killed when its output failed")
+    start = time.time()
+    results = ister.run_commands([["sleep", "1"], ["sleep", "1"]])
+    if time.time() - start > 1.9 or len(results) != 2:
+        raise Exception("Commands didn't run in parallel")
+    try:
+        ister.run_commands([["true"], ["false"]])
+    except Exception:
+        pass
+    else:
+        raise Exception("Failed parallel command not reported")
+
+
+def validate_target_worker():
+    """Run validate_target_worker test"""
+    target = tempfile.mkdtemp()
+    with ister.TargetWorker(target) as worker:
+        worker.run([{"op": "makedirs", "path": "/etc/sudoers.d"},
+                    {"op": "write", "path": "/etc/sudoers.d/test",
+                     "data": "test ALL=(ALL) ALL"}])
+        try:
+            worker.run([{"op": "chown", "path": "/etc", "user": "nobody",
+                         "error": "expected failure"}])
+        except Exception as exep:
+            if str(exep).find("expected failure") != 0:
+                raise Exception("Unexpected worker error: {}".format(exep))
+        else:
+            raise Exception("Worker didn't report failing operation")
+    if not os.path.exists("{}/etc/sudoers.d/test".format(target)):
+        raise Exception("Worker didn't write inside the target")
+    # The worker must not wait on command slots held when it was forked
+    for _ in range(ister.MAX_PARALLEL_COMMANDS):
+        ister.COMMAND_SLOTS.acquire()
+    try:
+        with ister.TargetWorker(target) as worker:
+            result = worker.run([{"op": "run_all",
+                                  "commands": [["true"]]}])[0]["results"][0]
+            if result["returncode"] is not None:
+                raise Exception("Command outside the target run")
+    finally:
+        for _ in range(ister.MAX_PARALLEL_COMMANDS):
+            ister.COMMAND_SLOTS.release()
+    ister.run_command(["rm", "-fr", target])
+    results = ister.run_worker_commands([["sh", "-c", "echo out"], ["false"],
+                                         ["sleep", "5"]] + [["true"]] * 4,
+                                        [None, None, 0.1] + [None] * 4)
+    if results[0]["stdout"] != "out\n" or results[1]["returncode"] != 1 or \
+       not results[2]["timed_out"] or \
+       [result["returncode"] for result in results[3:]] != [0] * 4:
+        raise Exception("Worker commands failed: {}".format(results))
+
+
+def validate_image_format_detection():
+    """Run validate_image_format_detection test"""
+    image = tempfile.mkstemp()[1]
+    headers = {"squashfs": b"hsqs" + b"\0" * 1024,
+               "erofs": b"\0" * 1024 + b"\xe2\xe1\xf5\xe0",
+               "disk": b"\xfd7zXZ\0" + b"\0" * 1024}
+    for image_format, header in headers.items():
+        with open(image, "wb") as ofile:
+            ofile.write(header)
+        template = {"ImageSourceLocation": "file://{}".format(image)}
+        if ister.get_image_format(template) != image_format:
+            raise Exception("{} image not detected".format(image_format))
+    os.remove(image)
+    template = {"ImageSourceLocation": "http://10.0.2.2:8001/root.sqfs"}
+    if ister.get_image_format(template) != "squashfs":
+        raise Exception("Remote squashfs image not detected")
+    template["ImageSourceFormat"] = "erofs"
+    if ister.get_image_format(template) != "erofs":
+        raise Exception("ImageSourceFormat not honoured")
+
+
+class MirrorHandler(http.server.BaseHTTPRequestHandler):
+    """Serve the server's data after its delay, throttled per chunk"""
+    def do_GET(self):
+        """Send the requested range of the server's data"""
+        time.sleep(self.server.delay)
+        data = self.server.data
+        start, end = 0, len(data)
+        if self.headers.get("Range") and self.server.ranges:
+            first, last = self.headers["Range"][len("bytes="):].split("-")
+            start = int(first)
+            end = int(last) + 1 if last else len(data)
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {0}-{1}/{2}"
+                             .format(start, end - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - start))
+        self.end_headers()
+        try:
+            for offset in range(start, end, 16 * 1024):
+                self.wfile.write(data[offset:min(offset + 16 * 1024, end)])
+                time.sleep(self.server.throttle)
+        except OSError:
+            pass
+
+    def log_message(self, *_):
+        """Keep the test output quiet"""
+        pass
+
+
+def start_mirror(data, delay=0.0, throttle=0.0, ranges=True):
+    """Start a local HTTP mirror stand-in, returning its server and URL"""
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), MirrorHandler)
+    server.daemon_threads = True
+    server.data = data
+    server.delay = delay
+    server.throttle = throttle
+    server.ranges = ranges
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:{}/image".format(server.server_port)
+
+
+def validate_mirror_failover():
+    """Run validate_mirror_failover test"""
+    data = os.urandom(1024 * 1024)
+    slow_server, slow = start_mirror(data, delay=0.3)
+    stalling_server, stalling = start_mirror(data, throttle=0.2)
+    fast_server, fast = start_mirror(data)
+    sluggish_server, sluggish = start_mirror(data, throttle=0.02)
+    try:
+        ranked = ister.rank_mirrors(["http://127.0.0.1:1/image", slow, fast])
+        if ranked != [fast, slow, "http://127.0.0.1:1/image"]:
+            raise Exception("Mirrors ranked incorrectly: {}".format(ranked))
+        if ister.rank_mirrors(["http://127.0.0.1:1/image"]) != \
+           ["http://127.0.0.1:1/image"]:
+            raise Exception("Single mirror not kept")
+        dest = tempfile.mkstemp()[1]
+        ister.download_image([stalling, fast], dest, 256 * 1024, 0.5)
+        with open(dest, "rb") as image:
+            if image.read() != data:
+                raise Exception("Image corrupted by mirror failover")
+        os.remove(dest)
+        if ister.INSTALL_REPORT["mirror"] != {"url": fast, "switches": 1}:
+            raise Exception("Failover not recorded: {}"
+                            .format(ister.INSTALL_REPORT["mirror"]))
+        ister.download_image([sluggish, "http://127.0.0.1:1/image"], dest,
+                             1024 * 1024, 0.5)
+        with open(dest, "rb") as image:
+            if image.read() != data:
+                raise Exception("Image corrupted by slow mirror retry")
+        os.remove(dest)
+        if ister.INSTALL_REPORT["mirror"] != {"url": sluggish,
+                                              "switches": 2}:
+            raise Exception("Slow mirror not retried: {}"
+                            .format(ister.INSTALL_REPORT["mirror"]))
+    finally:
+        for server in [slow_server, stalling_server, fast_server,
+                       sluggish_server]:
+            server.shutdown()
+
+
+def validate_io_tuning():
+    """Run validate_io_tuning test"""
+    sysfs = tempfile.mkdtemp()
+    queue_files = {"sdb": {"rotational": "1",
+                           "scheduler": "[none] mq-deadline",
+                           "nr_requests": "64", "read_ahead_kb": "128"},
+                   "nvme0n1": {"rotational": "0",
+                               "scheduler": "[none] mq-deadline",
+                               "nr_requests": "64", "read_ahead_kb": "128"}}
+    for disk, settings in queue_files.items():
+        os.makedirs("{0}/{1}/queue".format(sysfs, disk))
+        for setting, value in settings.items():
+            with open("{0}/{1}/queue/{2}".format(sysfs, disk, setting),
+                      "w") as qfile:
+                qfile.write(value)
+    template = {"PartitionLayout": [{"disk": "sdb"}, {"disk": "nvme0n1"}],
+                "IoTuning": {"nvme": {"read_ahead_kb": 512}}}
+    ister.SYSFS_BLOCK = sysfs
+    try:
+        ister.tune_devices(template, "/nonexistent")
+        report = ister.INSTALL_REPORT["io_tuning"]
+        if report["sdb"] != {"class": "rotational", "applied":
+                             {"scheduler": "mq-deadline",
+                              "nr_requests": "256",
+                              "read_ahead_kb": "4096"}}:
+            raise Exception("Wrong profile for sdb: {}".format(report))
+        if report["nvme0n1"]["applied"]["read_ahead_kb"] != "512":
+            raise Exception("IoTuning override ignored: {}".format(report))
+        ister.restore_io_tuning()
+        if ister.read_queue_setting("sdb", "read_ahead_kb") != "128" or \
+           ister.read_queue_setting("sdb", "scheduler") != "none":
+            raise Exception("Queue settings not restored")
+        plan = {"template": template,
+                "steps": [{"step": "tune_devices", "commands": []},
+                          {"step": "fail", "commands": []}]}
+        try:
+            ister.execute_plan(plan, context={"source": "/nonexistent",
+                                              "target": None})
+        except Exception:
+            pass
+        if ister.read_queue_setting("sdb", "read_ahead_kb") != "128":
+            raise Exception("Queue settings not restored on failure")
+    finally:
+        ister.SYSFS_BLOCK = "/sys/block"
+        ister.run_command(["rm", "-fr", sysfs])
+
+
+def validate_install_mount_options():
+    """Run validate_install_mount_options test"""
+    template = json.loads(good_disk_template())
+    template["PartitionMountPoints"][0]["options"] = "ro 0 0"
+    install = ister.target_mount_commands(template, "/target")
+    if ["mount", "-o", "noatime,commit=60,data=writeback,barrier=0",
+            "/dev/sdb3", "/target/"] not in install:
+        raise Exception("Install mount options not used: {}"
+                        .format(install))
+    production = ister.target_mount_commands(template, "/target", True)
+    if production != [["mount", "-o", "rw,relatime", "/dev/sdb3",
+                       "/target/"],
+                      ["mount", "-o", "ro", "/dev/sdb1", "/target/boot"]]:
+        raise Exception("Production mount options not used: {}"
+                        .format(production))
+
+
+def validate_raid_setup():
+    """Run validate_raid_setup test"""
+    template = json.loads(good_raid_template())
+    ister.validate_template(template)
+    groups = ister.raid_groups(template)
+    if [[array["rdisk"] for array in group] for group in groups] != \
+       [["md0", "md1"]]:
+        raise Exception("Arrays on separate disks not grouped: {}"
+                        .format(groups))
+    if ister.raid_command(template["RaidSetup"][0]) != \
+       ["mdadm", "--create", "/dev/md0", "--run", "--metadata=1.2",
+            "--level=1", "--raid-devices=2", "/dev/sda2", "/dev/sdb1"]:
+        raise Exception("Unexpected mdadm command")
+    if ["mkfs.ext4", "/dev/md0"] not in ister.filesystem_commands(template):
+        raise Exception("Filesystem not created on the array")
+    if ["mkfs.ext4", "-E", "stride=128,stripe_width=256", "/dev/md1"] not in \
+       ister.filesystem_commands(template):
+        raise Exception("Stripe geometry not passed to mkfs")
+    template["RaidSetup"][1]["rpartitions"] = ["sdb1", "sdd1"]
+    try:
+        ister.validate_template(template)
+    except Exception:
+        pass
+    else:
+        raise Exception("Partition used by two arrays passed validation")
+
+
+def validate_raid_loop_install():
+    """Run validate_raid_loop_install test"""
+    images = [tempfile.mkstemp()[1] for _ in range(2)]
+    loops = []
+    for image in images:
+        ister.run_command(["truncate", "-s", "64M", image])
+        loops.append(ister.run_command(["losetup", "-f", "--show", image])
+                     ["stdout"].strip()[len("/dev/"):])
+    template = {"PartitionLayout": [],
+                "RaidSetup": [{"raid": "md-raid1", "rdisk": "md100",
+                               "rpartitions": loops}]}
+    try:
+        ister.create_raid(template)
+        if ister.DEFERRED_RESYNC != ["md100"]:
+            raise Exception("Initial resync not deferred")
+        ister.run_command(["mkfs.ext4", "-q", "/dev/md100"])
+        ister.resume_raid_resync()
+    finally:
+        ister.run_command(["mdadm", "--stop", "/dev/md100"],
+                          raise_exception=False)
+        for loop in loops:
+            ister.run_command(["losetup", "-d", "/dev/{}".format(loop)])
+        for image in images:
+            os.remove(image)
+
+
+def validate_partition_alignment():
+    """Run validate_partition_alignment test"""
+    template = json.loads(good_disk_template())
+    template["PartitionAlignment"] = "3M"
+    ister.validate_template(template)
+    mkparts = [cmd[-2:] for cmd in ister.partition_commands(template)
+               if "mkpart" in cmd]
+    if mkparts != [["6144s", "1054719s"], ["1056768s", "2105343s"],
+                   ["2107392s", "100%"]]:
+        raise Exception("Partitions not aligned: {}".format(mkparts))
+    template["FilesystemTypes"].append({"disk": "sdc", "partition": 1,
+                                        "type": "xfs", "stripe_unit": "64K",
+                                        "stripe_width": 4})
+    if ["mkfs.xfs", "-d", "su=65536,sw=4", "/dev/sdc1"] not in \
+       ister.filesystem_commands(template):
+        raise Exception("Stripe override not passed to mkfs.xfs")
+    template["FilesystemTypes"] = [
+        {"disk": "sdc", "partition": 2, "type": "ext4",
+         "options": "-E lazy_itable_init=0 -L root", "stripe_unit": "64K",
+         "stripe_width": 4},
+        {"disk": "sdc", "partition": 3, "type": "xfs",
+         "options": "-d sunit=128,swidth=512", "stripe_unit": "64K"}]
+    if ister.filesystem_commands(template) != [
+            ["mkfs.ext4", "-E", "lazy_itable_init=0,stride=16,"
+             "stripe_width=64", "-L", "root", "/dev/sdc2"],
+            ["mkfs.xfs", "-d", "sunit=128,swidth=512", "/dev/sdc3"]]:
+        raise Exception("Stripe options not merged with the template's: {}"
+                        .format(ister.filesystem_commands(template)))
+
+
+def validate_post_scripts():
+    """Run validate_post_scripts test"""
+    target = tempfile.mkdtemp()
+    scripts = []
+    for name in ["first", "second", "third"]:
+        script = "{0}/{1}.sh".format(target, name)
+        with open(script, "w") as ofile:
+            ofile.write("#!/bin/sh\nsleep 1\necho {} >> $1/ran\n"
+                        .format(name))
+        os.chmod(script, 0o755)
+        scripts.append(script)
+    template = {"PostNonChroot": [{"script": scripts[0], "group": "config"},
+                                  scripts[2],
+                                  {"script": scripts[1], "group": "config"}]}
+    ister.validate_scripts("PostNonChroot", template["PostNonChroot"])
+    groups = ister.script_groups(ister.script_entries(template,
+                                                      "PostNonChroot"))
+    if [[script["index"] for script in group] for group in groups] != \
+       [[0, 2], [1]]:
+        raise Exception("Scripts not grouped: {}".format(groups))
+    start = time.time()
+    ister.run_post_non_chroot(template, target)
+    if time.time() - start > 2.9:
+        raise Exception("Grouped scripts didn't run concurrently")
+    with open(target + "/ran", "r") as ran:
+        if ran.read().split()[-1] != "third":
+            raise Exception("Script groups ran out of order")
+    report = [entry for entry in ister.INSTALL_REPORT["scripts"]
+              if entry["script"] in scripts]
+    if len(report) != 3 or [e for e in report if e["seconds"] < 1]:
+        raise Exception("Scripts not timed: {}".format(report))
+    template = {"PostNonChroot": [{"script": scripts[0], "timeout": 0.5}]}
+    try:
+        ister.run_post_non_chroot(template, target)
+    except Exception as exep:
+        if str(exep).find("timed out") < 0:
+            raise Exception("Unexpected script error: {}".format(exep))
+    else:
+        raise Exception("Script timeout not enforced")
+    os.chmod(scripts[0], 0o644)
+    commands = []
+    executable = []
+
+    class Worker(object):
+        """Check the scripts are executable instead of running them"""
+        def __init__(self, target_dir):
+            self.target_dir = target_dir
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *_):
+            pass
+
+        def run(self, operations):
+            """Return a successful result for each command"""
+            batch = operations[0]["commands"]
+            executable.extend(os.access(self.target_dir + command[0],
+                                        os.X_OK) for command in batch)
+            return [{"results": [{"returncode": 0, "seconds": 0,
+                                  "timed_out": False, "stdout": "",
+                                  "stderr": ""} for _ in batch]}]
+    target_worker, run_command = ister.TargetWorker, ister.run_command
+    ister.TargetWorker = Worker
+    ister.run_command = lambda command, *_, **__: commands.append(command)
+    try:
+        ister.run_post_chroot({"PostChroot": [scripts[0]]}, target)
+    finally:
+        ister.TargetWorker, ister.run_command = target_worker, run_command
+    mounts = [command[2:] for command in commands if "--rbind" in command]
+    umounts = [command[-1] for command in commands if command[0] == "umount"]
+    if executable != [True] or \
+       mounts != [[path, target + path]
+                  for path in ["/proc", "/dev", "/sys"]] or \
+       umounts != [target + path for path in ["/sys", "/dev", "/proc"]]:
+        raise Exception("Chroot scripts not set up: {0} {1}"
+                        .format(executable, commands))
+    ister.run_command(["rm", "-fr", target])
+
+
+def validate_preflight_check():
+    """Run validate_preflight_check test"""
+    sysfs = tempfile.mkdtemp()
+    source = tempfile.mkdtemp()
+    os.makedirs("{}/sdb".format(sysfs))
+    with open("{}/sdb/size".format(sysfs), "w") as sfile:
+        sfile.write(str(4 * 1024 * 1024))
+    os.makedirs("{}/boot".format(source))
+    with open("{}/boot/vmlinuz".format(source), "w") as kernel:
+        kernel.truncate(600 * 1024 * 1024)
+    os.link("{}/boot/vmlinuz".format(source), "{}/boot/link".format(source))
+    with open("{}/os-release".format(source), "w") as release:
+        release.write("NAME=test\n")
+    template = json.loads(good_disk_template())
+    template["ImageSourceFormat"] = "squashfs"
+    ister.SYSFS_BLOCK = sysfs
+    try:
+        usage = ister.get_source_usage(source, ["/", "/boot"], "squashfs")
+        if usage["/boot"] < 600 * 1024 * 1024 or \
+           usage["/boot"] > 601 * 1024 * 1024 or usage["/"] > 1024 * 1024:
+            raise Exception("Source usage not measured: {}".format(usage))
+        try:
+            ister.preflight_check(template, source)
+        except Exception as exep:
+            if str(exep).find("/boot needs") < 0 or \
+               str(exep).find("/ needs") >= 0:
+                raise Exception("Unexpected preflight error: {}".format(exep))
+        else:
+            raise Exception("Preflight missed an oversized /boot")
+        template["PartitionLayout"][0]["size"] = "1G"
+        ister.preflight_check(template, source)
+        template["PartitionLayout"][1]["size"] = "1G"
+        try:
+            ister.preflight_check(template, source)
+        except Exception as exep:
+            if str(exep).find("sdb3 doesn't fit") < 0:
+                raise Exception("Unexpected preflight error: {}".format(exep))
+        else:
+            raise Exception("Preflight missed a rest partition with no room")
+        template["PartitionLayout"][2]["size"] = "1G"
+        try:
+            ister.check_layout(template)
+        except Exception as exep:
+            if str(exep).find("partitions of sdb need") < 0:
+                raise Exception("Unexpected layout error: {}".format(exep))
+        else:
+            raise Exception("Layout check missed fixed partitions overflowing")
+    finally:
+        ister.SYSFS_BLOCK = "/sys/block"
+        ister.run_command(["rm", "-fr", sysfs, source])
+
+
+def validate_copy_strategy():
+    """Run validate_copy_strategy test"""
+    sysfs = tempfile.mkdtemp()
+    source = tempfile.mkdtemp()
+    os.makedirs("{}/sdb/queue".format(sysfs))
+    with open("{}/sdb/queue/rotational".format(sysfs), "w") as rotational:
+        rotational.write("0")
+    files = {"usr/lib/libc.so": 4000, "usr/lib/libm.so": 3000,
+             "usr/bin/sh": 2000, "etc/passwd": 500, "boot/vmlinuz": 1000}
+    for name, size in files.items():
+        os.makedirs(os.path.dirname("{0}/{1}".format(source, name)),
+                    exist_ok=True)
+        with open("{0}/{1}".format(source, name), "w") as ofile:
+            ofile.write("x" * size)
+    template = json.loads(good_disk_template())
+    ister.SYSFS_BLOCK = sysfs
+    min_files = ister.PARALLEL_COPY_MIN_FILES
+    try:
+        stats = ister.scan_source(source)
+        if stats["files"] != 5 or stats["bytes"] != 10500 or \
+           stats["sizes"]["usr"] != 9000:
+            raise Exception("Source not scanned: {}".format(stats))
+        parts = ister.split_copy(stats, 2)
+        if sorted(sum(parts, [])) != ["boot", "etc", "usr/bin", "usr/lib"] \
+           or len(parts) != 2:
+            raise Exception("Copy not split by size: {}".format(parts))
+        choice = ister.select_copy_strategy(template, source)
+        if choice["strategy"] != "rsync" or choice["reason"] != "only 5 files":
+            raise Exception("Unexpected copy strategy: {}".format(choice))
+        ister.PARALLEL_COPY_MIN_FILES = 1
+        choice = ister.select_copy_strategy(template, source)
+        if choice["strategy"] != "parallel":
+            raise Exception("Parallel copy not chosen: {}".format(choice))
+        os.link("{}/etc/passwd".format(source), "{}/etc/link".format(source))
+        if ister.select_copy_strategy(template, source)["strategy"] != "rsync":
+            raise Exception("Parallel copy chosen for hard links")
+        template["CopyStrategy"] = "parallel"
+        ister.validate_copy_strategy(template)
+        choice = ister.select_copy_strategy(template, source)
+        if choice["strategy"] != "parallel" or \
+           choice["reason"] != "set by CopyStrategy":
+            raise Exception("CopyStrategy ignored: {}".format(choice))
+        probes = []
+        scan_source = ister.scan_source
+        get_slow_source = ister.get_slow_source
+        ister.scan_source = lambda path: probes.append("scan")
+        ister.get_slow_source = lambda t: probes.append("slow") or "slow"
+        try:
+            template["CopyStrategy"] = "rsync"
+            ister.select_copy_strategy(template, source)
+            del template["CopyStrategy"]
+            ister.select_copy_strategy(template, source)
+        finally:
+            ister.scan_source = scan_source
+            ister.get_slow_source = get_slow_source
+        if probes != ["slow"]:
+            raise Exception("Source probed needlessly: {}".format(probes))
+    finally:
+        ister.SYSFS_BLOCK = "/sys/block"
+        ister.PARALLEL_COPY_MIN_FILES = min_files
+        ister.run_command(["rm", "-fr", sysfs, source])
+
+
+def validate_install_daemon():
+    """Run validate_install_daemon test"""
+    template = json.loads(good_disk_template())
+    moved = ister.retarget_template(template, "vdc")
+    if [part["disk"] for part in moved["PartitionMountPoints"]] != \
+       ["vdc", "vdc"] or template["PartitionLayout"][0]["disk"] != "sdb":
+        raise Exception("Template not moved to the target: {}".format(moved))
+    cache = ister.SourceCache(tempfile.mkdtemp(), "3M")
+    for name, age in [("old", 3), ("busy", 2), ("new", 1)]:
+        source = tempfile.mkdtemp()
+        cache.entries[name] = {"key": name, "source": source, "files": [],
+                               "device": None, "size": 1024 * 1024,
+                               "users": 1 if name == "busy" else 0,
+                               "last_used": time.time() - age}
+    cache.evict(2 * 1024 * 1024)
+    if sorted(cache.entries) != ["busy", "new"]:
+        raise Exception("LRU source not evicted: {}".format(cache.entries))
+    cache.evict(0)
+    if sorted(cache.entries) != ["busy"]:
+        raise Exception("Source in use evicted: {}".format(cache.entries))
+    ister.run_command(["rm", "-fr", cache.entries["busy"]["source"],
+                       cache.cache_dir])
+    lock_dir = ister.NBD_LOCK_DIR
+    ister.NBD_LOCK_DIR = tempfile.mkdtemp()
+    try:
+        device, lock = ister.reserve_nbd_device()
+        lock.close()
+        entries = []
+        prepare = cache.prepare
+
+        def keep_entry(entry, template):
+            """Keep the entry prepared so its lock isn't garbage collected"""
+            entries.append(entry)
+            prepare(entry, template)
+        cache.prepare = keep_entry
+        try:
+            cache.acquire({"ImageSourceType": "local",
+                           "ImageSourceLocation": "file:///missing.img",
+                           "ImageSourceFormat": "disk"})
+            raise Exception("Missing source image not reported")
+        except Exception as exep:
+            if "not found" not in str(exep):
+                raise
+        if "disk:file:///missing.img" in cache.entries or \
+           entries[0]["device"] or entries[0]["files"]:
+            raise Exception("Failed source left in the cache")
+        device_after, lock = ister.reserve_nbd_device()
+        lock.close()
+        if device_after != device:
+            raise Exception("nbd device of a failed source not released")
+    finally:
+        ister.run_command(["rm", "-fr", ister.NBD_LOCK_DIR, cache.cache_dir])
+        ister.NBD_LOCK_DIR = lock_dir
+    daemon = ister.InstallDaemon(1, cache)
+    if "error" not in daemon.handle({"op": "status", "job": "1"}) or \
+       "error" not in daemon.handle({"op": "reboot"}):
+        raise Exception("Bad daemon requests not reported")
+    if daemon.handle({"op": "status"})["jobs"] != []:
+        raise Exception("Unexpected daemon jobs")
+
+
+def validate_reuse_layout():
+    """Run validate_reuse_layout test"""
+    template = json.loads(good_disk_template())
+    template["ReuseLayout"] = True
+    template["FilesystemTypes"][2]["wipe"] = True
+    ister.validate_template(template)
+    table = ister.parse_partition_table(
+        "BYT;\n/dev/sdb:41943040s:scsi:512:512:gpt:QEMU HARDDISK:;\n"
+        "1:2048s:1050623s:1048576s:fat32:primary:boot, esp;\n"
+        "2:1050624s:2099199s:1048576s:linux-swap(v1):primary:;\n"
+        "3:2099200s:41940991s:39841792s:ext4:primary:;\n")
+    if table["partitions"][1] != {"start": 2048, "end": 1050623,
+                                  "flags": ["boot", "esp"]}:
+        raise Exception("Partition table not parsed: {}".format(table))
+    geometry = ister.partition_geometry(template)
+    if not ister.layout_matches(geometry, table):
+        raise Exception("Matching layout not detected")
+    table["partitions"][2]["end"] = 2099198
+    if ister.layout_matches(geometry, table):
+        raise Exception("Different partition end not detected")
+    table["partitions"][2]["end"] = 2099199
+    table["partitions"][1]["flags"] = []
+    if ister.layout_matches(geometry, table):
+        raise Exception("Missing boot flag not detected")
+    if ister.partition_commands(template, set()) != [] or \
+       ister.partition_commands(template, {"sdb"}) != \
+       ister.partition_commands(template):
+        raise Exception("Partition commands not limited to disks")
+    template["FilesystemTypes"][2]["wipe"] = False
+    template["FilesystemTypes"].append({"disk": "sdb", "partition": 4,
+                                        "type": "ext4"})
+    template["PartitionMountPoints"].append({"disk": "sdb", "partition": 4,
+                                             "mount": "/home"})
+    source = tempfile.mkdtemp()
+    os.makedirs("{}/boot/loader".format(source))
+    os.makedirs("{}/home".format(source))
+    formatted = []
+    get_filesystem_type = ister.get_filesystem_type
+    run_commands = ister.run_commands
+    ister.get_filesystem_type = lambda device: {"sdb1": "vfat",
+                                                "sdb2": "swap"}.get(
+                                                    device, "ext4")
+    ister.run_commands = lambda commands: formatted.extend(
+        command[-1] for command in commands)
+    try:
+        ister.create_filesystems(template, ["sdb"], None, source)
+    finally:
+        ister.get_filesystem_type = get_filesystem_type
+        ister.run_commands = run_commands
+        ister.run_command(["rm", "-fr", source])
+    if formatted != ["/dev/sdb1", "/dev/sdb3"]:
+        raise Exception("Filesystems copied into not formatted: {}"
+                        .format(formatted))
+
+
+def validate_lazy_source():
+    """Run validate_lazy_source test"""
+    data = os.urandom(8 * 1024 * 1024 + 1000)
+    server, url = start_mirror(data)
+    xz_server, xz_url = start_mirror(b"\xfd7zXZ\x00" + data)
+    plain_server, plain_url = start_mirror(data, ranges=False)
+    cache = tempfile.mkstemp()[1]
+    try:
+        if not ister.is_lazy_source({"ImageSourceType": "remote",
+                                     "ImageSourceLocation": url}) or \
+           ister.is_lazy_source({"ImageSourceType": "remote",
+                                 "ImageSourceLocation": xz_url}):
+            raise Exception("Lazy source not told apart by magic number")
+        if ister.is_lazy_source({"ImageSourceType": "remote",
+                                 "ImageSourceLocation": plain_url}):
+            raise Exception("Lazy source chosen without range support")
+        # A mirror that stops serving ranges after the probe
+        ister.REMOTE_PROBES[plain_url] = {"xz": False, "ranges": True}
+        template = {"ImageSourceType": "remote",
+                    "ImageSourceLocation": plain_url,
+                    "ImageSourceFormat": "squashfs"}
+        commands = []
+        run_command = ister.run_command
+        ister.run_command = commands.append
+        try:
+            ister.setup_source(template, device="/dev/nbd15")
+        finally:
+            ister.run_command = run_command
+        image = template["ImageSourceLocation"][len("file://"):]
+        with open(image, "rb") as downloaded:
+            if template["ImageSourceType"] != "local" or \
+               image != os.path.join(ister.get_run_dir(), "image") or \
+               downloaded.read() != data or \
+               [command[-2] for command in commands] != [image]:
+                raise Exception("Image not downloaded without ranges: {}"
+                                .format(commands))
+        ister.release_run()
+        # The fallback keeps to the memory path of the plan
+        template = {"ImageSourceType": "remote",
+                    "ImageSourceLocation": plain_url,
+                    "ImageSourceFormat": "disk"}
+        commands = []
+        ister.run_command = commands.append
+        try:
+            ister.setup_source(template, device="/dev/nbd15",
+                               memory={"path": "scratch", "scratch": cache})
+        finally:
+            ister.run_command = run_command
+        with open(cache, "rb") as downloaded:
+            if template["ImageSourceLocation"] != "file://" + cache or \
+               downloaded.read() != data or \
+               ["qemu-nbd", "-c", "/dev/nbd15", cache] not in commands:
+                raise Exception("Fallback not kept on scratch: {}"
+                                .format(commands))
+        ister.release_run()
+        source = ister.HttpBlockSource(["http://127.0.0.1:1/image", url],
+                                       cache)
+        if source.size != len(data):
+            raise Exception("Wrong lazy source size {}".format(source.size))
+        if source.read(4 * 1024 * 1024 + 10, 100) != \
+           data[4 * 1024 * 1024 + 10:4 * 1024 * 1024 + 110] or \
+           source.fetched != 1024 * 1024:
+            raise Exception("Random read not fetched by itself")
+        for offset in range(0, 4 * 1024 * 1024, 64 * 1024):
+            if source.read(offset, 64 * 1024) != \
+               data[offset:offset + 64 * 1024]:
+                raise Exception("Sequential read corrupted")
+        if source.requests != 4:
+            raise Exception("Read-ahead not used: {} requests"
+                            .format(source.requests))
+        if source.read(len(data) - 10, 10) != data[-10:]:
+            raise Exception("Last partial chunk not read")
+        client, connection = socket.socketpair()
+        threading.Thread(target=ister.serve_nbd, args=(source, connection),
+                         daemon=True).start()
+        if client.recv(18)[:16] != b"NBDMAGICIHAVEOPT":
+            raise Exception("No NBD handshake")
+        client.sendall(struct.pack(">I", 3) + b"IHAVEOPT" +
+                       struct.pack(">II", 1, 0))
+        size, _ = struct.unpack(">QH", ister.recv_exact(client, 10))
+        client.sendall(struct.pack(">IHHQQI", 0x25609513, 0, 0, 7, 4096, 512))
+        reply = ister.recv_exact(client, 16 + 512)
+        if size != len(data) or reply[4:16] != struct.pack(">IQ", 0, 7) or \
+           reply[16:] != data[4096:4608]:
+            raise Exception("NBD read failed")
+        client.sendall(struct.pack(">IHHQQI", 0x25609513, 0, 2, 8, 0, 0))
+        client.close()
+        source.close()
+    finally:
+        server.shutdown()
+        xz_server.shutdown()
+        plain_server.shutdown()
+
+
+def validate_memory_budget():
+    """Run validate_memory_budget test"""
+    data = os.urandom(2 * 1024 * 1024)
+    image = tempfile.mkstemp(suffix=".xz")[1]
+    with open(image, "wb") as ifile:
+        ifile.write(lzma.compress(data, lzma.FORMAT_XZ))
+    server, url = start_mirror(open(image, "rb").read())
+    sysfs = tempfile.mkdtemp()
+    os.makedirs("{}/sdb".format(sysfs))
+    with open("{}/sdb/size".format(sysfs), "w") as sfile:
+        sfile.write(str(8 * 1024 * 1024))
+    dest = tempfile.mkstemp()[1]
+    template = json.loads(good_disk_template())
+    template["ImageSourceLocation"] = "file://{}".format(image)
+    ram_backed = ister.is_ram_backed
+    ister.SYSFS_BLOCK = sysfs
+    try:
+        ister.download_image([url], dest, decompress=True)
+        with open(dest, "rb") as streamed:
+            if streamed.read() != data:
+                raise Exception("Streamed download not decompressed")
+        memory = ister.select_memory_path(template)
+        if memory["path"] != "tmp" or memory["budget"] is not None:
+            raise Exception("Disk backed /tmp limited: {}".format(memory))
+        ister.is_ram_backed = lambda path: True
+        template["MemoryBudget"] = "1G"
+        if ister.select_memory_path(template)["needed"] != len(data):
+            raise Exception("Decompressed image not accounted for")
+        template["MemoryBudget"] = "1M"
+        plan = ister.build_plan(template)
+        steps = [step["step"] for step in plan["steps"]]
+        if plan["memory"]["scratch"] != "/dev/sdb2" or \
+           steps[:4] != ["check_memory", "check_layout",
+                         "create_partitions", "setup_source"] or \
+           plan["steps"][-1]["commands"] != [["mkswap", "/dev/sdb2"]] or \
+           ["mkswap", "/dev/sdb2"] in \
+           plan["steps"][steps.index("create_filesystems")]["commands"]:
+            raise Exception("Image not spilled to swap: {}".format(plan))
+        sampler, stop = ister.check_memory({"path": "tmp"})
+        stop.set()
+        sampler.join(5)
+        if sampler.is_alive():
+            raise Exception("Memory sampling not stopped")
+        template["PartitionLayout"][1]["size"] = "1M"
+        try:
+            ister.select_memory_path(template)
+        except Exception as exep:
+            if str(exep).find("no swap partition") < 0:
+                raise Exception("Unexpected memory error: {}".format(exep))
+        else:
+            raise Exception("Image too large for memory and swap accepted")
+    finally:
+        ister.is_ram_backed = ram_backed
+        ister.SYSFS_BLOCK = "/sys/block"
+        server.shutdown()
+        ister.run_command(["rm", "-fr", sysfs, image, dest])
+
+
+def validate_run_isolation():
+    """Run validate_run_isolation test"""
+    ister.NBD_LOCK_DIR = tempfile.mkdtemp()
+    try:
+        run_dir = ister.get_run_dir()
+        device = ister.get_nbd_device()
+        other, lock = ister.reserve_nbd_device()
+        if other == device or ister.get_nbd_device() != device or \
+           ister.get_run_dir() != run_dir or not os.path.isdir(run_dir):
+            raise Exception("Runs share resources: {0} {1} {2}"
+                            .format(run_dir, device, other))
+        plan = ister.build_plan(json.loads(good_disk_template()))
+        commands = plan["steps"][[step["step"] for step in plan["steps"]]
+                                 .index("setup_source")]["commands"]
+        if ["qemu-nbd", "-c", "{device}", "{run}/source"] not in commands:
+            raise Exception("Plan not using run placeholders: {}"
+                            .format(commands))
+        ister.release_run()
+        if os.path.exists(run_dir) or ister.reserve_nbd_device()[0] != device:
+            raise Exception("Run resources not released")
+        lock.close()
+    finally:
+        ister.release_run()
+        ister.run_command(["rm", "-fr", ister.NBD_LOCK_DIR])
+        ister.NBD_LOCK_DIR = "/run/lock/ister"
+
+
+def validate_ordered_copy():
+    """Run validate_ordered_copy test"""
+    source = tempfile.mkdtemp()
+    target = tempfile.mkdtemp()
+    for name in ["usr/lib/libc.so", "usr/bin/sh", "etc/passwd"]:
+        os.makedirs(os.path.dirname("{0}/{1}".format(source, name)),
+                    exist_ok=True)
+        with open("{0}/{1}".format(source, name), "wb") as ofile:
+            ofile.write(os.urandom(64 * 1024))
+    os.link("{}/usr/bin/sh".format(source), "{}/usr/bin/bash".format(source))
+    open("{}/etc/empty".format(source), "w").close()
+    template = json.loads(good_disk_template())
+    template["ImageSourceType"] = "remote"
+    server, template["ImageSourceLocation"] = start_mirror(bytes(4096))
+    try:
+        if ister.seek_distance([(0, 10), (20, 5), (10, 10)]) != 25:
+            raise Exception("Seek distance miscounted")
+        files, _, ordered_seek = ister.schedule_copy(source)
+        names = sorted(path[len(source):] for path, _ in files)
+        if names != ["/etc/passwd", "/usr/lib/libc.so"]:
+            raise Exception("Unexpected files scheduled: {}".format(names))
+        offsets = [ister.get_physical_offset(path) for path, _ in files]
+        if None not in offsets and offsets != sorted(offsets):
+            raise Exception("Files not in physical order: {}"
+                            .format(offsets))
+        for path, stat in files:
+            ister.copy_file_data(path, target + path[len(source):], stat)
+            copied = os.stat(target + path[len(source):])
+            if open(path, "rb").read() != \
+               open(target + path[len(source):], "rb").read() or \
+               copied.st_mtime_ns != stat.st_mtime_ns:
+                raise Exception("File data not copied: {}".format(path))
+        choice = ister.select_copy_strategy(template, source)
+        if choice["strategy"] != "ordered" or \
+           choice["reason"].find("lazily") < 0 or ordered_seek < 0:
+            raise Exception("Ordered copy not chosen: {}".format(choice))
+    finally:
+        server.shutdown()
+        ister.run_command(["rm", "-fr", source, target])
+
+
+def validate_uncached_copy():
+    """Run validate_uncached_copy test"""
+    source = tempfile.mkdtemp()
+    target = tempfile.mkdtemp()
+    data = os.urandom(300 * 1024)
+    with open("{}/image".format(source), "wb") as ofile:
+        ofile.write(data)
+    template = json.loads(good_disk_template())
+    chunk = ister.COPY_CHUNK
+    ister.COPY_CHUNK = 64 * 1024
+    try:
+        stat = os.stat("{}/image".format(source))
+        ister.copy_file_uncached("{}/image".format(source),
+                                 "{}/usr/image".format(target), stat)
+        with open("{}/usr/image".format(target), "rb") as copied:
+            if copied.read() != data or os.stat(
+                    "{}/usr/image".format(target)).st_mtime_ns != \
+                    stat.st_mtime_ns:
+                raise Exception("Uncached copy corrupted the file")
+        if ister.get_page_cache() <= 0:
+            raise Exception("Page cache not measured")
+        if ister.drops_copy_cache(template):
+            raise Exception("Page cache dropped by default")
+        template["DropCopyCache"] = True
+        ister.validate_template(template)
+        choice = ister.select_copy_strategy(template, source)
+        if choice["strategy"] != "ordered" or \
+           choice["reason"].find("page cache") < 0:
+            raise Exception("Cache dropping copy not chosen: {}"
+                            .format(choice))
+        template["DropCopyCache"] = "yes"
+        try:
+            ister.validate_template(template)
+        except Exception:
+            pass
+        else:
+            raise Exception("Invalid DropCopyCache accepted")
+    finally:
+        ister.COPY_CHUNK = chunk
+        ister.run_command(["rm", "-fr", source, target])
+
+
+def validate_overlay_install():
+    """Run validate_overlay_install test"""
+    target = tempfile.mkdtemp()
+    template = json.loads(good_disk_template())
+    template["PartitionLayout"][1].update(size="4G", type="linux")
+    del template["FilesystemTypes"][1]
+    template["OverlayLower"] = {"disk": "sdb", "partition": 2}
+    try:
+        ister.validate_template(template)
+        commands = ister.target_mount_commands(template, target)
+        if ["mount", "-o", "ro", "/dev/sdb2", target + ".lower"] not in \
+           commands or ["mount", "-t", "overlay", "-o",
+                        "lowerdir={0}.lower,upperdir={0}.upper/overlay,"
+                        "workdir={0}.upper/overlay-workdir".format(target),
+                        "overlay", target] not in commands:
+            raise Exception("Overlay root not mounted: {}".format(commands))
+        os.makedirs("{}/boot/loader/entries".format(target))
+        os.makedirs("{}/etc".format(target))
+        with open("{}/boot/loader/entries/default.conf".format(target),
+                  "w") as conf:
+            conf.write("title Clear Linux\nlinux /vmlinuz\n"
+                       "initrd /initrd\noptions root=UUID=old rw quiet\n")
+        uuids = [{"uuid": "upper", "mount": "/", "type": "ext4"},
+                 {"uuid": "boot", "mount": "/boot", "type": "vfat"}]
+        ister.update_loader(uuids, target)
+        with open("{}/boot/loader/entries/default.conf".format(target),
+                  "r") as conf:
+            options = conf.readlines()[3]
+        if options != "options root=UUID=upper rw quiet\n":
+            raise Exception("Bad loader options: {}".format(options))
+        ister.update_loader(uuids, target, "lower")
+        with open("{}/boot/loader/entries/default.conf".format(target),
+                  "r") as conf:
+            options = conf.readlines()[3]
+        if options != "options root=PARTUUID=lower quiet ro " \
+                      "overlayroot=device:dev=UUID=upper,recurse=0\n":
+            raise Exception("Bad overlay loader options: {}".format(options))
+        ister.update_fstab(uuids, target, True)
+        with open("{}/etc/fstab".format(target), "r") as fstab:
+            entries = fstab.read()
+        if entries.find("UUID=upper") >= 0 or \
+           entries.find("UUID=boot") < 0:
+            raise Exception("Bad overlay fstab: {}".format(entries))
+        template["PartitionMountPoints"][0]["partition"] = 2
+        try:
+            ister.validate_template(template)
+        except Exception:
+            pass
+        else:
+            raise Exception("Mounted OverlayLower accepted")
+    finally:
+        ister.run_command(["rm", "-fr", target])
+
+
+def validate_pipelined_teardown():
+    """Run validate_pipelined_teardown test"""
+    source = tempfile.mkdtemp()
+    target = tempfile.mkdtemp()
+    with open("{}/file".format(target), "w") as ofile:
+        ofile.write("data")
+    ister.syncfs("{}/file".format(target))
+    if "/" not in ister.get_target_mounts("/") or \
+       ister.get_target_mounts(target):
+        raise Exception("Bad target mounts")
+    ister.start_writeback(target).join()
+    plan = ister.build_plan(json.loads(good_disk_template()))
+    steps = [step["step"] for step in plan["steps"]]
+    if steps.index("start_writeback") != steps.index("copy_files") + 1:
+        raise Exception("Writeback not started after the copy: {}"
+                        .format(steps))
+    # A daemon job releases its own scratch folder and lock
+    run_dir = ister.get_run_dir()
+    lock = open(os.path.join(run_dir, "nbd.lock"), "w")
+    ister.RUN_RESOURCES["lock"] = lock
+    ister.cleanup(source, target, raise_exception=False, shared_source=True,
+                  background=True)
+    if not ister.TEARDOWN:
+        raise Exception("Teardown not left in the background")
+    ister.wait_teardown()
+    if ister.TEARDOWN or os.path.exists(target) or \
+       not os.path.exists(source):
+        raise Exception("Background teardown incomplete")
+    if os.path.exists(run_dir) or not lock.closed or \
+       any(ister.RUN_RESOURCES.values()):
+        raise Exception("Shared source job leaked its run: {}"
+                        .format(ister.RUN_RESOURCES))
+    os.rmdir(source)
+
+
+def validate_template_batch():
+    """Run validate_template_batch test"""
+    folder = tempfile.mkdtemp()
+    key = "file://{}/missing.pub".format(folder)
+    bad = json.loads(good_disk_template())
+    bad.update(ImageSourceFormat="iso", ReuseLayout="yes",
+               Users=[{"username": "user", "key": key}],
+               PostNonChroot=[{"timeout": 5}])
+    good = json.loads(good_disk_template())
+    # Scripts are local to the installer, not to the validating host
+    good["PostChroot"] = ["/installer/only/setup.sh"]
+    templates = {"good.json": good,
+                 "min.json": json.loads(good_min_template()),
+                 "bad.json": bad,
+                 "nested/bad-too.json": {"ImageSourceType": "local",
+                                         "ImageSourceLocation": "file:///a",
+                                         "Users": [{"username": "other",
+                                                    "key": key}]},
+                 "malformed.json": {"ImageSourceType": "remote",
+                                    "ImageSourceLocation": "file:///a",
+                                    "ImageSourceMirrors": "http://x",
+                                    "Users": 5}}
+    os.makedirs("{}/nested".format(folder))
+    for name, template in templates.items():
+        with open("{0}/{1}".format(folder, name), "w") as tfile:
+            json.dump(template, tfile)
+    with open("{}/broken.json".format(folder), "w") as tfile:
+        tfile.write("{")
+    checked = []
+    check_url = ister.check_url
+    ister.check_url = lambda url: checked.append(url) or check_url(url)
+    try:
+        errors = ister.validate_templates([folder])
+    finally:
+        ister.check_url = check_url
+        ister.run_command(["rm", "-fr", folder])
+    errors = dict((os.path.basename(path), error)
+                  for path, error in errors.items())
+    if checked != ["file:///a", key]:
+        raise Exception("URLs not checked once: {}".format(checked))
+    if errors["good.json"] or errors["min.json"]:
+        raise Exception("Valid templates rejected: {}".format(errors))
+    if len(errors["bad.json"]) != 4 or len(errors["bad-too.json"]) != 1 or \
+       len(errors["broken.json"]) != 1 or \
+       len(errors["malformed.json"]) != 3:
+        raise Exception("Errors not all reported: {}".format(errors))
+    if ister.template_errors(templates["min.json"], {}) or \
+       "PartitionLayout" in templates["min.json"]:
+        raise Exception("Default layout inserted")
+
+
+def validate_install_packages():
+    """Run validate_install_packages test"""
+    template = json.loads(good_disk_template())
+    template["InstallPackages"] = [{"packagemanager": "zypper",
+                                    "type": "group", "name": "devel"}]
+    ister.validate_template(template)
+    plan = ister.build_plan(template)
+    steps = [step["step"] for step in plan["steps"]]
+    if not steps.index("setup_source") < steps.index("fetch_packages") < \
+       steps.index("create_partitions") or \
+       steps.index("install_packages") != steps.index("copy_files") + 1:
+        raise Exception("Packages not fetched during the copy: {}"
+                        .format(steps))
+    fetch = plan["steps"][steps.index("fetch_packages")]["commands"]
+    commit = plan["steps"][steps.index("install_packages")]["commands"]
+    if fetch != [["mkdir", "-p", "{run}/packages-root",
+                  "{run}/packages-upper", "{run}/packages-work"],
+                 ["mount", "-t", "overlay", "-o",
+                  "lowerdir={source},upperdir={run}/packages-upper,"
+                  "workdir={run}/packages-work", "overlay",
+                  "{run}/packages-root"],
+                 ["zypper", "--root", "{run}/packages-root", "--cache-dir",
+                  "{run}/packages", "-n", "in", "--download-only", "-t",
+                  "pattern", "devel"],
+                 ["umount", "{run}/packages-root"]] or \
+       commit != [["zypper", "--root", "{target}", "--cache-dir",
+                   "{run}/packages", "-n", "in", "-t", "pattern", "devel"]]:
+        raise Exception("Unexpected package commands: {0} {1}"
+                        .format(fetch, commit))
+    template["InstallPackages"][0]["type"] = "bundle"
+    try:
+        ister.validate_template(template)
+    except Exception:
+        pass
+    else:
+        raise Exception("Invalid InstallPackages accepted")
+    template["InstallPackages"][0]["type"] = "group"
+    metrics_file = tempfile.mkstemp()[1]
+    console_in, console_out = os.pipe()
+    ister.setup_progress(console_out, "file://{}".format(metrics_file))
+    run_dir = ister.RUN_RESOURCES["dir"]
+    ister.RUN_RESOURCES["dir"] = tempfile.mkdtemp()
+    try:
+        # The source isn't a system zypper can use
+        ister.start_package_download(template, tempfile.mkdtemp()).join()
+    finally:
+        ister.PROGRESS_SINKS["metrics"].close()
+        ister.PROGRESS_SINKS["metrics"] = None
+        ister.PROGRESS_SINKS["console"] = None
+        os.close(console_out)
+        ister.run_command(["rm", "-fr", ister.RUN_RESOURCES["dir"]])
+        ister.RUN_RESOURCES["dir"] = run_dir
+    with open(metrics_file, "r") as mfile:
+        events = [json.loads(line) for line in mfile
+                  if json.loads(line)["event"] == "package-download"]
+    os.remove(metrics_file)
+    with os.fdopen(console_in, "r") as console:
+        if "Package download failed" not in console.read() or \
+           len(events) != 1 or len(events[0]["failed"]) != 1:
+            raise Exception("Failed package download not logged: {}"
+                            .format(events))
+
+
+def validate_package_download():
+    """Run validate_package_download test"""
+    template = json.loads(good_post_install_template())
+    template["InstallPackages"] = template.pop("PostInstallPackages")
+    ister.validate_template(template)
+    ister.create_partitions(template)
+    ister.create_filesystems(template)
+    (source, target) = ister.setup_mounts(template)
+    try:
+        download = ister.start_package_download(template, source)
+        ister.copy_files(source, target)
+        download.join()
+        rpms = [name for _, _, files in os.walk(ister.get_package_cache())
+                for name in files if name.endswith(".rpm")]
+        if ister.INSTALL_REPORT["packages"]["failed"] or not rpms:
+            raise Exception("Packages not downloaded from the read only "
+                            "source: {}".format(
+                                ister.INSTALL_REPORT["packages"]))
+        ister.install_packages(template, target, download)
+        ister.run_command(["rpm", "--root", target, "-q", "linux"])
+    finally:
+        ister.cleanup(source, target)
+
+
 def run_tests(tests):
     """Run ister test suite"""
     flog = open("/root/test-log", "w")
@@ -370,7 +1613,34 @@ if __name__ == '__main__':
         validate_fs_default_detection,
         validate_full_user_install,
         validate_post_package_install,
-        validate_remote_image_setup
+        validate_remote_image_setup,
+        validate_rsync_progress_parse,
+        validate_progress_metrics,
+        validate_install_plan,
+        validate_command_executor,
+        validate_target_worker,
+        validate_image_format_detection,
+        validate_mirror_failover,
+        validate_io_tuning,
+        validate_install_mount_options,
+        validate_raid_setup,
+        validate_raid_loop_install,
+        validate_partition_alignment,
+        validate_post_scripts,
+        validate_preflight_check,
+        validate_copy_strategy,
+        validate_install_daemon,
+        validate_reuse_layout,
+        validate_lazy_source,
+        validate_memory_budget,
+        validate_run_isolation,
+        validate_ordered_copy,
+        validate_uncached_copy,
+        validate_overlay_install,
+        validate_pipelined_teardown,
+        validate_template_batch,
+        validate_install_packages,
+        validate_package_download
     ]
 
     run_tests(TESTS)